@@ -0,0 +1,197 @@
+"""
+Recording users' logins in the storage service without a call to it on each
+login.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LoginActivity(object):
+    """
+    Logins kept in memory and written to the storage service in batches by a
+    background thread.
+
+    Logins of the same user are combined while they wait, into a count and
+    the time of the last one, so memory use grows with the number of users
+    logging in rather than the number of logins. A batch is written once
+    ``batch_size`` users have logged in, or every ``flush_interval`` seconds
+    otherwise.
+
+    At most ``max_pending`` users' logins are kept. A login of another user
+    beyond that is dropped and counted, rather than slowing logins down or
+    growing without limit while the storage service is slow or unreachable.
+    Batches which fail to be written are kept to retry, as far as there is
+    space for them.
+    """
+
+    def __init__(self, backend, batch_size, flush_interval, max_pending,
+                 clock=time.time):
+        """
+        :param backend: Where to write logins to.
+        :type backend: ``authentication.backends.StorageBackend``
+        :param batch_size: The most users to write logins of at a time.
+        :type batch_size: int
+        :param flush_interval: The most seconds to wait between writes.
+        :type flush_interval: float
+        :param max_pending: The most users to keep logins of. If this is
+            ``0``, logins are not recorded.
+        :type max_pending: int
+        :param clock: A function which returns the current time in seconds
+            since the epoch.
+        """
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enabled = max_pending > 0
+        self._clock = clock
+        # Pending logins are ``[count, last_login]`` lists keyed by email
+        # address.
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counts = {
+            'recorded': 0,
+            'dropped': 0,
+            'written': 0,
+            'batches': 0,
+            'failures': 0,
+        }
+
+    def record(self, email):
+        """
+        Record that a user has logged in now.
+
+        :param email: The email address of the user.
+        :type email: string
+        :return: Whether the login was kept to be written.
+        :rtype: bool
+        """
+        if not self.enabled:
+            return False
+        now = self._clock()
+        with self._lock:
+            login = self._pending.get(email)
+            if login is not None:
+                login[0] += 1
+                login[1] = max(login[1], now)
+            elif len(self._pending) < self.max_pending:
+                self._pending[email] = [1, now]
+            else:
+                self._counts['dropped'] += 1
+                return False
+            self._counts['recorded'] += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+        return True
+
+    def _requeue(self, logins):
+        """
+        Keep logins which could not be written to try again, dropping those
+        of users for whom there is no space.
+        """
+        with self._lock:
+            for email, (count, last_login) in logins:
+                login = self._pending.get(email)
+                if login is not None:
+                    login[0] += count
+                    login[1] = max(login[1], last_login)
+                elif len(self._pending) < self.max_pending:
+                    self._pending[email] = [count, last_login]
+                else:
+                    self._counts['dropped'] += count
+
+    def flush(self):
+        """
+        Write all pending logins, ``batch_size`` users at a time.
+
+        If a batch cannot be written, whatever the error, it and the rest are
+        kept for the next flush.
+
+        :return: The number of logins written.
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._pending.items())
+                self._pending = OrderedDict()
+
+            written = 0
+            for start in range(0, len(pending), self.batch_size):
+                batch = pending[start:start + self.batch_size]
+                try:
+                    self.backend.record_logins(logins=[
+                        {'email': email, 'count': count,
+                         'last_login': last_login}
+                        for email, (count, last_login) in batch])
+                except Exception:
+                    # The storage service may be unreachable, or with an
+                    # in-process backend the database may fail.
+                    with self._lock:
+                        self._counts['failures'] += 1
+                    self._requeue(pending[start:])
+                    break
+                batch_logins = sum(login[0] for _, login in batch)
+                written += batch_logins
+                with self._lock:
+                    self._counts['batches'] += 1
+                    self._counts['written'] += batch_logins
+            return written
+
+    def start(self):
+        """
+        Write pending logins in a background thread, whenever there are
+        ``batch_size`` users' logins and at least every ``flush_interval``
+        seconds.
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Try to write all pending logins, and stop the background thread if
+        it is running.
+        """
+        if self._thread is None:
+            self.flush()
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Failed batches are kept by ``flush``, and the thread must
+                # keep running or logins would pile up until they are
+                # dropped.
+                pass
+            if self._stop.is_set():
+                return
+
+    def stats(self):
+        """
+        :return: The number of users with logins ``pending``, and counts of
+            logins ``recorded``, ``dropped`` and ``written``, of batches
+            written and of batches which failed to be written.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['pending'] = len(self._pending)
+        return stats
@@ -2,9 +2,13 @@
 An authentication service for use in a Jenca Cloud.
 """
 
+from collections import OrderedDict
+import functools
+import hashlib
+import multiprocessing
 import os
 
-from flask import Flask, jsonify, request, json
+from flask import Blueprint, current_app, Flask, g, jsonify, request
 from flask.ext.bcrypt import Bcrypt
 from flask.ext.login import (
     current_user,
@@ -15,19 +19,33 @@ from flask.ext.login import (
     make_secure_token,
     UserMixin,
 )
-from flask_jsonschema import JsonSchema, ValidationError
+from flask_jsonschema import ValidationError
 from flask_negotiate import consumes
 
-import requests
 from requests import codes
+from requests.exceptions import RequestException
 
-# This is necessary because urljoin moved between Python 2 and Python 3
-from future.standard_library import install_aliases
-install_aliases()
-
-# Ignore this line with linters because it necessarily comes after
-# `install_aliases`.
-from urllib.parse import urljoin  # noqa
+from authentication.activity import LoginActivity
+from authentication.backends import (
+    HTTPStorageBackend,
+    InProcessStorageBackend,
+    TimedStorageBackend,
+)
+from authentication.bloom import UserFilter
+from authentication.cache import UserCache
+from authentication.cost import calibrate_rounds, hash_rounds
+from authentication.hashing import HashingPool, pool_size, PoolFull
+from authentication.resilience import CircuitBreaker, ResilientStorageBackend
+from authentication.session_tokens import (
+    password_hash_fingerprint,
+    SessionTokens,
+)
+from authentication.single_flight import SingleFlight
+from authentication.storage_client import StorageClient
+from instrumentation.metrics import Counter, Gauge, Registry, instrument_app
+from instrumentation.profiling import profile_app, RequestProfiler
+from instrumentation.serving import thread_count, worker_count
+from instrumentation.validation import SchemaValidators
 
 
 class User(UserMixin):
@@ -60,17 +78,76 @@ class User(UserMixin):
         return self.email
 
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'secret')
-bcrypt = Bcrypt(app)
+# The routes of the service, which ``create_app`` adds to an application.
+blueprint = Blueprint('authentication', __name__)
+
+SECRET_KEY = os.environ.get('SECRET_KEY', 'secret')
+
+bcrypt = Bcrypt()
 login_manager = LoginManager()
-login_manager.init_app(app)
+
+# Request latencies and the other metrics below are published at /metrics.
+# With ``METRICS_DIR`` set, worker processes share their metrics through that
+# directory every ``METRICS_SYNC_INTERVAL`` seconds, so that /metrics gives
+# the metrics of all of them. See ``instrumentation.metrics.Registry``.
+metrics = Registry(
+    directory=os.environ.get('METRICS_DIR'),
+    sync_interval=float(os.environ.get('METRICS_SYNC_INTERVAL', 5)),
+)
+STORAGE_SECONDS = metrics.histogram(
+    'authentication_storage_seconds',
+    'Time taken by calls to the storage service.',
+    ['operation'],
+)
+BCRYPT_SECONDS = metrics.histogram(
+    'authentication_bcrypt_seconds',
+    'Time taken to hash or check a password, not including time queued.',
+    ['operation'],
+)
+check_password_hash = BCRYPT_SECONDS.timed(
+    bcrypt.check_password_hash, operation='check')
+generate_password_hash = BCRYPT_SECONDS.timed(
+    bcrypt.generate_password_hash, operation='generate')
+PASSWORD_REHASHES = metrics.counter(
+    'authentication_password_rehashes_total',
+    'Stored password hashes replaced on login because their work factor '
+    'differed from the configured one.',
+)
+
+# Requests can be profiled to see where time goes. Set
+# ``PROFILE_SAMPLE_RATE`` to the fraction of requests to profile with
+# cProfile, and ``PROFILE_SLOW_SECONDS`` to sample the stacks of requests
+# which take at least that long every ``PROFILE_SAMPLE_INTERVAL`` seconds.
+# Results, and memory traces, are given at /debug/profile and /debug/memory
+# to callers with the ``PROFILING_TOKEN``. These routes are only added if
+# that is set. See ``instrumentation.profiling``.
+profiler = RequestProfiler(
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+    slow_seconds=float(os.environ.get('PROFILE_SLOW_SECONDS', 0)),
+    interval=float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005)),
+)
+
+# Password hashing is deliberately slow, so it is done on a bounded pool of
+# workers. When the pool is full, requests which need hashing are refused
+# rather than tying up the threads which serve cheaper routes. Each worker
+# process has its own pool, so by default the cores are shared between the
+# processes. See ``authentication.hashing.pool_size``.
+_workers, _queue_depth = pool_size(
+    cpus=multiprocessing.cpu_count(),
+    processes=worker_count(),
+    threads=thread_count(),
+)
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', _workers))
+hashing_pool = HashingPool(
+    workers=BCRYPT_WORKERS,
+    queue_depth=int(os.environ.get('BCRYPT_QUEUE_DEPTH', _queue_depth)),
+)
+BCRYPT_RETRY_AFTER = int(os.environ.get('BCRYPT_RETRY_AFTER', 1))
 
 # Inputs can be validated using JSON schema.
-# Schemas are in app.config['JSONSCHEMA_DIR'].
-# See https://github.com/mattupstate/flask-jsonschema for details.
-app.config['JSONSCHEMA_DIR'] = os.path.join(app.root_path, 'schemas')
-jsonschema = JsonSchema(app)
+# Schemas are in app.config['JSONSCHEMA_DIR'], and are compiled when the
+# application is set up. See ``instrumentation.validation``.
+jsonschema = SchemaValidators()
 
 STORAGE_HOST = os.environ.get('STORAGE_HOST', 'storage')
 if STORAGE_HOST.find('env:') == 0:
@@ -78,6 +155,247 @@ if STORAGE_HOST.find('env:') == 0:
 
 STORAGE_URL = os.environ.get('STORAGE_URL', 'http://' + STORAGE_HOST + ':5001')
 
+# All requests to the storage service share one pool of connections.
+STORAGE_POOL_SIZE = int(os.environ.get('STORAGE_POOL_SIZE', 10))
+storage_client = StorageClient(
+    base_url=STORAGE_URL,
+    pool_size=STORAGE_POOL_SIZE,
+    connect_timeout=float(os.environ.get('STORAGE_CONNECT_TIMEOUT', 1)),
+    read_timeout=float(os.environ.get('STORAGE_READ_TIMEOUT', 5)),
+    retries=int(os.environ.get('STORAGE_RETRIES', 2)),
+)
+
+# User data is reached through the storage service's HTTP API unless
+# ``STORAGE_BACKEND`` is ``inprocess``. That is for when the storage service's
+# database can be used directly from this process.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'http')
+if STORAGE_BACKEND == 'inprocess':
+    storage_backend = InProcessStorageBackend()
+else:
+    # Set ``STORAGE_RECORD_CACHE_SIZE`` to ``0`` to always get users' details
+    # in full rather than revalidating the last details seen.
+    storage_backend = HTTPStorageBackend(
+        client=storage_client,
+        max_records=int(os.environ.get('STORAGE_RECORD_CACHE_SIZE', 10000)),
+    )
+# At most ``STORAGE_MAX_IN_FLIGHT`` calls to the storage service are made at
+# once, and after ``STORAGE_FAILURE_THRESHOLD`` failures in a row no calls are
+# made for ``STORAGE_RESET_TIMEOUT`` seconds. Requests which need the storage
+# service meanwhile are refused straight away rather than waiting on it. With
+# ``STORAGE_HEDGING`` set to ``true``, a read which is slower than the
+# ``STORAGE_HEDGE_PERCENTILE`` of recent reads is sent again.
+storage_backend = ResilientStorageBackend(
+    backend=storage_backend,
+    max_in_flight=int(os.environ.get(
+        'STORAGE_MAX_IN_FLIGHT', STORAGE_POOL_SIZE)),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get('STORAGE_FAILURE_THRESHOLD', 5)),
+        reset_timeout=float(os.environ.get('STORAGE_RESET_TIMEOUT', 10)),
+    ),
+    hedging=os.environ.get('STORAGE_HEDGING', 'false').lower() == 'true',
+    hedge_percentile=float(os.environ.get('STORAGE_HEDGE_PERCENTILE', 0.95)),
+    min_hedge_delay=float(os.environ.get('STORAGE_HEDGE_MIN_DELAY', 0.01)),
+)
+resilient_storage_backend = storage_backend
+storage_backend = TimedStorageBackend(
+    backend=storage_backend,
+    histogram=STORAGE_SECONDS,
+)
+
+# Users loaded from the storage service, and users which were not found, can
+# be cached. Set ``USER_CACHE_SIZE`` to a positive number to enable this.
+user_cache = UserCache(
+    max_entries=int(os.environ.get('USER_CACHE_SIZE', 0)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60)),
+)
+# The email addresses of all users can be kept in a Bloom filter, so that
+# users who certainly do not exist are ruled out without asking the storage
+# service. Logging in as them, checking their status and deleting them give
+# NOT_FOUND straight away, and passwords of new users which are certainly not
+# in use are hashed without first asking whether they are. Set
+# ``USER_FILTER_CAPACITY`` to a positive number to enable this. The filter is
+# kept in shared memory, so that worker processes forked after this module is
+# imported see users who sign up through any of them. It is built in the
+# background once the service starts and then rebuilt every
+# ``USER_FILTER_REBUILD_INTERVAL`` seconds. Users added to the storage service
+# in other ways, such as through another instance of this service, are added
+# every ``USER_FILTER_SYNC_INTERVAL`` seconds, reading again those added in the
+# ``USER_FILTER_SYNC_OVERLAP`` seconds before the last sync. If the filter has
+# not been brought up to date for ``USER_FILTER_MAX_LAG`` seconds, every user
+# is looked up in the storage service until it is.
+user_filter = UserFilter(
+    backend=storage_backend,
+    capacity=int(os.environ.get('USER_FILTER_CAPACITY', 0)),
+    error_rate=float(os.environ.get('USER_FILTER_ERROR_RATE', 0.01)),
+    page_size=int(os.environ.get('USER_FILTER_PAGE_SIZE', 1000)),
+    rebuild_interval=float(
+        os.environ.get('USER_FILTER_REBUILD_INTERVAL', 60 * 60)),
+    sync_interval=float(os.environ.get('USER_FILTER_SYNC_INTERVAL', 1)),
+    sync_overlap=float(os.environ.get('USER_FILTER_SYNC_OVERLAP', 10)),
+    max_lag=float(os.environ.get('USER_FILTER_MAX_LAG', 30)),
+    shared=True,
+)
+# Each user's last login time and number of logins are recorded in the
+# storage service. Logins are kept in memory and written in batches of up to
+# ``LOGIN_ACTIVITY_BATCH_SIZE`` users, at least every
+# ``LOGIN_ACTIVITY_FLUSH_INTERVAL`` seconds, by a thread started in each
+# worker process. Logins of at most ``LOGIN_ACTIVITY_MAX_PENDING`` users are
+# kept, and others are dropped. Set that to ``0`` to disable this.
+login_activity = LoginActivity(
+    backend=storage_backend,
+    batch_size=int(os.environ.get('LOGIN_ACTIVITY_BATCH_SIZE', 500)),
+    flush_interval=float(
+        os.environ.get('LOGIN_ACTIVITY_FLUSH_INTERVAL', 5)),
+    max_pending=int(os.environ.get('LOGIN_ACTIVITY_MAX_PENDING', 100000)),
+)
+# Concurrent lookups of the same user, for example by requests from many
+# tabs, share one call to the storage service.
+storage_lookups = SingleFlight()
+USER_FILTER_CHECKS = metrics.counter(
+    'authentication_user_filter_checks_total',
+    'Users looked up in the user filter, by whether the filter ruled them '
+    'out or not and the storage service found them or did not.',
+    ['result'],
+)
+
+# With ``SESSION_TOKENS`` set to ``true``, logging in gives a signed token
+# rather than setting cookies. Clients send it in an ``Authorization: Bearer``
+# header, and it is checked without the storage service except once every
+# ``SESSION_TOKEN_REVALIDATE_AFTER`` seconds. Tokens are signed with
+# ``SECRET_KEY`` and ones signed with any of the comma separated
+# ``SESSION_TOKEN_OLD_KEYS`` are still accepted, so that keys can be rotated.
+session_tokens = SessionTokens(
+    secret_keys=[SECRET_KEY] + [
+        key for key in os.environ.get('SESSION_TOKEN_OLD_KEYS', '').split(',')
+        if key],
+    max_age=float(os.environ.get('SESSION_TOKEN_MAX_AGE', 24 * 60 * 60)),
+    revalidate_after=float(
+        os.environ.get('SESSION_TOKEN_REVALIDATE_AFTER', 60)),
+)
+SESSION_TOKEN_CHECKS = metrics.counter(
+    'authentication_session_token_checks_total',
+    'Session tokens checked, by whether they were accepted locally, '
+    'accepted after checking the storage service, or rejected.',
+    ['result'],
+)
+
+
+@metrics.add_collector
+def collect_user_cache_metrics():
+    """
+    :return: Metrics for the user cache.
+    """
+    stats = user_cache.stats()
+    size = Gauge('authentication_user_cache_entries',
+                 'Entries in the user cache.')
+    size.set(stats['size'])
+    events = Counter('authentication_user_cache_events_total',
+                     'Lookups in and evictions from the user cache.',
+                     ['event'])
+    for event in ('hits', 'misses', 'evictions'):
+        events.set(stats[event], event=event)
+    return [size, events]
+
+
+@metrics.add_collector
+def collect_storage_resilience_metrics():
+    """
+    :return: Metrics for the bulkhead, circuit breaker and hedged reads
+        around the storage service.
+    """
+    stats = resilient_storage_backend.stats()
+    state = Gauge('authentication_storage_circuit_state',
+                  'Whether the circuit breaker for the storage service is '
+                  'in each state.', ['state'])
+    for name in ('closed', 'open', 'half_open'):
+        state.set(int(stats['state'] == name), state=name)
+    in_flight = Gauge('authentication_storage_in_flight',
+                      'Calls to the storage service in flight.')
+    in_flight.set(stats['in_flight'])
+    calls = Counter('authentication_storage_call_events_total',
+                    'Calls to the storage service which were rejected '
+                    'because the circuit was open or the bulkhead was full, '
+                    'which failed, and duplicate reads which were sent and '
+                    'which finished first.', ['event'])
+    for event in ('rejected_circuit_open', 'rejected_bulkhead_full',
+                  'failures', 'hedges_sent', 'hedges_won'):
+        calls.set(stats[event], event=event)
+    return [state, in_flight, calls]
+
+
+@metrics.add_collector
+def collect_storage_lookup_metrics():
+    """
+    :return: Metrics for lookups which share calls to the storage service.
+    """
+    stats = storage_lookups.stats()
+    lookups = Counter('authentication_storage_lookups_total',
+                      'User lookups which called the storage service, and '
+                      'those which shared a concurrent identical call.',
+                      ['result'])
+    for result in ('executed', 'collapsed'):
+        lookups.set(stats[result], result=result)
+    return [lookups]
+
+
+@metrics.add_collector
+def collect_login_activity_metrics():
+    """
+    :return: Metrics for logins waiting to be written to the storage
+        service.
+    """
+    stats = login_activity.stats()
+    pending = Gauge('authentication_login_activity_pending',
+                    'Users with logins waiting to be written to the storage '
+                    'service.')
+    pending.set(stats['pending'])
+    logins = Counter('authentication_login_activity_logins_total',
+                     'Logins recorded, dropped because too many users had '
+                     'logins waiting, and written to the storage service.',
+                     ['event'])
+    for event in ('recorded', 'dropped', 'written'):
+        logins.set(stats[event], event=event)
+    batches = Counter('authentication_login_activity_batches_total',
+                      'Batches of logins written to the storage service, '
+                      'and those which failed and were kept to retry.',
+                      ['result'])
+    batches.set(stats['batches'], result='written')
+    batches.set(stats['failures'], result='failed')
+    return [pending, logins, batches]
+
+
+@metrics.add_collector
+def collect_user_filter_metrics():
+    """
+    :return: Metrics for the user filter.
+    """
+    stats = user_filter.stats()
+    gauges = []
+    for name, documentation in (
+            ('entries', 'Email addresses added to the user filter.'),
+            ('bytes', 'Memory used by the user filter.'),
+            ('false_positive_rate', 'The expected chance that the user '
+                                    'filter does not rule out an email '
+                                    'address which is not in use.')):
+        gauge = Gauge('authentication_user_filter_' + name, documentation)
+        gauge.set(stats[name])
+        gauges.append(gauge)
+    return gauges
+
+
+def get_user_details(email):
+    """
+    Get a user's details from the storage service, sharing a call with any
+    concurrent lookup of the same user.
+
+    :param email: The email address of the user.
+    :type email: string
+    :return: The user's details, or ``None`` if there is no such user.
+    :rtype: ``dict`` or ``None``
+    """
+    return storage_lookups.do(
+        ('user', email), storage_backend.get_user, email=email)
+
 
 @login_manager.user_loader
 def load_user_from_id(user_id):
@@ -96,15 +414,23 @@ def load_user_from_id(user_id):
         there is no such user.
     :rtype: ``User`` or ``None``.
     """
-    url = urljoin(STORAGE_URL, 'users/{email}').format(email=user_id)
-    response = requests.get(url, headers={'Content-Type': 'application/json'})
+    found, user = user_cache.lookup(user_id)
+    if found:
+        return user
 
-    if response.status_code == codes.OK:
-        details = json.loads(response.text)
-        return User(
-            email=details['email'],
-            password_hash=details['password_hash'],
-        )
+    # The filter has every user who was added more than a few seconds ago,
+    # so a user whom it rules out does not exist.
+    if not user_filter.might_exist(user_id):
+        USER_FILTER_CHECKS.inc(result='absent')
+        return None
+
+    details = get_user_details(email=user_id)
+    if user_filter.ready:
+        result = 'false_positive' if details is None else 'present'
+        USER_FILTER_CHECKS.inc(result=result)
+    user = None if details is None else User(**details)
+    user_cache.store(user_id, user)
+    return user
 
 
 @login_manager.token_loader
@@ -121,21 +447,115 @@ def load_user_from_token(auth_token):
         there is no such user.
     :rtype: ``User`` or ``None``.
     """
-    response = requests.get(
-        urljoin(STORAGE_URL, '/users'),
-        headers={'Content-Type': 'application/json'},
+    # Storage keeps a digest of each user's token so that a user can be found
+    # with a single indexed lookup rather than by checking every user.
+    fingerprint = hashlib.sha256(auth_token.encode('utf8')).hexdigest()
+    details = storage_lookups.do(
+        ('token', fingerprint),
+        storage_backend.get_user_by_token_fingerprint,
+        fingerprint=fingerprint,
     )
 
-    for details in json.loads(response.text):
-        user = User(
-            email=details['email'],
-            password_hash=details['password_hash'],
-        )
+    if details is not None:
+        user = User(**details)
         if user.get_auth_token() == auth_token:
             return user
 
 
-@app.errorhandler(ValidationError)
+def rehash_password(user, password):
+    """
+    Replace a user's stored password hash with one made with the configured
+    work factor.
+
+    This is best effort. The old hash still works, so if the service is busy
+    or the storage service cannot be reached, the password is rehashed on a
+    later login instead.
+
+    :param user: A user whose password has just been checked.
+    :type user: ``User``
+    :param password: The user's password.
+    :type password: string
+    :return: The user with the new password hash, or ``user`` if the new hash
+        was not stored.
+    :rtype: ``User``
+    """
+    try:
+        password_hash = hashing_pool.run(
+            generate_password_hash, password,
+            current_app.config['BCRYPT_LOG_ROUNDS'])
+        details = storage_backend.update_user(
+            email=user.email,
+            password_hash=password_hash.decode('utf8'),
+        )
+    except (PoolFull, RequestException):
+        return user
+
+    user_cache.invalidate(user.email)
+    if details is None:
+        return user
+
+    PASSWORD_REHASHES.inc()
+    return User(**details)
+
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    """
+    Flask-Login ``request_loader`` callback, for session tokens.
+
+    A token which is due to be revalidated is only accepted if its user still
+    exists with the same password hash. A refreshed token is then given in
+    the ``X-Session-Token`` response header.
+
+    :param request: The request to load a user for.
+    :type request: ``flask.Request``
+    :return: The user identified by the request's session token, or ``None``
+        if session tokens are not enabled or there is no valid token. Users
+        accepted without consulting the storage service have no
+        ``password_hash``.
+    :rtype: ``User`` or ``None``.
+    """
+    if not current_app.config['SESSION_TOKENS']:
+        return None
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer':
+        return None
+
+    claims = session_tokens.verify(token)
+    if claims is None:
+        SESSION_TOKEN_CHECKS.inc(result='rejected')
+        return None
+
+    if not session_tokens.needs_revalidation(claims):
+        SESSION_TOKEN_CHECKS.inc(result='local')
+        return User(email=claims['email'], password_hash=None)
+
+    # The cache is bypassed so that changes made through another instance of
+    # this service are seen.
+    details = get_user_details(email=claims['email'])
+    if details is None or (password_hash_fingerprint(
+            details['password_hash']) != claims['password']):
+        SESSION_TOKEN_CHECKS.inc(result='rejected')
+        return None
+
+    SESSION_TOKEN_CHECKS.inc(result='revalidated')
+    g.refreshed_session_token = session_tokens.refresh(claims)
+    return User(**details)
+
+
+@blueprint.after_app_request
+def send_refreshed_session_token(response):
+    """
+    Give the client a session token which was refreshed for this request.
+    """
+    token = getattr(g, 'refreshed_session_token', None)
+    if token is not None:
+        response.headers['X-Session-Token'] = token
+    return response
+
+
+@blueprint.app_errorhandler(ValidationError)
 def on_validation_error(error):
     """
     :resjson string title: An explanation that there was a validation error.
@@ -151,26 +571,65 @@ def on_validation_error(error):
     ), codes.BAD_REQUEST
 
 
-@app.route('/login', methods=['POST'])
+@blueprint.app_errorhandler(RequestException)
+def on_storage_error(error):
+    """
+    :resjson string title: An explanation that the storage service could not
+        be reached.
+    :resjson string message: The precise error.
+    :status 503:
+    """
+    return jsonify(
+        title='The storage service is unavailable.',
+        detail=str(error),
+    ), codes.SERVICE_UNAVAILABLE
+
+
+@blueprint.app_errorhandler(PoolFull)
+def on_pool_full(error):
+    """
+    :resheader Retry-After: The number of seconds to wait before trying
+        again.
+    :resjson string title: An explanation that the service is busy.
+    :resjson string message: Details of why the service is busy.
+    :status 503:
+    """
+    return jsonify(
+        title='The service is busy.',
+        detail='Too many passwords are being checked. Try again later.',
+    ), codes.SERVICE_UNAVAILABLE, {'Retry-After': str(BCRYPT_RETRY_AFTER)}
+
+
+@blueprint.route('/login', methods=['POST'])
 @consumes('application/json')
 @jsonschema.validate('user', 'get')
 def login():
     """
     Log in a given user.
 
+    If the user's stored password hash was made with a different work factor
+    to the configured one, it is replaced. This changes the user's remember
+    token.
+
     :param email: An email address to log in as.
     :type email: string
     :param password: A password associated with the given ``email`` address.
     :type password: string
     :reqheader Content-Type: application/json
     :resheader Content-Type: application/json
-    :resheader Set-Cookie: A ``remember_token``.
+    :resheader Set-Cookie: A ``remember_token``, unless session tokens are
+        enabled.
     :resjson string email: The email address which has been logged in.
     :resjson string password: The password of the user which has been logged
         in.
+    :resjson string token: A session token to send in an
+        ``Authorization: Bearer`` header. This is only given if session tokens
+        are enabled.
     :status 200: A user with the given ``email`` has been logged in.
     :status 404: No user can be found with the given ``email``.
     :status 401: The given ``password`` is incorrect.
+    :status 503: Too many passwords are being checked. Try again after the
+        number of seconds given in the ``Retry-After`` header.
     """
     email = request.json['email']
     password = request.json['password']
@@ -183,19 +642,34 @@ def login():
                 email=email),
         ), codes.NOT_FOUND
 
-    if not bcrypt.check_password_hash(user.password_hash, password):
+    if not hashing_pool.run(check_password_hash, user.password_hash,
+                            password):
         return jsonify(
             title='An incorrect password was provided.',
             detail='The password for the user "{email}" does not match the '
                    'password provided.'.format(email=email),
         ), codes.UNAUTHORIZED
 
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    if hash_rounds(user.password_hash) != rounds:
+        user = rehash_password(user=user, password=password)
+
+    # This is written to the storage service later, in a batch.
+    login_activity.record(email=user.email)
+
+    if current_app.config['SESSION_TOKENS']:
+        token = session_tokens.issue(
+            email=user.email,
+            password_hash=user.password_hash,
+        )
+        return jsonify(email=email, password=password, token=token)
+
     login_user(user, remember=True)
 
     return jsonify(email=email, password=password)
 
 
-@app.route('/logout', methods=['POST'])
+@blueprint.route('/logout', methods=['POST'])
 @consumes('application/json')
 @login_required
 def logout():
@@ -209,7 +683,7 @@ def logout():
     return jsonify({}), codes.OK
 
 
-@app.route('/users/<email>', methods=['DELETE'])
+@blueprint.route('/users/<email>', methods=['DELETE'])
 @consumes('application/json')
 def specific_user_route(email):
     """
@@ -221,25 +695,25 @@ def specific_user_route(email):
     :status 200: The user has been deleted.
     :status 404: There is no user with the given ``email``.
     """
-    user = load_user_from_id(email)
-
-    if user is None:
+    # The storage service says whether there was a user to delete, so there
+    # is no need to check first, unless the user filter rules them out.
+    details = None
+    if user_filter.might_exist(email):
+        details = storage_backend.delete_user(email=email)
+    user_cache.invalidate(email)
+
+    if details is None:
         return jsonify(
             title='The requested user does not exist.',
             detail='No user exists with the email "{email}"'.format(
                 email=email),
         ), codes.NOT_FOUND
 
-    requests.delete(
-        urljoin(STORAGE_URL, '/users/{email}'.format(email=email)),
-        headers={'Content-Type': 'application/json'},
-    )
-
-    return_data = jsonify(email=user.email)
+    return_data = jsonify(email=details['email'])
     return return_data, codes.OK
 
 
-@app.route('/signup', methods=['POST'])
+@blueprint.route('/signup', methods=['POST'])
 @consumes('application/json')
 @jsonschema.validate('user', 'create')
 def signup():
@@ -257,39 +731,137 @@ def signup():
     :status 200: A user with the given ``email`` and ``password`` has been
         created.
     :status 409: There already exists a user with the given ``email``.
+    :status 503: Too many passwords are being hashed. Try again after the
+        number of seconds given in the ``Retry-After`` header.
     """
     email = request.json['email']
     password = request.json['password']
 
-    if load_user_from_id(email) is not None:
+    # The storage service refuses to create a user whose email address is in
+    # use, so there is no need to check first.
+    password_hash = hashing_pool.run(
+        generate_password_hash, password,
+        current_app.config['BCRYPT_LOG_ROUNDS'])
+    created = storage_backend.create_user(
+        email=email,
+        password_hash=password_hash.decode('utf8'),
+    )
+
+    if not created:
         return jsonify(
             title='There is already a user with the given email address.',
             detail='A user already exists with the email "{email}"'.format(
                 email=email),
         ), codes.CONFLICT
 
-    data = {
-        'email': email,
-        'password_hash': bcrypt.generate_password_hash(password).decode(
-            'utf8'),
-    }
+    user_cache.invalidate(email)
+    user_filter.add(email)
+    return jsonify(email=email, password=password), codes.CREATED
 
-    requests.post(
-        urljoin(STORAGE_URL, '/users'),
-        headers={'Content-Type': 'application/json'},
-        data=json.dumps(data),
-    )
 
-    return jsonify(email=email, password=password), codes.CREATED
+@blueprint.route('/signup/batch', methods=['POST'])
+@consumes('application/json')
+@jsonschema.validate('user', 'batch_create')
+def signup_batch():
+    """
+    Sign up many new users.
 
+    Email addresses which are already in use are looked up in one request
+    to the storage service first, so that only the passwords of users who
+    can be created are hashed. Passwords are hashed in parallel and then all
+    new users are sent to the storage service in one request.
 
-@app.route('/status', methods=['GET'])
+    :param users: An array of objects with ``email`` and ``password``
+        strings.
+    :type users: array
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson array created: The email addresses of the users which have been
+        created.
+    :resjson array conflicts: The email addresses of the users which have not
+        been created because there already exists a user with the email
+        address.
+    :status 200: All users without conflicts have been created.
+    :status 503: Too many passwords are being hashed. Try again after the
+        number of seconds given in the ``Retry-After`` header.
+    """
+    users = request.json['users']
+
+    emails = OrderedDict.fromkeys(user['email'] for user in users)
+    maybe_in_use = [
+        email for email in emails if user_filter.might_exist(email)]
+    in_use = set()
+    if maybe_in_use:
+        existing, _ = storage_backend.get_users(emails=maybe_in_use)
+        in_use.update(user['email'] for user in existing)
+
+    new_users = []
+    for user in users:
+        if user['email'] in in_use:
+            continue
+        # Only the first user with each email address can be created.
+        in_use.add(user['email'])
+        new_users.append(user)
+
+    created = []
+    if new_users:
+        password_hashes = hashing_pool.map(
+            functools.partial(
+                generate_password_hash,
+                rounds=current_app.config['BCRYPT_LOG_ROUNDS']),
+            [user['password'] for user in new_users],
+        )
+        created, _ = storage_backend.create_users(users=[
+            {'email': user['email'],
+             'password_hash': password_hash.decode('utf8')}
+            for user, password_hash in zip(new_users, password_hashes)])
+    for email in created:
+        user_cache.invalidate(email)
+        user_filter.add(email)
+
+    # Every user but the first with each email address which was created is
+    # a conflict, whether or not it was sent to the storage service.
+    not_yet_seen = set(created)
+    conflicts = []
+    for user in users:
+        if user['email'] in not_yet_seen:
+            not_yet_seen.discard(user['email'])
+        else:
+            conflicts.append(user['email'])
+
+    return jsonify(created=created, conflicts=conflicts)
+
+
+@blueprint.route('/cache', methods=['GET'])
+@consumes('application/json')
+def cache_route():
+    """
+    Get statistics about the user cache.
+
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson int size: The number of cached entries.
+    :resjson int max_entries: The maximum number of cached entries. The cache
+        is disabled if this is 0.
+    :resjson int hits: The number of lookups which found a cached entry.
+    :resjson int misses: The number of lookups which did not find a cached
+        entry.
+    :resjson int evictions: The number of entries removed to make space for
+        others.
+    :status 200:
+    """
+    return jsonify(**user_cache.stats())
+
+
+@blueprint.route('/status', methods=['GET'])
 @consumes('application/json')
 def status():
     """
     Get information about the current activated user.
 
     :reqheader Content-Type: application/json
+    :reqheader Authorization: ``Bearer`` and a session token, if session
+        tokens are enabled.
     :resheader Content-Type: application/json
     :resjson bool is_authenticated: There is a current authenticated user.
     :resjson string email: The email address of the current user. This is only
@@ -300,8 +872,112 @@ def status():
         return jsonify(is_authenticated=True, email=current_user.email)
     return jsonify(is_authenticated=False)
 
+
+def bcrypt_log_rounds():
+    """
+    The bcrypt work factor is ``BCRYPT_LOG_ROUNDS`` if that is set.
+    Otherwise, if ``BCRYPT_TARGET_SECONDS`` is set, it is the highest work
+    factor with which checking a password takes no longer than that on this
+    host. Stored hashes with a different work factor are replaced when their
+    users log in.
+
+    :return: The bcrypt work factor to use.
+    :rtype: int
+    """
+    if 'BCRYPT_LOG_ROUNDS' in os.environ:
+        return int(os.environ['BCRYPT_LOG_ROUNDS'])
+    if 'BCRYPT_TARGET_SECONDS' in os.environ:
+        return calibrate_rounds(
+            target_seconds=float(os.environ['BCRYPT_TARGET_SECONDS']))
+    return 12
+
+
+def create_app(config=None):
+    """
+    Create an application which serves the authentication service's routes,
+    with its requests measured at ``/metrics`` and profiled as configured.
+
+    The storage client, caches and other state outside of the application
+    are shared by every application in a process.
+
+    :param config: Configuration to use instead of the defaults, which are
+        taken from environment variables.
+    :type config: ``dict``
+    :return: An application instance.
+    :rtype: ``Flask``
+    """
+    config = config or {}
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = SECRET_KEY
+    # See ``session_tokens``.
+    app.config['SESSION_TOKENS'] = os.environ.get(
+        'SESSION_TOKENS', 'false').lower() == 'true'
+    app.config['JSONSCHEMA_DIR'] = os.path.join(app.root_path, 'schemas')
+    app.config['PROFILING_TOKEN'] = os.environ.get('PROFILING_TOKEN')
+    if 'BCRYPT_LOG_ROUNDS' not in config:
+        # Calibrating the work factor takes a while, so it is only done if
+        # it is needed.
+        app.config['BCRYPT_LOG_ROUNDS'] = bcrypt_log_rounds()
+    app.config.update(config)
+
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+    jsonschema.init_app(app)
+    app.register_blueprint(blueprint)
+    instrument_app(app=app, registry=metrics)
+    profile_app(
+        app=app,
+        profiler=profiler,
+        token=app.config['PROFILING_TOKEN'],
+    )
+    return app
+
+
+def reset_after_fork():
+    """
+    Prepare a newly forked worker process to serve requests.
+
+    Connections opened before the fork are shared with the parent process,
+    so they are closed here and each worker opens its own. Threads do not
+    survive a fork, so the user filter, the writing of login activity and
+    the sharing of metrics are started here rather than when this module is
+    imported.
+    """
+    storage_client.close()
+    if STORAGE_BACKEND == 'inprocess':
+        from storage.storage import (
+            app as storage_app,
+            dispose_engines,
+            user_counts,
+        )
+        dispose_engines(app=storage_app)
+        user_counts.start()
+    user_filter.start()
+    login_activity.start()
+    metrics.start_sync()
+
+
+def finish_before_exit():
+    """
+    Write pending login activity before a worker process exits, so that it
+    is not lost when the service is stopped or restarted. With the in-process
+    storage backend, pending changes to the number of users are also written.
+    """
+    login_activity.stop()
+    if STORAGE_BACKEND == 'inprocess':
+        from storage.storage import user_counts
+        user_counts.stop()
+
+
+app = create_app()
+
 if __name__ == '__main__':   # pragma: no cover
+    user_filter.start()
+    login_activity.start()
     # Specifying 0.0.0.0 as the host tells the operating system to listen on
     # all public IPs. This makes the server visible externally.
     # See http://flask.pocoo.org/docs/0.10/quickstart/#a-minimal-application
-    app.run(host='0.0.0.0')
+    try:
+        app.run(host='0.0.0.0')
+    finally:
+        finish_before_exit()
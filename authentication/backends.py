@@ -0,0 +1,457 @@
+"""
+Ways for the authentication service to reach user data.
+
+Each backend gives user details as dictionaries with ``email`` and
+``password_hash`` keys.
+"""
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from requests import codes
+from sqlalchemy.exc import IntegrityError
+
+from authentication.cache import UserCache
+
+# The storage service gives this header after a write. Reads which send it
+# back are served from the primary database rather than a replica until the
+# time which it gives.
+PRIMARY_UNTIL_HEADER = 'X-Primary-Until'
+
+
+class StorageBackend(object):
+    """
+    The interface to user data which the authentication service needs.
+    """
+
+    def get_user(self, email):
+        """
+        :param email: The email address of a user.
+        :type email: string
+        :return: The details of the user with the given ``email``, or
+            ``None`` if there is no such user.
+        :rtype: ``dict`` or ``None``
+        """
+        raise NotImplementedError()
+
+    def get_user_by_token_fingerprint(self, fingerprint):
+        """
+        :param fingerprint: The SHA-256 hex digest of a user's remember
+            token.
+        :type fingerprint: string
+        :return: The details of the user with the given token
+            ``fingerprint``, or ``None`` if there is no such user.
+        :rtype: ``dict`` or ``None``
+        """
+        raise NotImplementedError()
+
+    def get_users(self, emails):
+        """
+        :param emails: The email addresses of the users to get.
+        :type emails: list of strings
+        :return: A tuple of the details of the users which exist and the
+            email addresses of those which do not, each in the order given
+            and without repeats.
+        :rtype: ``tuple``
+        """
+        raise NotImplementedError()
+
+    def get_users_page(self, after, limit):
+        """
+        :param after: Only give users with email addresses after this one,
+            or ``None`` to start from the first user.
+        :type after: string or ``None``
+        :param limit: The largest number of users to give.
+        :type limit: int
+        :return: A tuple of the details of up to ``limit`` users in order of
+            email address, the ``after`` value for the next page or ``None``
+            if this is the last page, and the total number of users.
+        :rtype: ``tuple``
+        """
+        raise NotImplementedError()
+
+    def get_new_users(self, since, after, limit):
+        """
+        :param since: Only give users added at or after this time, in
+            seconds since the epoch by the storage service's clock, or
+            ``None`` to give all users.
+        :type since: float or ``None``
+        :param after: Only give users with email addresses after this one,
+            or ``None`` to start from the first user.
+        :type after: string or ``None``
+        :param limit: The largest number of users to give.
+        :type limit: int
+        :return: A tuple of the details of up to ``limit`` users in order of
+            email address, the ``after`` value for the next page or ``None``
+            if this is the last page, and the time by the storage service's
+            clock at which the users were read.
+        :rtype: ``tuple``
+        """
+        raise NotImplementedError()
+
+    def create_user(self, email, password_hash):
+        """
+        :param email: The email address of the new user.
+        :type email: string
+        :param password_hash: The password hash of the new user.
+        :type password_hash: string
+        :return: Whether the user was created. It is not created if there is
+            already a user with the given ``email``.
+        :rtype: bool
+        """
+        raise NotImplementedError()
+
+    def create_users(self, users):
+        """
+        :param users: The details of the new users.
+        :type users: list of ``dict``
+        :return: A tuple of the email addresses of the users which were
+            created, and the email addresses of the users which were not
+            created because their email addresses are already in use.
+        :rtype: ``tuple``
+        """
+        raise NotImplementedError()
+
+    def update_user(self, email, password_hash):
+        """
+        :param email: The email address of the user to update.
+        :type email: string
+        :param password_hash: The new password hash of the user.
+        :type password_hash: string
+        :return: The updated details of the user, or ``None`` if there is no
+            such user.
+        :rtype: ``dict`` or ``None``
+        """
+        raise NotImplementedError()
+
+    def record_logins(self, logins):
+        """
+        :param logins: Dictionaries with the ``email`` of a user, a
+            ``count`` of their logins and the time of the ``last_login`` of
+            those, in seconds since the epoch.
+        :type logins: list of ``dict``
+        :return: The number of entries of ``logins`` for users who exist.
+            Logins of other users are ignored.
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+    def delete_user(self, email):
+        """
+        :param email: The email address of the user to delete.
+        :type email: string
+        :return: The details of the deleted user, or ``None`` if there was
+            no such user.
+        :rtype: ``dict`` or ``None``
+        """
+        raise NotImplementedError()
+
+
+class HTTPStorageBackend(StorageBackend):
+    """
+    Reach user data through the storage service's HTTP API.
+
+    The last user details seen for each email address can be kept with the
+    storage service's ``ETag`` for them. A later ``get_user`` sends the tag,
+    and if the user is unchanged the storage service answers with an empty
+    ``304`` response and the kept details are given.
+
+    After a user is written, the storage service may give an
+    ``X-Primary-Until`` header. Until then, ``get_user`` sends it back for
+    that user only, so that reads of the user see the write even if the
+    storage service's replicas lag behind, while reads of other users are
+    still served from the replicas. Writes are only remembered by the
+    backend which made them, so reads made through another process soon
+    after a write may not see it.
+    """
+
+    def __init__(self, client, max_records=0, clock=time.time):
+        """
+        :param client: A client for the storage service.
+        :type client: ``authentication.storage_client.StorageClient``
+        :param max_records: The maximum number of users' details to keep for
+            revalidation. If this is ``0`` every ``get_user`` gets the
+            details in full.
+        :type max_records: int
+        :param clock: A function which returns the current time in seconds
+            since the epoch.
+        """
+        self.client = client
+        # Records never expire as they are always checked with the storage
+        # service before use.
+        self.records = UserCache(max_entries=max_records, ttl=float('inf'))
+        self._clock = clock
+        # ``X-Primary-Until`` header values keyed by email address.
+        self._primary_until = {}
+        self._lock = threading.Lock()
+
+    def _pin(self, emails, response):
+        """
+        Send reads of the users with the given ``emails`` to the primary
+        database for as long as ``response`` says, and forget pins which have
+        expired.
+        """
+        value = response.headers.get(PRIMARY_UNTIL_HEADER)
+        now = self._clock()
+        with self._lock:
+            for email, until in list(self._primary_until.items()):
+                if float(until) <= now:
+                    del self._primary_until[email]
+            if value is not None:
+                for email in emails:
+                    self._primary_until[email] = value
+
+    def _pin_headers(self, email):
+        """
+        :return: The headers to send with a read of the user with the given
+            ``email``.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            value = self._primary_until.get(email)
+        if value is None or float(value) <= self._clock():
+            return {}
+        return {PRIMARY_UNTIL_HEADER: value}
+
+    def _remember(self, email, response, details):
+        """
+        Keep ``details`` to revalidate with the ``ETag`` of ``response``, or
+        forget any kept details if there are none.
+        """
+        etag = response.headers.get('ETag')
+        if details is None or etag is None:
+            self.records.invalidate(email)
+        else:
+            self.records.store(email, (etag, details))
+
+    def _user_details(self, response):
+        """
+        :return: The user details in a response from the storage service, or
+            ``None`` if the response says that there is no such user.
+        :raises requests.exceptions.HTTPError: The storage service gave an
+            unexpected error.
+        """
+        if response.status_code == codes.NOT_FOUND:
+            return None
+        response.raise_for_status()
+        details = json.loads(response.text)
+        return {
+            'email': details['email'],
+            'password_hash': details['password_hash'],
+        }
+
+    def get_user(self, email):
+        found, record = self.records.lookup(email)
+        headers = self._pin_headers(email)
+        if found:
+            headers['If-None-Match'] = record[0]
+        response = self.client.get(
+            'users/{email}'.format(email=email), headers=headers)
+        if found and response.status_code == codes.NOT_MODIFIED:
+            return dict(record[1])
+        details = self._user_details(response)
+        self._remember(email, response, details)
+        return details
+
+    def get_user_by_token_fingerprint(self, fingerprint):
+        response = self.client.get(
+            'tokens/{fingerprint}'.format(fingerprint=fingerprint))
+        return self._user_details(response)
+
+    def get_users(self, emails):
+        response = self.client.post(
+            '/users/lookup', data=json.dumps({'emails': emails}))
+        response.raise_for_status()
+        result = json.loads(response.text)
+        users = [
+            {'email': user['email'], 'password_hash': user['password_hash']}
+            for user in result['users']]
+        return users, result['missing']
+
+    def get_users_page(self, after, limit):
+        params = {'limit': limit}
+        if after is not None:
+            params['after'] = after
+        response = self.client.get('/users', params=params)
+        response.raise_for_status()
+        page = json.loads(response.text)
+        users = [
+            {'email': user['email'], 'password_hash': user['password_hash']}
+            for user in page['users']]
+        return users, page['next'], page['total']
+
+    def get_new_users(self, since, after, limit):
+        params = {'limit': limit}
+        if since is not None:
+            params['created_since'] = repr(since)
+        if after is not None:
+            params['after'] = after
+        response = self.client.get('/users', params=params)
+        response.raise_for_status()
+        page = json.loads(response.text)
+        users = [
+            {'email': user['email'], 'password_hash': user['password_hash']}
+            for user in page['users']]
+        return users, page['next'], page['as_of']
+
+    def create_user(self, email, password_hash):
+        data = {'email': email, 'password_hash': password_hash}
+        response = self.client.post('/users', data=json.dumps(data))
+        self.records.invalidate(email)
+        self._pin([email], response)
+        if response.status_code == codes.CONFLICT:
+            return False
+        response.raise_for_status()
+        return True
+
+    def create_users(self, users):
+        response = self.client.post(
+            '/users/batch', data=json.dumps({'users': users}))
+        response.raise_for_status()
+        result = json.loads(response.text)
+        self._pin(result['created'], response)
+        return result['created'], result['conflicts']
+
+    def update_user(self, email, password_hash):
+        response = self.client.patch(
+            '/users/{email}'.format(email=email),
+            data=json.dumps({'password_hash': password_hash}))
+        self._pin([email], response)
+        details = self._user_details(response)
+        self._remember(email, response, details)
+        return details
+
+    def record_logins(self, logins):
+        response = self.client.post(
+            '/users/activity', data=json.dumps({'logins': logins}))
+        response.raise_for_status()
+        return json.loads(response.text)['updated']
+
+    def delete_user(self, email):
+        response = self.client.delete('/users/{email}'.format(email=email))
+        self.records.invalidate(email)
+        self._pin([email], response)
+        return self._user_details(response)
+
+
+class InProcessStorageBackend(StorageBackend):
+    """
+    Reach user data directly through the storage service's database models,
+    for when both services run in the same process. This avoids encoding
+    requests as JSON and sending them over the network.
+    """
+
+    def __init__(self):
+        # This is imported here so that the storage service's database is
+        # only set up when this backend is used.
+        from storage import storage
+        self.storage = storage
+
+    def _user_details(self, user):
+        if user is None:
+            return None
+        return {'email': user.email, 'password_hash': user.password_hash}
+
+    @contextmanager
+    def _user_shard(self, email):
+        """
+        Send queries made within this block to the shard of the user with
+        the given ``email``.
+        """
+        storage = self.storage
+        with storage.app.app_context():
+            with storage.using_shard(storage.shard_for(email)):
+                yield
+
+    def get_user(self, email):
+        with self._user_shard(email):
+            return self._user_details(self.storage.load_user_from_id(email))
+
+    def get_user_by_token_fingerprint(self, fingerprint):
+        with self.storage.app.app_context():
+            return self._user_details(
+                self.storage.load_user_from_token_fingerprint(fingerprint))
+
+    def get_users(self, emails):
+        with self.storage.app.app_context():
+            users, missing = self.storage.load_users(emails=emails)
+            return [self._user_details(user) for user in users], missing
+
+    def get_users_page(self, after, limit):
+        with self.storage.app.app_context():
+            users, next_after, total = self.storage.get_users_page(
+                limit=limit, after=after)
+            page = [self._user_details(user) for user in users]
+            return page, next_after, total
+
+    def get_new_users(self, since, after, limit):
+        with self.storage.app.app_context():
+            as_of = time.time()
+            users, next_after, _ = self.storage.get_users_page(
+                limit=limit, after=after, created_since=since)
+            page = [self._user_details(user) for user in users]
+            return page, next_after, as_of
+
+    def create_user(self, email, password_hash):
+        storage = self.storage
+        with self._user_shard(email):
+            storage.db.session.add(
+                storage.User(email=email, password_hash=password_hash))
+            try:
+                storage.db.session.commit()
+            except IntegrityError:
+                storage.db.session.rollback()
+                return False
+            return True
+
+    def create_users(self, users):
+        with self.storage.app.app_context():
+            return self.storage.create_users(records=users)
+
+    def update_user(self, email, password_hash):
+        storage = self.storage
+        with self._user_shard(email):
+            user = storage.load_user_from_id(email)
+            if user is None:
+                return None
+            user.password_hash = password_hash
+            storage.db.session.commit()
+            return self._user_details(user)
+
+    def record_logins(self, logins):
+        with self.storage.app.app_context():
+            return self.storage.record_logins(logins=logins)
+
+    def delete_user(self, email):
+        storage = self.storage
+        with self._user_shard(email):
+            user = storage.load_user_from_id(email)
+            if user is None:
+                return None
+            details = self._user_details(user)
+            if not storage.delete_user(email=email):
+                return None
+            return details
+
+
+class TimedStorageBackend(object):
+    """
+    Time every call to another backend.
+    """
+
+    def __init__(self, backend, histogram):
+        """
+        :param backend: The backend to time calls to.
+        :type backend: ``StorageBackend``
+        :param histogram: A histogram with an ``operation`` label, which is
+            given the name of each method called.
+        :type histogram: ``instrumentation.metrics.Histogram``
+        """
+        self.backend = backend
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        return self.histogram.timed(
+            getattr(self.backend, name), operation=name)
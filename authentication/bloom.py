@@ -0,0 +1,421 @@
+"""
+Approximate sets of email addresses, for answering that a user does not exist
+without asking the storage service.
+"""
+
+import ctypes
+import hashlib
+import math
+import multiprocessing
+import threading
+import time
+
+
+class BloomFilter(object):
+    """
+    A set which can say that an item is definitely not in it, or that it
+    probably is. Items cannot be removed.
+    """
+
+    def __init__(self, capacity, error_rate, shared=False):
+        """
+        :param capacity: The number of items to size the filter for.
+        :type capacity: int
+        :param error_rate: The chance that an item which was not added is
+            reported as present, once ``capacity`` items have been added.
+        :type error_rate: float
+        :param shared: Whether to keep the filter in shared memory, so that
+            processes forked after it is made all see the items any of them
+            add.
+        :type shared: bool
+        """
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(
+            int(round(self.size / float(capacity) * math.log(2))), 1)
+        length = (self.size + 7) // 8
+        if shared:
+            self._bits = multiprocessing.RawArray(ctypes.c_ubyte, length)
+            self._count = multiprocessing.RawValue(ctypes.c_longlong, 0)
+            self._lock = multiprocessing.Lock()
+        else:
+            self._bits = (ctypes.c_ubyte * length)()
+            self._count = ctypes.c_longlong(0)
+            self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        """
+        The number of items added.
+        """
+        return self._count.value
+
+    def _positions(self, item):
+        # Two halves of one digest are combined to make all the positions.
+        # See Kirsch and Mitzenmacher, "Less Hashing, Same Performance".
+        digest = hashlib.sha256(item.encode('utf8')).digest()
+        first = int(hashlib.sha256(digest[:16]).hexdigest()[:16], 16)
+        second = int(hashlib.sha256(digest[16:]).hexdigest()[:16], 16) | 1
+        return [(first + index * second) % self.size
+                for index in range(self.hashes)]
+
+    def add(self, item):
+        """
+        :param item: An item to add.
+        :type item: string
+        """
+        positions = self._positions(item)
+        # Setting a bit reads and writes a whole byte, so adds must not
+        # interleave or one could undo another.
+        with self._lock:
+            for position in positions:
+                self._bits[position // 8] |= 1 << (position % 8)
+            self._count.value += 1
+
+    def clear(self):
+        """
+        Remove all items.
+        """
+        with self._lock:
+            ctypes.memset(self._bits, 0, len(self._bits))
+            self._count.value = 0
+
+    def __contains__(self, item):
+        return all(
+            self._bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(item))
+
+    def memory_bytes(self):
+        """
+        :return: The number of bytes used for the filter's bits.
+        :rtype: int
+        """
+        return len(self._bits)
+
+    def false_positive_rate(self):
+        """
+        :return: The expected chance that an item which was not added is
+            reported as present, given the number of items added so far.
+        :rtype: float
+        """
+        return (1 - math.exp(
+            -self.hashes * self.count / float(self.size))) ** self.hashes
+
+
+class UserFilter(object):
+    """
+    A ``BloomFilter`` of the email addresses of all users, which is built
+    from the storage service a page at a time, kept up to date with users
+    added since and rebuilt periodically.
+
+    Two filters are kept: one in use and a spare which the next build fills
+    before they are swapped. With ``shared`` both are kept in shared memory,
+    so that worker processes forked after the ``UserFilter`` is made share
+    them. Then a user added through any worker might exist in all of them
+    straight away, and only one worker builds or syncs at a time.
+
+    Users added through ``add`` are in the filter straight away. Users
+    added to the storage service in any other way, for example by another
+    instance of the authentication service or by importing a snapshot, are
+    added every ``sync_interval`` seconds. So while the filter is ``ready``,
+    ``might_exist`` returning ``False`` means that the user does not exist,
+    unless they were added in the last ``sync_interval`` seconds or so. If
+    the filter has not been brought up to date for ``max_lag`` seconds, for
+    example because the storage service cannot be reached, it is not
+    ``ready`` and rules out nobody until it is.
+
+    Deleted users stay in the filter until it is rebuilt, as do users added
+    to the storage service's database other than through the storage
+    service, which do not have the time at which they were added.
+    """
+
+    def __init__(self, backend, capacity, error_rate, page_size,
+                 rebuild_interval, sync_interval=1, sync_overlap=10,
+                 max_lag=30, shared=False):
+        """
+        :param backend: Where to get the users from.
+        :type backend: ``authentication.backends.StorageBackend``
+        :param capacity: The number of users to size the filter for. The
+            error rate rises once there are more.
+        :type capacity: int
+        :param error_rate: The chance that an email address which is not in
+            use is reported as possibly in use.
+        :type error_rate: float
+        :param page_size: The number of users to get at a time.
+        :type page_size: int
+        :param rebuild_interval: The number of seconds between builds.
+        :type rebuild_interval: float
+        :param sync_interval: The number of seconds between adding users
+            added to the storage service since the last build or sync.
+        :type sync_interval: float
+        :param sync_overlap: The number of seconds before the last sync from
+            which the next one reads users. Users can be read some time after
+            they are added, and storage service processes' clocks may
+            differ, so syncs overlap by this much.
+        :type sync_overlap: float
+        :param max_lag: The number of seconds after the last build or sync
+            after which the filter rules out nobody.
+        :type max_lag: float
+        :param shared: Whether to share the filter with processes forked
+            after it is made.
+        :type shared: bool
+        """
+        self.backend = backend
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.rebuild_interval = rebuild_interval
+        self.sync_interval = sync_interval
+        self.sync_overlap = sync_overlap
+        self.max_lag = max_lag
+        self.enabled = capacity > 0
+        self._filters = [
+            BloomFilter(capacity=capacity, error_rate=error_rate,
+                        shared=shared)
+            for _ in range(2)] if self.enabled else []
+        if shared:
+            self._lock = multiprocessing.Lock()
+            value = multiprocessing.RawValue
+        else:
+            self._lock = threading.Lock()
+
+            def value(typecode, initial):
+                return typecode(initial)
+        # The index of the filter in use, or -1 before the first build.
+        self._active = value(ctypes.c_int, -1)
+        # When the last build finished, and when the build in progress, if
+        # any, started.
+        self._built_at = value(ctypes.c_double, 0)
+        self._building = value(ctypes.c_double, 0)
+        # Incremented by each build, so that a build which was taken over
+        # does not replace the filter in use.
+        self._generation = value(ctypes.c_long, 0)
+        # The time by the storage service's clock from which the next sync
+        # reads users, or 0 before the first build. When the filter was last
+        # brought up to date by a build or a sync, and when the sync in
+        # progress, if any, started.
+        self._synced_to = value(ctypes.c_double, 0)
+        self._synced_at = value(ctypes.c_double, 0)
+        self._syncing = value(ctypes.c_double, 0)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _current(self):
+        """
+        :return: The index of the filter in use, or -1 if the filter has not
+            been built or has not been brought up to date for ``max_lag``
+            seconds.
+        :rtype: int
+        """
+        if time.time() - self._synced_at.value > self.max_lag:
+            return -1
+        return self._active.value
+
+    @property
+    def ready(self):
+        """
+        Whether the filter has been built and recently brought up to date.
+        """
+        return self._current() >= 0
+
+    def might_exist(self, email):
+        """
+        :param email: An email address.
+        :type email: string
+        :return: ``False`` if there was no user with the given ``email``
+            when the filter was last built or synced and none has been added
+            since. ``True`` if there might be one, or if the filter is not
+            ``ready``.
+        :rtype: bool
+        """
+        active = self._current()
+        return active < 0 or email in self._filters[active]
+
+    def add(self, email):
+        """
+        Record that there is a user with the given ``email``.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            active = self._active.value
+            if active >= 0:
+                self._filters[active].add(email)
+            if self._building.value:
+                # The user may be behind the page being read by the build.
+                self._filters[(active + 1) % 2].add(email)
+
+    def build(self):
+        """
+        Build a new filter from every user in the storage service and then
+        use it in place of the current one.
+
+        A build which another process started less than
+        ``rebuild_interval`` seconds ago is left to finish, rather than two
+        processes filling the same spare filter. An older one is assumed to
+        have died and is taken over.
+
+        :return: Whether the filter was built.
+        :rtype: bool
+        :raises Exception: The users could not be read, for example because
+            the storage service could not be reached. The current filter is
+            kept.
+        """
+        with self._lock:
+            now = time.time()
+            building = self._building.value
+            if building and now - building < self.rebuild_interval:
+                return False
+            self._generation.value += 1
+            generation = self._generation.value
+            self._building.value = now
+            spare = self._filters[(self._active.value + 1) % 2]
+            spare.clear()
+        try:
+            after = None
+            as_of = None
+            while True:
+                users, after, page_as_of = self.backend.get_new_users(
+                    since=None, after=after, limit=self.page_size)
+                if as_of is None:
+                    as_of = page_as_of
+                if self._generation.value != generation:
+                    # Another build has taken over the spare filter.
+                    return False
+                for user in users:
+                    spare.add(user['email'])
+                if after is None:
+                    break
+            with self._lock:
+                if self._generation.value != generation:
+                    return False
+                self._active.value = (self._active.value + 1) % 2
+                self._built_at.value = time.time()
+                # Users added since a little before the first page was read
+                # are read again by the next sync.
+                self._synced_to.value = max(
+                    self._synced_to.value, as_of - self.sync_overlap)
+                self._synced_at.value = max(self._synced_at.value, now)
+                return True
+        finally:
+            with self._lock:
+                if self._generation.value == generation:
+                    self._building.value = 0
+
+    def sync(self):
+        """
+        Add the users added to the storage service since the last build or
+        sync, from a little before it to allow for users which could not be
+        read yet.
+
+        A sync which another process started less than ``max_lag`` seconds
+        ago is left to finish. An older one is assumed to have died.
+
+        :return: Whether users were read.
+        :rtype: bool
+        :raises Exception: The users could not be read, for example because
+            the storage service could not be reached. The next sync reads
+            them.
+        """
+        with self._lock:
+            now = time.time()
+            since = self._synced_to.value
+            syncing = self._syncing.value
+            if not since or (syncing and now - syncing < self.max_lag):
+                return False
+            self._syncing.value = now
+        try:
+            after = None
+            as_of = None
+            while True:
+                users, after, page_as_of = self.backend.get_new_users(
+                    since=since, after=after, limit=self.page_size)
+                if as_of is None:
+                    as_of = page_as_of
+                for user in users:
+                    self.add(user['email'])
+                if after is None:
+                    break
+            with self._lock:
+                self._synced_to.value = max(
+                    self._synced_to.value, as_of - self.sync_overlap)
+                self._synced_at.value = max(self._synced_at.value, now)
+                return True
+        finally:
+            with self._lock:
+                if self._syncing.value == now:
+                    self._syncing.value = 0
+
+    def start(self):
+        """
+        Build the filter, and rebuild it every ``rebuild_interval`` seconds,
+        in a background thread, and sync it every ``sync_interval`` seconds
+        in another. Each process which shares the filter runs its own
+        threads, but a process skips a rebuild or a sync if another has done
+        one recently.
+        """
+        if not self.enabled or self._threads:
+            return
+        self._stop.clear()
+        for target in (self._run, self._run_sync):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop rebuilding and syncing the filter.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            started = time.time()
+            if started - self._built_at.value >= self.rebuild_interval:
+                try:
+                    self.build()
+                except Exception:
+                    # Whatever went wrong, for example the storage service
+                    # being unreachable or a database error in process, the
+                    # current filter, if any, is kept until the next build.
+                    pass
+            next_build = max(self._built_at.value, started) + \
+                self.rebuild_interval
+            if self._stop.wait(max(next_build - time.time(), 0)):
+                return
+
+    def _run_sync(self):
+        while not self._stop.wait(self.sync_interval):
+            if time.time() - self._synced_at.value < self.sync_interval:
+                # Another process has synced the shared filter.
+                continue
+            try:
+                self.sync()
+            except Exception:
+                # The users are read by the next sync, and until then the
+                # filter stops ruling out users once it lags too far.
+                pass
+
+    def stats(self):
+        """
+        :return: The number of ``entries`` in the filter, the ``bytes`` used
+            by it and the spare filter, and its expected
+            ``false_positive_rate``. These are all 0 if the filter has not
+            been built.
+        :rtype: ``dict``
+        """
+        active = self._active.value
+        if active < 0:
+            return {'entries': 0, 'bytes': 0, 'false_positive_rate': 0.0}
+        bloom = self._filters[active]
+        return {
+            'entries': bloom.count,
+            'bytes': sum(
+                each.memory_bytes() for each in self._filters),
+            'false_positive_rate': bloom.false_positive_rate(),
+        }
@@ -0,0 +1,111 @@
+"""
+A bounded in-process cache for users loaded from the storage service.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class UserCache(object):
+    """
+    A thread safe least-recently-used cache whose entries expire.
+
+    Both users and the absence of users (``None``) can be cached. Entries
+    are not shared between processes, so a change made through another
+    process is only seen here once the entry has expired.
+    """
+
+    def __init__(self, max_entries, ttl, clock=time.time):
+        """
+        :param max_entries: The maximum number of entries to keep. If this is
+            ``0`` the cache is disabled.
+        :type max_entries: int
+        :param ttl: The number of seconds for which an entry is valid.
+        :type ttl: float
+        :param clock: A function which returns the current time in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        """
+        Whether anything can be stored in the cache.
+        """
+        return self.max_entries > 0
+
+    def lookup(self, key):
+        """
+        :param key: The key to look up.
+        :return: A tuple of whether an unexpired entry was found for ``key``,
+            and the cached value if one was.
+        :rtype: ``tuple``
+        """
+        if not self.enabled:
+            return False, None
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._clock():
+                self.misses += 1
+                return False, None
+            # Re-inserting an entry marks it as the most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def store(self, key, value):
+        """
+        Cache ``value`` for ``key``, evicting the least recently used entry
+        if the cache is full.
+
+        :param key: The key to store the value under.
+        :param value: The value to cache. This may be ``None``.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (self._clock() + self.ttl, value)
+
+    def invalidate(self, key):
+        """
+        Remove any entry for ``key``.
+
+        :param key: The key to remove.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: The size of the cache and counts of cache hits, misses and
+            evictions.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,121 @@
+"""
+Choose the bcrypt work factor.
+
+Each step up in the work factor doubles the time taken to hash or check a
+password. Run this module to see how many logins per second one core can
+check at each work factor on this host::
+
+    python -m authentication.cost --min-rounds 10 --max-rounds 14 --target 0.1
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import bcrypt
+
+# The work factors which bcrypt accepts.
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def hash_rounds(password_hash):
+    """
+    :param password_hash: A bcrypt hash, such as ``$2b$12$...``.
+    :type password_hash: string
+    :return: The work factor which ``password_hash`` was made with, or
+        ``None`` if it is not a bcrypt hash.
+    :rtype: int or ``None``
+    """
+    parts = password_hash.split('$')
+    if len(parts) < 4:
+        return None
+    try:
+        return int(parts[2])
+    except ValueError:
+        return None
+
+
+def check_seconds(rounds, samples=3):
+    """
+    :param rounds: A bcrypt work factor.
+    :type rounds: int
+    :param samples: The number of times to check a password.
+    :type samples: int
+    :return: The fewest seconds taken to check a password against a hash
+        with the work factor ``rounds``, on one core of this host.
+    :rtype: float
+    """
+    password = b'password'
+    password_hash = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    timings = []
+    for _ in range(samples):
+        started = time.time()
+        bcrypt.hashpw(password, password_hash)
+        timings.append(time.time() - started)
+    return min(timings)
+
+
+def calibrate_rounds(target_seconds, min_rounds=MIN_ROUNDS,
+                     max_rounds=MAX_ROUNDS, measure=check_seconds):
+    """
+    Find the highest work factor with which checking a password takes no
+    longer than ``target_seconds``.
+
+    Work factors are measured from ``min_rounds`` upwards, stopping at the
+    first which is too slow, so this takes about twice ``target_seconds``
+    for each sample.
+
+    :param target_seconds: The longest that checking a password should take.
+    :type target_seconds: float
+    :param min_rounds: The work factor to use even if it is too slow.
+    :type min_rounds: int
+    :param max_rounds: The highest work factor to consider.
+    :type max_rounds: int
+    :param measure: A function which takes a work factor and returns the
+        seconds taken to check a password with it.
+    :return: A work factor.
+    :rtype: int
+    """
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        if measure(rounds) > target_seconds:
+            break
+        chosen = rounds
+    return chosen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--min-rounds', type=int, default=10)
+    parser.add_argument('--max-rounds', type=int, default=14)
+    parser.add_argument('--samples', type=int, default=3)
+    parser.add_argument('--target', type=float,
+                        help='Seconds which checking a password should take. '
+                        'If this is given, the work factor which '
+                        'BCRYPT_TARGET_SECONDS would choose is shown.')
+    args = parser.parse_args()
+
+    print('{rounds:>6} {ms:>10} {rate:>18}'.format(
+        rounds='rounds', ms='ms/check', rate='logins/s per core'))
+    timings = {}
+    for rounds in range(args.min_rounds, args.max_rounds + 1):
+        seconds = timings[rounds] = check_seconds(
+            rounds=rounds, samples=args.samples)
+        print('{rounds:>6} {ms:>10.1f} {rate:>18.1f}'.format(
+            rounds=rounds, ms=seconds * 1000, rate=1 / seconds))
+
+    if args.target is not None:
+        chosen = calibrate_rounds(
+            target_seconds=args.target,
+            min_rounds=args.min_rounds,
+            max_rounds=args.max_rounds,
+            measure=timings.get,
+        )
+        print('BCRYPT_TARGET_SECONDS={target} chooses {rounds} rounds'.format(
+            target=args.target, rounds=chosen))
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
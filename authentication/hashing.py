@@ -0,0 +1,117 @@
+"""
+A bounded pool of workers for slow password hashing.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class PoolFull(Exception):
+    """
+    Raised when work is given to a ``HashingPool`` which has no space for it.
+    """
+
+
+def pool_size(cpus, processes, threads):
+    """
+    Choose the size of the ``HashingPool`` of each of several processes.
+
+    The cores are shared between the processes rather than each process
+    using them all, which would run many times as many hashes at once as
+    there are cores. Fewer tasks may run and wait in a process than it has
+    request threads, so that a process with a full pool refuses hashing
+    while it still has a thread to do so, rather than every thread waiting
+    for the pool. So a process has at most one worker fewer than it has
+    threads, even if that leaves it fewer workers than its share of the
+    cores, except that a process with one thread has one worker.
+
+    :param cpus: The number of CPU cores.
+    :type cpus: int
+    :param processes: The number of processes, each with its own pool.
+    :type processes: int
+    :param threads: The number of threads which serve requests in each
+        process.
+    :type threads: int
+    :return: A tuple of the number of ``workers`` and the ``queue_depth``.
+    :rtype: ``tuple``
+    """
+    workers = max(1, min(cpus // processes, threads - 1))
+    return workers, max(threads - workers - 1, 0)
+
+
+class HashingPool(object):
+    """
+    Run password hashing and verification on a fixed number of threads.
+
+    bcrypt releases the GIL while it works, so threads can hash in parallel.
+    At most ``workers`` tasks run at once and at most ``queue_depth`` more
+    wait for a worker. Work beyond that is refused with ``PoolFull`` rather
+    than queued, so a burst of logins ties up a bounded number of request
+    threads and the rest remain free for other routes.
+    """
+
+    def __init__(self, workers, queue_depth):
+        """
+        :param workers: The maximum number of tasks to run at once.
+        :type workers: int
+        :param queue_depth: The maximum number of tasks to wait for a worker.
+        :type queue_depth: int
+        """
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedule ``function(*args, **kwargs)`` to run on a worker.
+
+        :raises PoolFull: There are already as many tasks running and
+            waiting as the pool allows.
+        :return: A future for the result of the call.
+        :rtype: ``concurrent.futures.Future``
+        """
+        if not self._slots.acquire(False):
+            raise PoolFull()
+
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, function, *args, **kwargs):
+        """
+        Run ``function(*args, **kwargs)`` on a worker and wait for it to
+        finish. See ``submit``.
+
+        :return: The result of the call.
+        """
+        return self.submit(function, *args, **kwargs).result()
+
+    def map(self, function, iterable):
+        """
+        Run ``function`` on each item of ``iterable`` in parallel, with at
+        most ``workers`` of these calls scheduled at once so that one caller
+        does not fill the queue. See ``submit``.
+
+        :return: An iterator of the results, in the order of ``iterable``.
+        """
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= self.workers:
+                yield pending.popleft().result()
+            pending.append(self.submit(function, item))
+
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self):
+        """
+        Stop the workers once all scheduled tasks are complete.
+        """
+        self._executor.shutdown(wait=True)
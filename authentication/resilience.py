@@ -0,0 +1,326 @@
+"""
+Protection for the authentication service against a slow or failing storage
+service.
+
+A bulkhead caps the number of calls to the storage service in flight, a
+circuit breaker refuses calls for a while after repeated failures, and reads
+can be hedged by sending a duplicate when the first is slower than most.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+# Backend methods which only read, and so can safely be sent twice.
+READ_OPERATIONS = frozenset([
+    'get_user',
+    'get_user_by_token_fingerprint',
+    'get_users',
+    'get_users_page',
+    'get_new_users',
+])
+
+
+class CircuitOpen(RequestException):
+    """
+    Raised instead of calling the storage service while the circuit breaker
+    is open.
+    """
+
+
+class BulkheadFull(RequestException):
+    """
+    Raised instead of calling the storage service when as many calls as are
+    allowed are already in flight.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Track failures of calls to a dependency, and refuse calls for a while
+    once there have been too many in a row.
+
+    The breaker is ``closed`` while calls succeed. After
+    ``failure_threshold`` consecutive failures it is ``open`` and calls are
+    refused for ``reset_timeout`` seconds. It is then ``half_open`` and one
+    trial call is allowed. If that succeeds the breaker is closed again, and
+    otherwise it is opened again.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.time):
+        """
+        :param failure_threshold: The number of consecutive failures after
+            which to open the breaker. If this is ``0`` the breaker is never
+            opened.
+        :type failure_threshold: int
+        :param reset_timeout: The number of seconds for which to refuse
+            calls once the breaker is open.
+        :type reset_timeout: float
+        :param clock: A function which returns the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        """
+        ``'closed'``, ``'open'`` or ``'half_open'``.
+        """
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if self._clock() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """
+        :return: Whether a call may be made now. If this is the trial call of
+            a half open breaker, no other call is allowed until its result
+            is recorded.
+        :rtype: bool
+        """
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'open' or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        """
+        Record that an allowed call succeeded.
+        """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """
+        Record that an allowed call failed.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or (
+                    self.failure_threshold and
+                    self._failures >= self.failure_threshold):
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+
+class LatencyWindow(object):
+    """
+    The most recent latencies of some calls, for estimating percentiles.
+    """
+
+    def __init__(self, size=1000, min_samples=20):
+        """
+        :param size: The number of latencies to keep.
+        :type size: int
+        :param min_samples: The number of latencies needed for an estimate.
+        :type min_samples: int
+        """
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: The percentile to estimate, such as ``0.95``.
+        :type fraction: float
+        :return: The nearest-rank percentile of the kept latencies, or
+            ``None`` if there are fewer than ``min_samples``.
+        :rtype: float or ``None``
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < max(self.min_samples, 1):
+            return None
+        index = max(0, int(round(fraction * len(latencies))) - 1)
+        return latencies[index]
+
+
+class ResilientStorageBackend(object):
+    """
+    Call another backend through a bulkhead and a circuit breaker, and
+    optionally hedge reads.
+
+    A call which raises ``requests.exceptions.RequestException`` counts as a
+    failure. Refused calls raise ``CircuitOpen`` or ``BulkheadFull``, which
+    are also ``RequestException`` so that they are handled like the storage
+    service being unreachable.
+
+    When hedging, each read is made on a separate thread. If it has not
+    finished after the ``hedge_percentile`` of recent read latencies, and
+    there is space in the bulkhead, the same read is sent again and the
+    first result to arrive is used.
+    """
+
+    def __init__(self, backend, max_in_flight, breaker, hedging=False,
+                 hedge_percentile=0.95, min_hedge_delay=0.01,
+                 clock=time.time):
+        """
+        :param backend: The backend to call.
+        :type backend: ``authentication.backends.StorageBackend``
+        :param max_in_flight: The most calls to allow at once, including
+            hedged duplicates.
+        :type max_in_flight: int
+        :param breaker: The circuit breaker for the storage service.
+        :type breaker: ``CircuitBreaker``
+        :param hedging: Whether to hedge reads.
+        :type hedging: bool
+        :param hedge_percentile: The percentile of read latencies after
+            which to send a duplicate read.
+        :type hedge_percentile: float
+        :param min_hedge_delay: The least number of seconds to wait before
+            sending a duplicate read.
+        :type min_hedge_delay: float
+        :param clock: A function which returns the current time in seconds.
+        """
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.breaker = breaker
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.latencies = LatencyWindow()
+        self._clock = clock
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._counts = {
+            'in_flight': 0,
+            'rejected_circuit_open': 0,
+            'rejected_bulkhead_full': 0,
+            'failures': 0,
+            'hedges_sent': 0,
+            'hedges_won': 0,
+        }
+        self._executor = None
+        if hedging:
+            # A read and its duplicate each take a thread.
+            self._executor = ThreadPoolExecutor(max_workers=2 * max_in_flight)
+
+    def _count(self, name, difference=1):
+        with self._lock:
+            self._counts[name] += difference
+
+    def _enter(self):
+        """
+        Take a place in the bulkhead and check the circuit breaker.
+
+        :raises CircuitOpen: The circuit breaker is open.
+        :raises BulkheadFull: There is no space in the bulkhead.
+        """
+        if not self._slots.acquire(False):
+            self._count('rejected_bulkhead_full')
+            raise BulkheadFull('Too many requests to the storage service are '
+                               'in flight.')
+        if not self.breaker.allow():
+            self._slots.release()
+            self._count('rejected_circuit_open')
+            raise CircuitOpen('The storage service has failed repeatedly and '
+                              'is not being called.')
+        self._count('in_flight')
+
+    def _call(self, name, function, *args, **kwargs):
+        """
+        Call ``function``, which has already been allowed by ``_enter``, and
+        record how it went.
+        """
+        started = self._clock()
+        try:
+            result = function(*args, **kwargs)
+        except RequestException:
+            self._count('failures')
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # The storage service was reached, so this is not its failure.
+            self.breaker.record_success()
+            raise
+        finally:
+            self._count('in_flight', -1)
+            self._slots.release()
+        self.breaker.record_success()
+        if name in READ_OPERATIONS:
+            self.latencies.observe(self._clock() - started)
+        return result
+
+    def hedge_delay(self):
+        """
+        :return: The number of seconds after which to send a duplicate read.
+        :rtype: float
+        """
+        percentile = self.latencies.percentile(self.hedge_percentile)
+        return max(percentile or 0, self.min_hedge_delay)
+
+    def _hedged(self, name, function, *args, **kwargs):
+        self._enter()
+        first = self._executor.submit(
+            self._call, name, function, *args, **kwargs)
+        done, _ = wait([first], timeout=self.hedge_delay())
+        if done:
+            return first.result()
+
+        try:
+            self._enter()
+        except RequestException:
+            # No duplicate is sent if it would not be allowed.
+            return first.result()
+        self._count('hedges_sent')
+        second = self._executor.submit(
+            self._call, name, function, *args, **kwargs)
+
+        pending = set([first, second])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count('hedges_won')
+                    return future.result()
+        # Both reads failed.
+        return first.result()
+
+    def __getattr__(self, name):
+        function = getattr(self.backend, name)
+
+        if self.hedging and name in READ_OPERATIONS:
+            def call(*args, **kwargs):
+                return self._hedged(name, function, *args, **kwargs)
+        else:
+            def call(*args, **kwargs):
+                self._enter()
+                return self._call(name, function, *args, **kwargs)
+        return call
+
+    def stats(self):
+        """
+        :return: The ``state`` of the circuit breaker, the number of calls
+            ``in_flight``, and counts of calls rejected because the circuit
+            was open or the bulkhead was full, of calls which failed, of
+            duplicate reads sent and of those which finished first.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            stats = dict(self._counts)
+        stats['state'] = self.breaker.state
+        return stats
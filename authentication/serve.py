@@ -0,0 +1,46 @@
+"""
+Serve the authentication service in production, with a worker process for
+each share of the CPU cores. See ``instrumentation.serving``.
+
+Run with, for example::
+
+    python -m authentication.serve --bind 0.0.0.0:5000
+"""
+
+import argparse
+import os
+import tempfile
+
+from instrumentation.serving import serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--bind', default='0.0.0.0:5000')
+    parser.add_argument('--workers', type=int,
+                        help='Worker processes to run. By default this is '
+                        'WEB_CONCURRENCY or based on the number of cores.')
+    args = parser.parse_args()
+    if args.workers:
+        # The password hashing pool is sized for the number of workers when
+        # the application is imported.
+        os.environ['WEB_CONCURRENCY'] = str(args.workers)
+    # Workers share their metrics through a directory which is new for
+    # each run, unless one is given.
+    if 'METRICS_DIR' not in os.environ:
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(
+            prefix='authentication-metrics-')
+    elif not os.path.isdir(os.environ['METRICS_DIR']):
+        os.makedirs(os.environ['METRICS_DIR'])
+
+    from authentication.authentication import (
+        app,
+        finish_before_exit,
+        reset_after_fork,
+    )
+    serve(app=app, bind=args.bind, after_fork=reset_after_fork,
+          workers=args.workers, before_exit=finish_before_exit)
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
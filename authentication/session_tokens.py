@@ -0,0 +1,120 @@
+"""
+Signed session tokens which can be checked without the storage service.
+
+A token holds a user's email address, a short fingerprint of their password
+hash, when it expires and when the user was last checked against the storage
+service. It is signed but not encrypted, so its contents can be read by
+whoever holds it.
+"""
+
+import hashlib
+import time
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+SALT = 'session-token'
+
+
+def password_hash_fingerprint(password_hash):
+    """
+    :param password_hash: A user's password hash.
+    :type password_hash: string
+    :return: A short digest of ``password_hash``, which changes when the
+        password hash changes.
+    :rtype: string
+    """
+    return hashlib.sha256(password_hash.encode('utf8')).hexdigest()[:16]
+
+
+class SessionTokens(object):
+    """
+    Issue and verify session tokens.
+
+    Tokens are signed with the first of ``secret_keys`` and are accepted if
+    they are signed with any of them. To rotate keys, put the new key first
+    and keep the old key until tokens signed with it have expired.
+    """
+
+    def __init__(self, secret_keys, max_age, revalidate_after,
+                 clock=time.time):
+        """
+        :param secret_keys: Keys to verify tokens with, the first of which is
+            also used to sign tokens.
+        :type secret_keys: list of strings
+        :param max_age: The number of seconds for which a token is valid.
+        :type max_age: float
+        :param revalidate_after: The number of seconds after which a token's
+            user should be checked against the storage service again.
+        :type revalidate_after: float
+        :param clock: A function which returns the current time in seconds.
+        """
+        self.max_age = max_age
+        self.revalidate_after = revalidate_after
+        self._clock = clock
+        self._serializers = [
+            URLSafeSerializer(secret_key, salt=SALT)
+            for secret_key in secret_keys]
+
+    def issue(self, email, password_hash):
+        """
+        :param email: The email address of the user.
+        :type email: string
+        :param password_hash: The current password hash of the user.
+        :type password_hash: string
+        :return: A new token for the user, which expires after ``max_age``
+            seconds.
+        :rtype: string
+        """
+        now = self._clock()
+        return self._dump({
+            'email': email,
+            'password': password_hash_fingerprint(password_hash),
+            'expires': now + self.max_age,
+            'checked': now,
+        })
+
+    def refresh(self, claims):
+        """
+        :param claims: The claims of a token whose user has just been checked
+            against the storage service.
+        :type claims: ``dict``
+        :return: A token with the same claims and expiry, marked as checked
+            now.
+        :rtype: string
+        """
+        claims = dict(claims, checked=self._clock())
+        return self._dump(claims)
+
+    def verify(self, token):
+        """
+        :param token: A token given by a client.
+        :type token: string
+        :return: The claims in ``token``, or ``None`` if it is not signed with
+            any of the keys or if it has expired. The claims are the
+            ``email``, the ``password`` hash fingerprint, the time that the
+            token ``expires`` and the time that the user was last
+            ``checked``.
+        :rtype: ``dict`` or ``None``
+        """
+        for serializer in self._serializers:
+            try:
+                claims = serializer.loads(token)
+            except BadSignature:
+                continue
+            if claims['expires'] <= self._clock():
+                return None
+            return claims
+        return None
+
+    def needs_revalidation(self, claims):
+        """
+        :param claims: The claims of a verified token.
+        :type claims: ``dict``
+        :return: Whether the token's user should be checked against the
+            storage service.
+        :rtype: bool
+        """
+        return claims['checked'] + self.revalidate_after <= self._clock()
+
+    def _dump(self, claims):
+        return self._serializers[0].dumps(claims)
@@ -0,0 +1,82 @@
+"""
+Sharing one call between concurrent callers who ask for the same thing.
+"""
+
+import threading
+
+
+class _Call(object):
+    """
+    A call in progress, which other callers can wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Make at most one call at a time for each key.
+
+    A caller who asks for a key while a call for it is in progress waits for
+    that call and is given its result, or its exception, rather than making
+    another call. Once the call has finished the next caller makes a new one,
+    so results are not cached.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        :param key: What is being asked for. Callers who give equal keys at
+            the same time share a call.
+        :param function: The function to call if there is no call for
+            ``key`` in progress. This is called with ``args`` and ``kwargs``.
+        :return: The result of the shared call.
+        :raises Exception: Whatever the shared call raised.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """
+        :return: The number of calls ``in_flight``, the number ``executed``
+            and the number of callers ``collapsed`` into another's call.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executed': self.executed,
+                'collapsed': self.collapsed,
+            }
@@ -0,0 +1,124 @@
+"""
+An HTTP client for the storage service.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# This is necessary because urljoin moved between Python 2 and Python 3
+from future.standard_library import install_aliases
+install_aliases()
+
+# Ignore this line with linters because it necessarily comes after
+# `install_aliases`.
+from urllib.parse import urljoin  # noqa
+
+# Requests with these methods are retried if the storage service fails to
+# respond.
+READ_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class StorageClient(object):
+    """
+    A client which keeps a pool of persistent connections to the storage
+    service.
+
+    One client is shared by every request and thread, so that connections
+    are reused rather than opened for each call to the storage service.
+    """
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=1.0,
+                 read_timeout=5.0, retries=2):
+        """
+        :param base_url: The URL of the storage service.
+        :type base_url: string
+        :param pool_size: The maximum number of connections to keep open to
+            the storage service.
+        :type pool_size: int
+        :param connect_timeout: The default number of seconds to wait for a
+            connection to the storage service.
+        :type connect_timeout: float
+        :param read_timeout: The default number of seconds to wait for the
+            storage service to respond once connected.
+        :type read_timeout: float
+        :param retries: The number of times to retry a ``GET`` request which
+            fails. Other requests are retried only if a connection could not
+            be made, as then they cannot have reached the storage service.
+        :type retries: int
+        """
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+
+        retry_options = {
+            'total': retries,
+            'connect': retries,
+            'read': retries,
+            'backoff_factor': 0.05,
+        }
+        try:
+            max_retries = Retry(
+                allowed_methods=READ_METHODS, **retry_options)
+        except TypeError:
+            # ``allowed_methods`` was called ``method_whitelist`` before
+            # urllib3 1.26.
+            max_retries = Retry(
+                method_whitelist=READ_METHODS, **retry_options)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=max_retries,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, **kwargs):
+        """
+        Make a request to the storage service.
+
+        :param method: An HTTP method, e.g. ``'GET'``.
+        :type method: string
+        :param path: The path to request, relative to the ``base_url``.
+        :type path: string
+        :param kwargs: Any other arguments to pass to ``requests``, such as a
+            ``timeout`` to use instead of the default.
+        :return: The response from the storage service.
+        :rtype: ``requests.Response``
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(
+            method=method,
+            url=urljoin(self.base_url, path),
+            **kwargs)
+
+    def get(self, path, **kwargs):
+        """
+        Make a ``GET`` request to the storage service. See ``request``.
+        """
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        """
+        Make a ``POST`` request to the storage service. See ``request``.
+        """
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        """
+        Make a ``PATCH`` request to the storage service. See ``request``.
+        """
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        """
+        Make a ``DELETE`` request to the storage service. See ``request``.
+        """
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        """
+        Close all pooled connections to the storage service.
+        """
+        self.session.close()
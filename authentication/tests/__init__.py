@@ -0,0 +1,5 @@
+import os
+
+# The storage service refuses to start without the secret key which it
+# shares with the authentication service.
+os.environ.setdefault('SECRET_KEY', 'secret')
@@ -0,0 +1,230 @@
+"""
+Tests for authentication.activity.
+"""
+
+import threading
+import time
+import unittest
+
+from requests.exceptions import ConnectionError
+
+from authentication.activity import LoginActivity
+
+
+class FakeClock(object):
+    """
+    A clock which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 100
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingStorageBackend(object):
+    """
+    A storage backend which keeps the batches of logins written to it, or
+    fails to write them.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+        self.error = None
+        self.written = threading.Event()
+
+    def record_logins(self, logins):
+        if self.fail:
+            raise ConnectionError()
+        if self.error is not None:
+            raise self.error
+        self.batches.append(logins)
+        self.written.set()
+        return len(logins)
+
+
+class LoginActivityTests(unittest.TestCase):
+    """
+    Tests for ``LoginActivity``.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = RecordingStorageBackend()
+
+    def activity(self, batch_size=10, max_pending=10, flush_interval=60):
+        return LoginActivity(
+            backend=self.backend,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_pending=max_pending,
+            clock=self.clock,
+        )
+
+    def test_logins_combined(self):
+        """
+        Logins of the same user are written as a count and the time of the
+        last one.
+        """
+        activity = self.activity()
+        activity.record(email='alice@example.com')
+        self.clock.now = 105
+        activity.record(email='bob@example.com')
+        self.clock.now = 110
+        activity.record(email='alice@example.com')
+        self.assertEqual(activity.flush(), 3)
+        self.assertEqual(self.backend.batches, [[
+            {'email': 'alice@example.com', 'count': 2, 'last_login': 110},
+            {'email': 'bob@example.com', 'count': 1, 'last_login': 105},
+        ]])
+        self.assertEqual(activity.stats()['pending'], 0)
+
+    def test_batches(self):
+        """
+        Logins are written ``batch_size`` users at a time.
+        """
+        activity = self.activity(batch_size=2)
+        for index in range(5):
+            activity.record(email='user{index}@example.com'.format(
+                index=index))
+        activity.flush()
+        self.assertEqual([len(batch) for batch in self.backend.batches],
+                         [2, 2, 1])
+        self.assertEqual(activity.stats()['batches'], 3)
+
+    def test_nothing_pending(self):
+        """
+        Nothing is written if there are no logins.
+        """
+        self.assertEqual(self.activity().flush(), 0)
+        self.assertEqual(self.backend.batches, [])
+
+    def test_dropped_when_full(self):
+        """
+        Logins of users beyond ``max_pending`` are dropped, but logins of
+        users who already have logins pending are kept.
+        """
+        activity = self.activity(max_pending=1)
+        self.assertTrue(activity.record(email='alice@example.com'))
+        self.assertFalse(activity.record(email='bob@example.com'))
+        self.assertTrue(activity.record(email='alice@example.com'))
+        stats = activity.stats()
+        self.assertEqual(stats['recorded'], 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['pending'], 1)
+
+    def test_disabled(self):
+        """
+        With ``max_pending`` of ``0`` logins are not recorded.
+        """
+        activity = self.activity(max_pending=0)
+        self.assertFalse(activity.record(email='alice@example.com'))
+        self.assertEqual(activity.stats()['dropped'], 0)
+
+    def test_failed_batch_kept(self):
+        """
+        Logins which fail to be written are combined with later ones and
+        written by a later flush.
+        """
+        activity = self.activity()
+        activity.record(email='alice@example.com')
+        self.backend.fail = True
+        self.assertEqual(activity.flush(), 0)
+        self.clock.now = 110
+        activity.record(email='alice@example.com')
+        self.backend.fail = False
+        self.assertEqual(activity.flush(), 2)
+        self.assertEqual(self.backend.batches, [[
+            {'email': 'alice@example.com', 'count': 2, 'last_login': 110},
+        ]])
+        self.assertEqual(activity.stats()['failures'], 1)
+
+    def test_batch_kept_after_other_error(self):
+        """
+        Logins which fail to be written because of an error other than a
+        request error, such as a database error from an in-process backend,
+        are kept for a later flush.
+        """
+        activity = self.activity()
+        activity.record(email='alice@example.com')
+        self.backend.error = RuntimeError('Database is locked.')
+        self.assertEqual(activity.flush(), 0)
+        self.assertEqual(activity.stats()['pending'], 1)
+        self.backend.error = None
+        self.assertEqual(activity.flush(), 1)
+        self.assertEqual(activity.stats()['failures'], 1)
+
+    def test_thread_survives_error(self):
+        """
+        The background thread keeps writing logins after a batch fails with
+        an error other than a request error.
+        """
+        self.backend.error = RuntimeError('Database is locked.')
+        activity = self.activity(flush_interval=0.01)
+        activity.start()
+        self.addCleanup(activity.stop)
+        activity.record(email='alice@example.com')
+        deadline = time.time() + 5
+        while not activity.stats()['failures'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertGreater(activity.stats()['failures'], 0)
+        self.backend.error = None
+        self.assertTrue(self.backend.written.wait(5))
+        self.assertEqual(self.backend.batches[0][0]['count'], 1)
+
+    def test_failed_batch_dropped_when_full(self):
+        """
+        Logins which fail to be written are dropped if other users' logins
+        have filled the space meanwhile.
+        """
+        activity = self.activity(max_pending=1)
+        self.backend.fail = True
+        activity.record(email='alice@example.com')
+        activity.record(email='alice@example.com')
+        original_record_logins = self.backend.record_logins
+
+        def record_logins(logins):
+            # Another user logs in while the batch is being written.
+            activity.record(email='bob@example.com')
+            return original_record_logins(logins)
+
+        self.backend.record_logins = record_logins
+        activity.flush()
+        stats = activity.stats()
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['pending'], 1)
+
+    def test_flushed_when_batch_full(self):
+        """
+        The background thread writes logins as soon as ``batch_size`` users
+        have logged in, without waiting for ``flush_interval``.
+        """
+        activity = self.activity(batch_size=2, flush_interval=60)
+        activity.start()
+        self.addCleanup(activity.stop)
+        activity.record(email='alice@example.com')
+        activity.record(email='bob@example.com')
+        self.assertTrue(self.backend.written.wait(5))
+        self.assertEqual(len(self.backend.batches[0]), 2)
+
+    def test_flushed_on_stop(self):
+        """
+        Stopping writes any pending logins.
+        """
+        activity = self.activity(flush_interval=60)
+        activity.start()
+        activity.record(email='alice@example.com')
+        activity.stop()
+        self.assertEqual(activity.stats()['written'], 1)
+
+    def test_stop_without_start(self):
+        """
+        Stopping writes any pending logins even if the background thread
+        was not started.
+        """
+        activity = self.activity()
+        activity.record(email='alice@example.com')
+        activity.stop()
+        self.assertEqual(activity.stats()['written'], 1)
@@ -3,23 +3,43 @@ Tests for authentication.authentication.
 """
 
 import json
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 from flask.ext.login import make_secure_token
 from requests import codes
+from requests.exceptions import ConnectionError
 import responses
 from werkzeug.http import parse_cookie
 
+from authentication import authentication
+from authentication.activity import LoginActivity
 from authentication.authentication import (
     app,
     bcrypt,
+    create_app,
     load_user_from_id,
     load_user_from_token,
     User,
     STORAGE_URL,
 )
 
+from authentication.backends import HTTPStorageBackend
+from authentication.bloom import UserFilter
+from authentication.cache import UserCache
+from authentication.cost import hash_rounds
+from authentication.hashing import HashingPool
+from authentication.resilience import CircuitBreaker, ResilientStorageBackend
+from authentication.session_tokens import SessionTokens
+from authentication.single_flight import SingleFlight
+from authentication.storage_client import StorageClient
+from authentication.tests.test_bloom import in_child_process
+from storage.storage import app as storage_app, db, dispose_engines
 from storage.tests.testtools import InMemoryStorageTests
 
 # This is necessary because urljoin moved between Python 2 and Python 3
@@ -53,10 +73,12 @@ class AuthenticationTests(InMemoryStorageTests):
             # We assume here that everything is in the style:
             # "{uri}/{method}/<{id}>" or "{uri}/{method}" when this is
             # not necessarily the case.
+            # Patterns are anchored so that, for example, "/users" does not
+            # also match "/users/batch".
             pattern = urljoin(
                 STORAGE_URL,
-                re.sub(pattern='<.+>', repl='.+', string=rule.rule),
-            )
+                re.sub(pattern='<.+>', repl='[^/?]+', string=rule.rule),
+            ) + r'(\?.*)?$'
 
             for method in rule.methods:
                 responses.add_callback(
@@ -80,9 +102,16 @@ class AuthenticationTests(InMemoryStorageTests):
         """
         # The storage application is a ``werkzeug.test.Client`` and therefore
         # has methods like 'head', 'get' and 'post'.
+        # Conditional request headers are passed on so that revalidation can
+        # be tested.
+        headers = [
+            (name, request.headers[name])
+            for name in ['If-None-Match', 'X-Primary-Until']
+            if name in request.headers]
         response = getattr(self.storage_app, request.method.lower())(
             request.path_url,
             content_type=request.headers['Content-Type'],
+            headers=headers,
             data=request.body)
 
         return (
@@ -110,6 +139,24 @@ class SignupTests(AuthenticationTests):
         self.assertEqual(response.status_code, codes.CREATED)
         self.assertEqual(json.loads(response.data.decode('utf8')), USER_DATA)
 
+    @responses.activate
+    def test_signup_single_request(self):
+        """
+        Signing up makes one request to the storage service, which refuses to
+        create a user with an email address which is in use.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(len(responses.calls), 1)
+
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(len(responses.calls), 2)
+
     @responses.activate
     def test_passwords_hashed(self):
         """
@@ -191,6 +238,104 @@ class SignupTests(AuthenticationTests):
         self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
 
 
+class SignupBatchTests(AuthenticationTests):
+    """
+    Tests for the bulk user sign up endpoint at ``/signup/batch``.
+    """
+
+    @responses.activate
+    def test_signup_batch(self):
+        """
+        Many users can be signed up at once. Users whose email addresses are
+        already in use are reported as conflicts and can log in with their
+        original password.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        users = [
+            {'email': 'bob@example.com', 'password': 'bob_secret'},
+            {'email': USER_DATA['email'], 'password': 'different'},
+            {'email': 'carol@example.com', 'password': 'carol_secret'},
+        ]
+        response = self.app.post(
+            '/signup/batch',
+            content_type='application/json',
+            data=json.dumps({'users': users}))
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {
+                'created': ['bob@example.com', 'carol@example.com'],
+                'conflicts': [USER_DATA['email']],
+            },
+        )
+
+        for user in (users[0], users[2], USER_DATA):
+            response = self.app.post(
+                '/login',
+                content_type='application/json',
+                data=json.dumps(user))
+            self.assertEqual(response.status_code, codes.OK)
+
+    @responses.activate
+    def test_existing_users_not_hashed(self):
+        """
+        Passwords are only hashed for users whose email addresses are not
+        already in use, and repeated email addresses are conflicts in the
+        order given.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        hashed = []
+        original = authentication.generate_password_hash
+
+        def generate_password_hash(password, rounds=None):
+            hashed.append(password)
+            return original(password, rounds)
+
+        authentication.generate_password_hash = generate_password_hash
+        self.addCleanup(
+            setattr, authentication, 'generate_password_hash', original)
+        users = [
+            {'email': USER_DATA['email'], 'password': 'different'},
+            {'email': 'bob@example.com', 'password': 'bob_secret'},
+            {'email': 'bob@example.com', 'password': 'bob_other'},
+        ]
+        response = self.app.post(
+            '/signup/batch',
+            content_type='application/json',
+            data=json.dumps({'users': users}))
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {
+                'created': ['bob@example.com'],
+                'conflicts': [USER_DATA['email'], 'bob@example.com'],
+            },
+        )
+        self.assertEqual(hashed, ['bob_secret'])
+
+    def test_missing_password(self):
+        """
+        A bulk signup request with a user without a password returns a
+        BAD_REQUEST status code and an error message.
+        """
+        response = self.app.post(
+            '/signup/batch',
+            content_type='application/json',
+            data=json.dumps({'users': [{'email': USER_DATA['email']}]}))
+        self.assertEqual(response.status_code, codes.BAD_REQUEST)
+        expected = {
+            'title': 'There was an error validating the given arguments.',
+            'detail': "'password' is a required property",
+        }
+        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+
+
 class LoginTests(AuthenticationTests):
     """
     Tests for the user log in endpoint at ``/login``.
@@ -279,6 +424,41 @@ class LoginTests(AuthenticationTests):
             user = load_user_from_id(user_id=USER_DATA['email'])
             self.assertEqual(token, user.get_auth_token())
 
+    @responses.activate
+    def test_hashing_pool_full(self):
+        """
+        If too many passwords are already being checked, a
+        SERVICE_UNAVAILABLE status code, a Retry-After header and error
+        details are returned.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+
+        original_pool = authentication.hashing_pool
+        authentication.hashing_pool = HashingPool(workers=1, queue_depth=0)
+        release = threading.Event()
+        authentication.hashing_pool.submit(release.wait)
+        try:
+            response = self.app.post(
+                '/login',
+                content_type='application/json',
+                data=json.dumps(USER_DATA))
+        finally:
+            release.set()
+            authentication.hashing_pool.shutdown()
+            authentication.hashing_pool = original_pool
+
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        expected = {
+            'title': 'The service is busy.',
+            'detail': 'Too many passwords are being checked. Try again later.',
+        }
+        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+
     def test_missing_email(self):
         """
         A login request without an email address returns a BAD_REQUEST status
@@ -322,41 +502,65 @@ class LoginTests(AuthenticationTests):
         self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
 
 
-class LogoutTests(AuthenticationTests):
+class RehashTests(AuthenticationTests):
     """
-    Tests for the user log out endpoint at ``/logout``.
+    Tests for replacing stored password hashes on login when the configured
+    work factor changes.
     """
 
-    @responses.activate
-    def test_logout(self):
+    def setUp(self):
+        super(RehashTests, self).setUp()
+        self.original_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.original_backend = authentication.storage_backend
+
+    def tearDown(self):
+        app.config['BCRYPT_LOG_ROUNDS'] = self.original_rounds
+        authentication.storage_backend = self.original_backend
+        super(RehashTests, self).tearDown()
+
+    def signup_and_login(self):
         """
-        A POST request to log out when a user is logged in returns an OK status
-        code.
+        Sign up with the configured work factor, then change it to 4 and log
+        in.
+
+        :return: The response to logging in.
         """
         self.app.post(
             '/signup',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-        self.app.post(
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        return self.app.post(
             '/login',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-        response = self.app.post('/logout', content_type='application/json')
-        self.assertEqual(response.status_code, codes.OK)
 
-    def test_not_logged_in(self):
+    @responses.activate
+    def test_rehash(self):
         """
-        A POST request to log out when no user is logged in returns an
-        UNAUTHORIZED status code.
+        Logging in replaces a stored hash with a different work factor. The
+        new hash matches the password and the remember token given is for the
+        new hash.
         """
-        response = self.app.post('/logout', content_type='application/json')
-        self.assertEqual(response.status_code, codes.UNAUTHORIZED)
+        response = self.signup_and_login()
+        self.assertEqual(response.status_code, codes.OK)
+
+        user = load_user_from_id(user_id=USER_DATA['email'])
+        self.assertEqual(hash_rounds(user.password_hash), 4)
+        self.assertTrue(bcrypt.check_password_hash(user.password_hash,
+                                                   USER_DATA['password']))
+
+        cookies = response.headers.getlist('Set-Cookie')
+        items = [list(parse_cookie(cookie).items())[0] for cookie in cookies]
+        headers_dict = {key: value for key, value in items}
+        with app.app_context():
+            self.assertEqual(headers_dict['remember_token'],
+                             user.get_auth_token())
 
     @responses.activate
-    def test_logout_twice(self):
+    def test_no_rehash(self):
         """
-        A POST request to log out, after a successful log out attempt returns
-        an UNAUTHORIZED status code.
+        A stored hash with the configured work factor is not replaced.
         """
         self.app.post(
             '/signup',
@@ -366,172 +570,704 @@ class LogoutTests(AuthenticationTests):
             '/login',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-        self.app.post('/logout', content_type='application/json')
-        response = self.app.post('/logout', content_type='application/json')
-        self.assertEqual(response.status_code, codes.UNAUTHORIZED)
+        methods = [call.request.method for call in responses.calls]
+        self.assertNotIn('PATCH', methods)
 
-    def test_incorrect_content_type(self):
+    @responses.activate
+    def test_rehash_storage_unavailable(self):
         """
-        If a Content-Type header other than 'application/json' is given, an
-        UNSUPPORTED_MEDIA_TYPE status code is given.
+        If the new hash cannot be stored, the user is still logged in and the
+        old hash is kept.
         """
-        response = self.app.post('/logout')
-        self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
+        backend = authentication.storage_backend
 
+        class FailingUpdates(object):
+            def __getattr__(self, name):
+                return getattr(backend, name)
 
-class LoadUserTests(AuthenticationTests):
+            def update_user(self, email, password_hash):
+                raise ConnectionError('Storage is down.')
+
+        authentication.storage_backend = FailingUpdates()
+        response = self.signup_and_login()
+        self.assertEqual(response.status_code, codes.OK)
+
+        user = load_user_from_id(user_id=USER_DATA['email'])
+        self.assertNotEqual(hash_rounds(user.password_hash), 4)
+
+
+class SessionTokenTests(AuthenticationTests):
     """
-    Tests for ``load_user_from_id``, which is a function required by
-    Flask-Login.
+    Tests for logging in with session tokens enabled.
     """
 
-    @responses.activate
-    def test_user_exists(self):
+    def setUp(self):
+        super(SessionTokenTests, self).setUp()
+        self.original_session_tokens = authentication.session_tokens
+        self.now = 1000.0
+        authentication.session_tokens = SessionTokens(
+            secret_keys=[app.config['SECRET_KEY']],
+            max_age=100,
+            revalidate_after=10,
+            clock=lambda: self.now,
+        )
+        app.config['SESSION_TOKENS'] = True
+
+    def tearDown(self):
+        app.config['SESSION_TOKENS'] = False
+        authentication.session_tokens = self.original_session_tokens
+        super(SessionTokenTests, self).tearDown()
+
+    def login(self):
         """
-        If a user exists with the email given as the user ID to
-        ``load_user_from_id``, that user is returned.
+        Sign up and log in.
+
+        :return: The session token given on logging in.
         """
         self.app.post(
             '/signup',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-        self.assertEqual(
-            load_user_from_id(user_id=USER_DATA['email']).email,
-            USER_DATA['email'],
-        )
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(response.headers.getlist('Set-Cookie'), [])
+        return json.loads(response.data.decode('utf8'))['token']
+
+    def status(self, token):
+        """
+        :return: The response to a status request with the given token.
+        """
+        return self.app.get(
+            '/status',
+            content_type='application/json',
+            headers={'Authorization': 'Bearer ' + token})
+
+    def assert_authenticated(self, response, authenticated):
+        data = json.loads(response.data.decode('utf8'))
+        self.assertEqual(data['is_authenticated'], authenticated)
 
     @responses.activate
-    def test_user_does_not_exist(self):
+    def test_status_without_storage(self):
         """
-        If no user exists with the email given as the user ID to
-        ``load_user_from_id``, ``None`` is returned.
+        A session token is accepted without a request to the storage service
+        until it is due to be revalidated.
         """
-        self.assertIsNone(load_user_from_id(user_id='email'))
+        token = self.login()
+        calls = len(responses.calls)
 
+        response = self.status(token)
+        self.assert_authenticated(response, True)
+        self.assertEqual(json.loads(response.data.decode('utf8'))['email'],
+                         USER_DATA['email'])
+        self.assertEqual(len(responses.calls), calls)
+        self.assertNotIn('X-Session-Token', response.headers)
 
-class StatusTests(AuthenticationTests):
-    """
-    Tests for the endpoint to get the current user's details.
-    """
+    @responses.activate
+    def test_revalidation(self):
+        """
+        A session token which is due to be revalidated is checked against the
+        storage service and a refreshed token is given, which is then accepted
+        without the storage service.
+        """
+        token = self.login()
+        self.now += 10
+        calls = len(responses.calls)
+
+        response = self.status(token)
+        self.assert_authenticated(response, True)
+        self.assertEqual(len(responses.calls), calls + 1)
+
+        refreshed = response.headers['X-Session-Token']
+        self.assert_authenticated(self.status(refreshed), True)
+        self.assertEqual(len(responses.calls), calls + 1)
 
     @responses.activate
-    def test_user_logged_in(self):
+    def test_password_changed(self):
         """
-        A ``GET`` request for information about the logged in user returns an
-        OK status code with a flag that there is an active user and that
-        user's email address if there is a logged in user.
+        A session token is rejected on revalidation if the user's password
+        hash has changed since it was issued.
         """
-        self.app.post(
-            '/signup',
-            content_type='application/json',
-            data=json.dumps(USER_DATA))
-        self.app.post(
-            '/login',
+        token = self.login()
+        self.storage_app.patch(
+            '/users/{email}'.format(email=USER_DATA['email']),
             content_type='application/json',
-            data=json.dumps(USER_DATA))
-        response = self.app.get('/status', content_type='application/json')
-        self.assertEqual(response.headers['Content-Type'], 'application/json')
-        self.assertEqual(response.status_code, codes.OK)
-        expected = {
-            'is_authenticated': True,
-            'email': USER_DATA['email'],
-        }
-        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+            data=json.dumps({'password_hash': 'new_hash'}))
 
-    def test_no_user_logged_in(self):
+        self.assert_authenticated(self.status(token), True)
+        self.now += 10
+        self.assert_authenticated(self.status(token), False)
+
+    @responses.activate
+    def test_expired(self):
         """
-        A ``GET`` request for information about the logged in user returns an
-        OK status code and a flag describing that there is no active user if
-        there is no logged in user.
+        An expired session token is not accepted.
         """
-        response = self.app.get('/status', content_type='application/json')
-        self.assertEqual(response.headers['Content-Type'], 'application/json')
-        self.assertEqual(response.status_code, codes.OK)
-        expected = {
-            'is_authenticated': False,
-        }
-        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+        token = self.login()
+        self.now += 100
+        self.assert_authenticated(self.status(token), False)
 
-    def test_incorrect_content_type(self):
+    @responses.activate
+    def test_disabled(self):
         """
-        If a Content-Type header other than 'application/json' is given, an
-        UNSUPPORTED_MEDIA_TYPE status code is given.
+        Session tokens are not accepted when they are not enabled.
         """
-        response = self.app.get('/status', content_type='text/html')
-        self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
+        token = self.login()
+        app.config['SESSION_TOKENS'] = False
+        self.assert_authenticated(self.status(token), False)
 
 
-class LoadUserFromTokenTests(AuthenticationTests):
+class UserFilterTests(AuthenticationTests):
     """
-    Tests for ``load_user_from_token``, which is a function required by
-    Flask-Login when using secure "Alternative Tokens".
+    Tests for ruling out users who do not exist with the user filter.
     """
 
-    @responses.activate
-    def test_load_user_from_token(self):
+    def setUp(self):
+        super(UserFilterTests, self).setUp()
+        self.original_user_filter = authentication.user_filter
+        authentication.user_filter = UserFilter(
+            backend=authentication.storage_backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+        )
+
+    def tearDown(self):
+        authentication.user_filter = self.original_user_filter
+        super(UserFilterTests, self).tearDown()
+
+    def create_in_storage(self):
         """
-        A user is loaded if their token is provided to
-        ``load_user_from_token``.
+        Create a user in the storage service without the authentication
+        service, as another instance of it would.
         """
-        self.app.post(
-            '/signup',
+        self.storage_app.post(
+            '/users',
             content_type='application/json',
-            data=json.dumps(USER_DATA))
+            data=json.dumps({
+                'email': USER_DATA['email'],
+                'password_hash': bcrypt.generate_password_hash(
+                    USER_DATA['password']).decode('utf8'),
+            }))
+
+    @responses.activate
+    def test_login_non_existant_user(self):
+        """
+        Logging in as a user who has been ruled out returns a NOT_FOUND
+        status code without asking the storage service.
+        """
+        authentication.user_filter.build()
+        calls = len(responses.calls)
         response = self.app.post(
             '/login',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-        cookies = response.headers.getlist('Set-Cookie')
-
-        items = [list(parse_cookie(cookie).items())[0] for cookie in cookies]
-        headers_dict = {key: value for key, value in items}
-        token = headers_dict['remember_token']
-        with app.app_context():
-            user = load_user_from_id(user_id=USER_DATA['email'])
-            self.assertEqual(load_user_from_token(auth_token=token), user)
+        self.assertEqual(response.status_code, codes.NOT_FOUND)
+        self.assertEqual(len(responses.calls), calls)
 
     @responses.activate
-    def test_fake_token(self):
+    def test_login_user_created_elsewhere(self):
         """
-        If a token does not belong to a user, ``None`` is returned.
+        A user who was created in the storage service other than through
+        this service after the filter was built can log in once the filter
+        is synced.
         """
-        self.app.post(
-            '/signup',
+        authentication.user_filter.build()
+        self.create_in_storage()
+        self.assertTrue(authentication.user_filter.sync())
+        response = self.app.post(
+            '/login',
             content_type='application/json',
             data=json.dumps(USER_DATA))
-
-        with app.app_context():
-            self.assertIsNone(load_user_from_token(auth_token='fake'))
-
-
-class DeleteUserTests(AuthenticationTests):
-    """
-    Tests for the delete user endpoint at ``DELETE /users/<email>``.
-    """
+        self.assertEqual(response.status_code, codes.OK)
+        text = self.app.get('/metrics').data.decode('utf8')
+        self.assertIn(
+            'authentication_user_filter_checks_total{result="present"} ',
+            text)
 
     @responses.activate
-    def test_delete_user(self):
+    def test_login_lagging_filter(self):
         """
-        A ``DELETE`` request to delete a user returns an OK status code and the
-        email of the deleted user. The user no longer exists.
+        A user whom a filter which has not been brought up to date recently
+        would rule out is looked up in the storage service.
         """
-        self.app.post(
-            '/signup',
+        authentication.user_filter.max_lag = 0
+        authentication.user_filter.build()
+        self.create_in_storage()
+        response = self.app.post(
+            '/login',
             content_type='application/json',
             data=json.dumps(USER_DATA))
+        self.assertEqual(response.status_code, codes.OK)
 
+    @responses.activate
+    def test_delete_non_existant_user(self):
+        """
+        Deleting a user who has been ruled out returns a NOT_FOUND status
+        code without asking the storage service.
+        """
+        authentication.user_filter.build()
+        calls = len(responses.calls)
         response = self.app.delete(
             '/users/{email}'.format(email=USER_DATA['email']),
             content_type='application/json')
+        self.assertEqual(response.status_code, codes.NOT_FOUND)
+        self.assertEqual(len(responses.calls), calls)
 
-        self.assertEqual(response.headers['Content-Type'], 'application/json')
-        self.assertEqual(response.status_code, codes.OK)
-        self.assertEqual(
-            json.loads(response.data.decode('utf8')),
+    @responses.activate
+    def test_delete_user_created_elsewhere(self):
+        """
+        A user who was created in the storage service other than through
+        this service after the filter was built can be deleted once the
+        filter is synced.
+        """
+        authentication.user_filter.build()
+        self.storage_app.post(
+            '/users/batch',
+            content_type='application/json',
+            data=json.dumps({'users': [{
+                'email': USER_DATA['email'],
+                'password_hash': 'hash',
+            }]}))
+        authentication.user_filter.sync()
+        response = self.app.delete(
+            '/users/{email}'.format(email=USER_DATA['email']),
+            content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+
+    @responses.activate
+    def test_signup_then_login(self):
+        """
+        A user who signs up after the filter is built can log in.
+        """
+        authentication.user_filter.build()
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(response.status_code, codes.OK)
+
+    @responses.activate
+    def test_existing_users(self):
+        """
+        Users who exist when the filter is built are not ruled out.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        authentication.user_filter.build()
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(response.status_code, codes.OK)
+
+    @responses.activate
+    def test_metrics(self):
+        """
+        The size, memory use and expected false positive rate of the filter,
+        and the results of checks, are published.
+        """
+        authentication.user_filter.build()
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        text = self.app.get('/metrics').data.decode('utf8')
+        for expected in (
+            'authentication_user_filter_entries 0.0',
+            'authentication_user_filter_bytes ',
+            'authentication_user_filter_false_positive_rate ',
+            'authentication_user_filter_checks_total{result="absent"} ',
+        ):
+            self.assertIn(expected, text)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is not available.')
+class SharedUserFilterTests(AuthenticationTests):
+    """
+    Tests for the user filter shared by worker processes forked after it is
+    made.
+    """
+
+    def setUp(self):
+        super(SharedUserFilterTests, self).setUp()
+        # Worker processes need a database which they all see.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+            os.path.join(directory, 'storage.db')
+        with storage_app.app_context():
+            db.create_all()
+        self.addCleanup(setattr, authentication, 'user_filter',
+                        authentication.user_filter)
+        authentication.user_filter = UserFilter(
+            backend=authentication.storage_backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+            shared=True,
+        )
+
+    @responses.activate
+    def test_signup_in_other_worker(self):
+        """
+        A user who signs up through one worker process can log in through
+        another straight away.
+        """
+        authentication.user_filter.build()
+
+        def signup():
+            dispose_engines(app=storage_app)
+            # The parent's hashing threads do not survive the fork.
+            authentication.hashing_pool = HashingPool(
+                workers=1, queue_depth=0)
+            response = self.app.post(
+                '/signup',
+                content_type='application/json',
+                data=json.dumps(USER_DATA))
+            return response.status_code == codes.CREATED
+
+        self.assertTrue(in_child_process(signup))
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(response.status_code, codes.OK)
+
+
+class LoginActivityTests(AuthenticationTests):
+    """
+    Tests for recording logins in the storage service in batches.
+    """
+
+    def setUp(self):
+        super(LoginActivityTests, self).setUp()
+        self.original_login_activity = authentication.login_activity
+        authentication.login_activity = LoginActivity(
+            backend=authentication.storage_backend,
+            batch_size=10,
+            flush_interval=60,
+            max_pending=100,
+        )
+
+    def tearDown(self):
+        authentication.login_activity = self.original_login_activity
+        super(LoginActivityTests, self).tearDown()
+
+    def activity(self):
+        """
+        :return: The login activity of the user from ``USER_DATA`` in the
+            storage service.
+        """
+        response = self.storage_app.get(
+            '/users/{email}/activity'.format(email=USER_DATA['email']),
+            content_type='application/json')
+        return json.loads(response.data.decode('utf8'))
+
+    @responses.activate
+    def test_login_recorded(self):
+        """
+        Logins are written to the storage service when the pending logins
+        are flushed, and not before.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        calls = len(responses.calls)
+        for _ in range(2):
+            response = self.app.post(
+                '/login',
+                content_type='application/json',
+                data=json.dumps(USER_DATA))
+            self.assertEqual(response.status_code, codes.OK)
+        # Each login only gets the user.
+        self.assertEqual(len(responses.calls), calls + 2)
+        self.assertEqual(self.activity()['login_count'], 0)
+
+        self.assertEqual(authentication.login_activity.flush(), 2)
+        activity = self.activity()
+        self.assertEqual(activity['login_count'], 2)
+        self.assertIsNotNone(activity['last_login'])
+
+    @responses.activate
+    def test_failed_login_not_recorded(self):
+        """
+        A login with an incorrect password is not recorded.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(
+                {'email': USER_DATA['email'], 'password': 'wrong'}))
+        self.assertEqual(
+            authentication.login_activity.stats()['recorded'], 0)
+
+    @responses.activate
+    def test_metrics(self):
+        """
+        The numbers of users with pending logins, of logins and of batches
+        are published.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        text = self.app.get('/metrics').data.decode('utf8')
+        for expected in (
+            'authentication_login_activity_pending 1',
+            'authentication_login_activity_logins_total{event="recorded"} 1',
+            'authentication_login_activity_batches_total{result="written"} 0',
+        ):
+            self.assertIn(expected, text)
+
+
+class LogoutTests(AuthenticationTests):
+    """
+    Tests for the user log out endpoint at ``/logout``.
+    """
+
+    @responses.activate
+    def test_logout(self):
+        """
+        A POST request to log out when a user is logged in returns an OK status
+        code.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = self.app.post('/logout', content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+
+    def test_not_logged_in(self):
+        """
+        A POST request to log out when no user is logged in returns an
+        UNAUTHORIZED status code.
+        """
+        response = self.app.post('/logout', content_type='application/json')
+        self.assertEqual(response.status_code, codes.UNAUTHORIZED)
+
+    @responses.activate
+    def test_logout_twice(self):
+        """
+        A POST request to log out, after a successful log out attempt returns
+        an UNAUTHORIZED status code.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post('/logout', content_type='application/json')
+        response = self.app.post('/logout', content_type='application/json')
+        self.assertEqual(response.status_code, codes.UNAUTHORIZED)
+
+    def test_incorrect_content_type(self):
+        """
+        If a Content-Type header other than 'application/json' is given, an
+        UNSUPPORTED_MEDIA_TYPE status code is given.
+        """
+        response = self.app.post('/logout')
+        self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
+
+
+class LoadUserTests(AuthenticationTests):
+    """
+    Tests for ``load_user_from_id``, which is a function required by
+    Flask-Login.
+    """
+
+    @responses.activate
+    def test_user_exists(self):
+        """
+        If a user exists with the email given as the user ID to
+        ``load_user_from_id``, that user is returned.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(
+            load_user_from_id(user_id=USER_DATA['email']).email,
+            USER_DATA['email'],
+        )
+
+    @responses.activate
+    def test_user_does_not_exist(self):
+        """
+        If no user exists with the email given as the user ID to
+        ``load_user_from_id``, ``None`` is returned.
+        """
+        self.assertIsNone(load_user_from_id(user_id='email'))
+
+
+class StatusTests(AuthenticationTests):
+    """
+    Tests for the endpoint to get the current user's details.
+    """
+
+    @responses.activate
+    def test_user_logged_in(self):
+        """
+        A ``GET`` request for information about the logged in user returns an
+        OK status code with a flag that there is an active user and that
+        user's email address if there is a logged in user.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = self.app.get('/status', content_type='application/json')
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        expected = {
+            'is_authenticated': True,
+            'email': USER_DATA['email'],
+        }
+        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+
+    def test_no_user_logged_in(self):
+        """
+        A ``GET`` request for information about the logged in user returns an
+        OK status code and a flag describing that there is no active user if
+        there is no logged in user.
+        """
+        response = self.app.get('/status', content_type='application/json')
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        expected = {
+            'is_authenticated': False,
+        }
+        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+
+    def test_incorrect_content_type(self):
+        """
+        If a Content-Type header other than 'application/json' is given, an
+        UNSUPPORTED_MEDIA_TYPE status code is given.
+        """
+        response = self.app.get('/status', content_type='text/html')
+        self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
+
+
+class LoadUserFromTokenTests(AuthenticationTests):
+    """
+    Tests for ``load_user_from_token``, which is a function required by
+    Flask-Login when using secure "Alternative Tokens".
+    """
+
+    @responses.activate
+    def test_load_user_from_token(self):
+        """
+        A user is loaded if their token is provided to
+        ``load_user_from_token``.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        cookies = response.headers.getlist('Set-Cookie')
+
+        items = [list(parse_cookie(cookie).items())[0] for cookie in cookies]
+        headers_dict = {key: value for key, value in items}
+        token = headers_dict['remember_token']
+        with app.app_context():
+            user = load_user_from_id(user_id=USER_DATA['email'])
+            self.assertEqual(load_user_from_token(auth_token=token), user)
+
+    @responses.activate
+    def test_fake_token(self):
+        """
+        If a token does not belong to a user, ``None`` is returned.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+
+        with app.app_context():
+            self.assertIsNone(load_user_from_token(auth_token='fake'))
+
+
+class DeleteUserTests(AuthenticationTests):
+    """
+    Tests for the delete user endpoint at ``DELETE /users/<email>``.
+    """
+
+    @responses.activate
+    def test_delete_user(self):
+        """
+        A ``DELETE`` request to delete a user returns an OK status code and the
+        email of the deleted user. The user no longer exists.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+
+        response = self.app.delete(
+            '/users/{email}'.format(email=USER_DATA['email']),
+            content_type='application/json')
+
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
             {'email': USER_DATA['email']})
 
         self.assertIsNone(load_user_from_id(user_id=USER_DATA['email']))
 
+    @responses.activate
+    def test_delete_single_request(self):
+        """
+        Deleting a user makes one request to the storage service, whether or
+        not the user exists.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        calls = len(responses.calls)
+
+        for _ in range(2):
+            self.app.delete(
+                '/users/{email}'.format(email=USER_DATA['email']),
+                content_type='application/json')
+            calls += 1
+            self.assertEqual(len(responses.calls), calls)
+
     @responses.activate
     def test_non_existant_user(self):
         """
@@ -563,6 +1299,468 @@ class DeleteUserTests(AuthenticationTests):
         self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
 
 
+class UserCacheTests(AuthenticationTests):
+    """
+    Tests for caching users loaded from the storage service.
+    """
+
+    def setUp(self):
+        super(UserCacheTests, self).setUp()
+        self.original_cache = authentication.user_cache
+        authentication.user_cache = UserCache(max_entries=10, ttl=60)
+
+    def tearDown(self):
+        authentication.user_cache = self.original_cache
+        super(UserCacheTests, self).tearDown()
+
+    @responses.activate
+    def test_status_uses_cache(self):
+        """
+        Once a user has logged in, getting their status does not make a
+        request to the storage service.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        calls = len(responses.calls)
+        response = self.app.get('/status', content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode('utf8'))['email'],
+                         USER_DATA['email'])
+        self.assertEqual(len(responses.calls), calls)
+
+    @responses.activate
+    def test_signup_invalidates(self):
+        """
+        A user which was not found can be loaded once they have signed up.
+        """
+        self.assertIsNone(load_user_from_id(user_id=USER_DATA['email']))
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertIsNotNone(load_user_from_id(user_id=USER_DATA['email']))
+
+    @responses.activate
+    def test_delete_invalidates(self):
+        """
+        A deleted user is not loaded from the cache.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertIsNotNone(load_user_from_id(user_id=USER_DATA['email']))
+        self.app.delete(
+            '/users/{email}'.format(email=USER_DATA['email']),
+            content_type='application/json')
+        self.assertIsNone(load_user_from_id(user_id=USER_DATA['email']))
+
+    def test_cache_stats(self):
+        """
+        Cache statistics are available at ``/cache``.
+        """
+        response = self.app.get('/cache', content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {'size': 0, 'max_entries': 10, 'hits': 0, 'misses': 0,
+             'evictions': 0},
+        )
+
+
+class CreateAppTests(AuthenticationTests):
+    """
+    Tests for ``create_app``.
+    """
+
+    @responses.activate
+    def test_config(self):
+        """
+        An application made with given configuration serves the
+        authentication service's routes with that configuration.
+        """
+        client = create_app(
+            config={'BCRYPT_LOG_ROUNDS': 4, 'SESSION_TOKENS': True},
+        ).test_client()
+        client.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = client.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertIn('token', json.loads(response.data.decode('utf8')))
+        user = load_user_from_id(user_id=USER_DATA['email'])
+        self.assertEqual(hash_rounds(user.password_hash), 4)
+
+    def test_errors(self):
+        """
+        An application made with ``create_app`` handles the authentication
+        service's errors.
+        """
+        client = create_app(config={'BCRYPT_LOG_ROUNDS': 4}).test_client()
+        response = client.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps({}))
+        self.assertEqual(response.status_code, codes.BAD_REQUEST)
+
+    def test_instrumented(self):
+        """
+        An application made with ``create_app`` records its requests and
+        publishes them at ``/metrics``, and adds the profiling routes if a
+        profiling token is configured.
+        """
+        client = create_app(
+            config={'BCRYPT_LOG_ROUNDS': 4, 'PROFILING_TOKEN': 'token'},
+        ).test_client()
+        client.get('/status')
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertIn(
+            'http_request_duration_seconds_count{route="/status"',
+            response.data.decode('utf8'))
+        response = client.get(
+            '/debug/profile', headers={'X-Profiling-Token': 'token'})
+        self.assertEqual(response.status_code, codes.OK)
+
+
+class StorageRecordTests(AuthenticationTests):
+    """
+    Tests for revalidating users' details with the storage service.
+    """
+
+    def setUp(self):
+        super(StorageRecordTests, self).setUp()
+        self.original_backend = authentication.storage_backend
+        self.backend = HTTPStorageBackend(
+            client=authentication.storage_client, max_records=10)
+        authentication.storage_backend = self.backend
+
+    def tearDown(self):
+        authentication.storage_backend = self.original_backend
+        super(StorageRecordTests, self).tearDown()
+
+    @responses.activate
+    def test_unchanged_user_revalidated(self):
+        """
+        Loading a user a second time sends the ``ETag`` from the first time
+        and gives the same details from a NOT_MODIFIED response.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        first = self.backend.get_user(email=USER_DATA['email'])
+        second = self.backend.get_user(email=USER_DATA['email'])
+        self.assertEqual(second, first)
+        request, response = responses.calls[-1]
+        self.assertIn('If-None-Match', request.headers)
+        self.assertEqual(response.status_code, codes.NOT_MODIFIED)
+
+    @responses.activate
+    def test_updated_user(self):
+        """
+        After a user is updated, loading them gives their new details.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.backend.get_user(email=USER_DATA['email'])
+        self.storage_app.patch(
+            '/users/{email}'.format(email=USER_DATA['email']),
+            content_type='application/json',
+            data=json.dumps({'password_hash': 'new_hash'}))
+        user = self.backend.get_user(email=USER_DATA['email'])
+        self.assertEqual(user['password_hash'], 'new_hash')
+
+    @responses.activate
+    def test_deleted_user(self):
+        """
+        A deleted user is not given from kept details.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.backend.get_user(email=USER_DATA['email'])
+        self.app.delete(
+            '/users/{email}'.format(email=USER_DATA['email']),
+            content_type='application/json')
+        self.assertIsNone(self.backend.get_user(email=USER_DATA['email']))
+        self.assertEqual(self.backend.records.stats()['size'], 0)
+
+
+class ReadYourWritesTests(unittest.TestCase):
+    """
+    Tests for sending reads of users who were just written to the storage
+    service's primary database.
+    """
+
+    def setUp(self):
+        self.now = 100.0
+        self.client = StorageClient(base_url=STORAGE_URL)
+        self.addCleanup(self.client.close)
+        self.backend = HTTPStorageBackend(
+            client=self.client, clock=lambda: self.now)
+        responses.add(
+            responses.POST, urljoin(STORAGE_URL, '/users'),
+            status=codes.CREATED, body='{}',
+            adding_headers={'X-Primary-Until': '102.0'})
+        for email in ('alice@example.com', 'bob@example.com'):
+            responses.add(
+                responses.GET, urljoin(STORAGE_URL, 'users/' + email),
+                status=codes.OK, content_type='application/json',
+                body=json.dumps({'email': email, 'password_hash': 'hash'}))
+
+    def read_headers(self, email):
+        """
+        :return: The headers sent with a read of the user with the given
+            ``email``.
+        """
+        self.backend.get_user(email=email)
+        return responses.calls[-1].request.headers
+
+    @responses.activate
+    def test_two_callers(self):
+        """
+        After one user is written, reads of that user send the storage
+        service's ``X-Primary-Until`` header back and reads of other users
+        do not.
+        """
+        self.backend.create_user(
+            email='alice@example.com', password_hash='hash')
+        self.assertEqual(
+            self.read_headers('alice@example.com')['X-Primary-Until'],
+            '102.0')
+        self.assertNotIn(
+            'X-Primary-Until', self.read_headers('bob@example.com'))
+        self.assertNotIn('Cookie', self.read_headers('bob@example.com'))
+
+    @responses.activate
+    def test_expired(self):
+        """
+        Reads of a user no longer send the header once the time which it
+        gives has passed.
+        """
+        self.backend.create_user(
+            email='alice@example.com', password_hash='hash')
+        self.now = 102.0
+        self.assertNotIn(
+            'X-Primary-Until', self.read_headers('alice@example.com'))
+
+
+class BlockingStorageBackend(object):
+    """
+    A storage backend whose lookups wait until they are released.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def get_user(self, email):
+        self.calls.append(('get_user', email))
+        self.release.wait()
+        return {'email': email, 'password_hash': 'hash'}
+
+    def get_user_by_token_fingerprint(self, fingerprint):
+        self.calls.append(('get_user_by_token_fingerprint', fingerprint))
+        self.release.wait()
+        return None
+
+
+class StorageLookupTests(unittest.TestCase):
+    """
+    Tests for sharing concurrent lookups of the same user.
+    """
+
+    def setUp(self):
+        self.original_backend = authentication.storage_backend
+        self.original_lookups = authentication.storage_lookups
+        self.backend = BlockingStorageBackend()
+        authentication.storage_backend = self.backend
+        authentication.storage_lookups = SingleFlight()
+
+    def tearDown(self):
+        authentication.storage_backend = self.original_backend
+        authentication.storage_lookups = self.original_lookups
+
+    def concurrently(self, function, callers):
+        """
+        Call ``function`` from ``callers`` threads at once, and let the
+        storage backend respond once all but one are sharing a lookup.
+
+        :return: The results of the calls.
+        """
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(function()))
+            for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        while authentication.storage_lookups.stats()['collapsed'] < (
+                callers - 1):
+            time.sleep(0.001)
+        self.backend.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_load_user_from_id(self):
+        """
+        Concurrent loads of the same user make one call to the storage
+        service.
+        """
+        users = self.concurrently(
+            lambda: load_user_from_id(user_id=USER_DATA['email']),
+            callers=4)
+        self.assertEqual([user.email for user in users],
+                         [USER_DATA['email']] * 4)
+        self.assertEqual(self.backend.calls,
+                         [('get_user', USER_DATA['email'])])
+
+    def test_load_user_from_token(self):
+        """
+        Concurrent loads of a user by the same token make one call to the
+        storage service.
+        """
+        results = self.concurrently(
+            lambda: load_user_from_token(auth_token='token'), callers=3)
+        self.assertEqual(results, [None] * 3)
+        self.assertEqual(len(self.backend.calls), 1)
+
+    def test_metrics(self):
+        """
+        The numbers of lookups made and shared are published.
+        """
+        self.concurrently(
+            lambda: load_user_from_id(user_id=USER_DATA['email']),
+            callers=3)
+        text = app.test_client().get('/metrics').data.decode('utf8')
+        self.assertIn(
+            'authentication_storage_lookups_total{result="executed"} 1', text)
+        self.assertIn(
+            'authentication_storage_lookups_total{result="collapsed"} 2',
+            text)
+
+
+class MetricsTests(AuthenticationTests):
+    """
+    Tests for the metrics endpoint at ``/metrics``.
+    """
+
+    @responses.activate
+    def test_sub_timers(self):
+        """
+        The time taken by calls to the storage service and by password
+        hashing is published.
+        """
+        self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(USER_DATA))
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, codes.OK)
+        text = response.data.decode('utf8')
+        for expected in (
+            'authentication_storage_seconds_count{operation="get_user"}',
+            'authentication_storage_seconds_count{operation="create_user"}',
+            'authentication_bcrypt_seconds_count{operation="generate"} ',
+            'authentication_bcrypt_seconds_count{operation="check"} ',
+            'http_request_duration_seconds_count'
+            '{route="/login",method="POST",status="200"} ',
+            'authentication_user_cache_entries ',
+            'authentication_storage_circuit_state{state="closed"} 1',
+            'authentication_storage_in_flight 0',
+        ):
+            self.assertIn(expected, text)
+
+
+class StorageUnavailableTests(unittest.TestCase):
+    """
+    Tests for when the storage service cannot be reached.
+    """
+
+    def test_storage_unavailable(self):
+        """
+        If a request to the storage service fails, a SERVICE_UNAVAILABLE
+        status code and error details are returned.
+        """
+        client = app.test_client()
+        with responses.RequestsMock() as mock:
+            mock.add(
+                responses.GET,
+                re.compile(urljoin(STORAGE_URL, '/users/.+')),
+                body=ConnectionError('Storage is down.'),
+            )
+            response = client.post(
+                '/login',
+                content_type='application/json',
+                data=json.dumps(USER_DATA))
+
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.status_code, codes.SERVICE_UNAVAILABLE)
+        expected = {
+            'title': 'The storage service is unavailable.',
+            'detail': 'Storage is down.',
+        }
+        self.assertEqual(json.loads(response.data.decode('utf8')), expected)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    """
+    Tests for refusing requests while the storage service is failing.
+    """
+
+    def setUp(self):
+        self.original_backend = authentication.storage_backend
+        authentication.storage_backend = ResilientStorageBackend(
+            backend=HTTPStorageBackend(client=authentication.storage_client),
+            max_in_flight=1,
+            breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60),
+        )
+
+    def tearDown(self):
+        authentication.storage_backend = self.original_backend
+
+    def test_circuit_open(self):
+        """
+        Once the storage service has failed, requests which need it get a
+        SERVICE_UNAVAILABLE status code without it being called.
+        """
+        client = app.test_client()
+        with responses.RequestsMock() as mock:
+            mock.add(
+                responses.GET,
+                re.compile(urljoin(STORAGE_URL, '/users/.+')),
+                body=ConnectionError('Storage is down.'),
+            )
+            for _ in range(2):
+                response = client.post(
+                    '/login',
+                    content_type='application/json',
+                    data=json.dumps(USER_DATA))
+            self.assertEqual(len(mock.calls), 1)
+
+        self.assertEqual(response.status_code, codes.SERVICE_UNAVAILABLE)
+        self.assertEqual(
+            json.loads(response.data.decode('utf8'))['title'],
+            'The storage service is unavailable.')
+
+
 class UserTests(unittest.TestCase):
     """
     Tests for the ``User`` model.
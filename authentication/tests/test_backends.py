@@ -0,0 +1,217 @@
+"""
+Tests for authentication.backends.
+"""
+
+import json
+
+from requests import codes
+
+from authentication import authentication
+from authentication.backends import InProcessStorageBackend
+
+from storage.tests.testtools import InMemoryStorageTests
+
+USER_DATA = {'email': 'alice@example.com', 'password_hash': '123abc'}
+
+
+class InProcessStorageBackendTests(InMemoryStorageTests):
+    """
+    Tests for ``InProcessStorageBackend``.
+    """
+
+    def setUp(self):
+        super(InProcessStorageBackendTests, self).setUp()
+        self.backend = InProcessStorageBackend()
+
+    def test_create_and_get_user(self):
+        """
+        A created user can be got by email address.
+        """
+        self.assertTrue(self.backend.create_user(**USER_DATA))
+        self.assertEqual(self.backend.get_user(USER_DATA['email']), USER_DATA)
+
+    def test_create_existing_user(self):
+        """
+        A user is not created if their email address is in use.
+        """
+        self.backend.create_user(**USER_DATA)
+        self.assertFalse(self.backend.create_user(
+            email=USER_DATA['email'], password_hash='different'))
+        self.assertEqual(self.backend.get_user(USER_DATA['email']), USER_DATA)
+
+    def test_get_non_existant_user(self):
+        """
+        ``None`` is given for a user which does not exist.
+        """
+        self.assertIsNone(self.backend.get_user(USER_DATA['email']))
+
+    def test_get_user_by_token_fingerprint(self):
+        """
+        A user can be got by the fingerprint of their remember token.
+        """
+        self.backend.create_user(**USER_DATA)
+        storage = self.backend.storage
+        with storage.app.app_context():
+            fingerprint = storage.token_fingerprint(**USER_DATA)
+        self.assertEqual(
+            self.backend.get_user_by_token_fingerprint(fingerprint),
+            USER_DATA,
+        )
+
+    def test_create_users(self):
+        """
+        Many users can be created at once, with conflicts reported.
+        """
+        self.backend.create_user(**USER_DATA)
+        bob = {'email': 'bob@example.com', 'password_hash': '456def'}
+        self.assertEqual(
+            self.backend.create_users([USER_DATA, bob]),
+            ([bob['email']], [USER_DATA['email']]),
+        )
+
+    def test_get_users(self):
+        """
+        Many users can be got at once, with missing users reported.
+        """
+        self.backend.create_user(**USER_DATA)
+        self.assertEqual(
+            self.backend.get_users(['bob@example.com', USER_DATA['email']]),
+            ([USER_DATA], ['bob@example.com']),
+        )
+
+    def test_get_users_page(self):
+        """
+        Users are given a page at a time in order of email address, with the
+        total number of users.
+        """
+        bob = {'email': 'bob@example.com', 'password_hash': '456def'}
+        self.backend.create_users([bob, USER_DATA])
+        self.assertEqual(
+            self.backend.get_users_page(after=None, limit=1),
+            ([USER_DATA], USER_DATA['email'], 2),
+        )
+        self.assertEqual(
+            self.backend.get_users_page(after=USER_DATA['email'], limit=1),
+            ([bob], None, 2),
+        )
+
+    def test_get_new_users(self):
+        """
+        Users added since a time are given a page at a time, with the time at
+        which they were read.
+        """
+        self.backend.create_user(**USER_DATA)
+        users, next_after, as_of = self.backend.get_new_users(
+            since=None, after=None, limit=10)
+        self.assertEqual((users, next_after), ([USER_DATA], None))
+        self.assertEqual(
+            self.backend.get_new_users(since=as_of, after=None, limit=10)[:2],
+            ([], None),
+        )
+        bob = {'email': 'bob@example.com', 'password_hash': '456def'}
+        self.backend.create_users([bob])
+        self.assertEqual(
+            self.backend.get_new_users(since=as_of, after=None, limit=10)[:2],
+            ([bob], None),
+        )
+
+    def test_record_logins(self):
+        """
+        Logins of users who exist are recorded.
+        """
+        self.backend.create_user(**USER_DATA)
+        self.assertEqual(
+            self.backend.record_logins([
+                {'email': USER_DATA['email'], 'count': 1, 'last_login': 1.0},
+                {'email': 'bob@example.com', 'count': 1, 'last_login': 1.0},
+            ]),
+            1,
+        )
+
+    def test_update_user(self):
+        """
+        Updating a user gives their new details, which are then stored.
+        """
+        self.backend.create_user(**USER_DATA)
+        updated = {'email': USER_DATA['email'], 'password_hash': 'new_hash'}
+        self.assertEqual(
+            self.backend.update_user(
+                email=USER_DATA['email'], password_hash='new_hash'),
+            updated,
+        )
+        self.assertEqual(self.backend.get_user(USER_DATA['email']), updated)
+
+    def test_update_non_existant_user(self):
+        """
+        ``None`` is given when updating a user which does not exist.
+        """
+        self.assertIsNone(self.backend.update_user(
+            email=USER_DATA['email'], password_hash='new_hash'))
+
+    def test_delete_user(self):
+        """
+        Deleting a user gives their details, and the user no longer exists.
+        """
+        self.backend.create_user(**USER_DATA)
+        self.assertEqual(self.backend.delete_user(USER_DATA['email']),
+                         USER_DATA)
+        self.assertIsNone(self.backend.get_user(USER_DATA['email']))
+        self.assertIsNone(self.backend.delete_user(USER_DATA['email']))
+
+    def test_delete_user_concurrently(self):
+        """
+        ``None`` is given if another caller deletes the user after it is
+        loaded.
+        """
+        self.backend.create_user(**USER_DATA)
+        storage = self.backend.storage
+        original_load_user_from_id = storage.load_user_from_id
+
+        def load_user_from_id(user_id):
+            user = original_load_user_from_id(user_id)
+            storage.db.session.expunge(user)
+            storage.delete_user(email=user_id)
+            return user
+
+        self.addCleanup(
+            setattr, storage, 'load_user_from_id', original_load_user_from_id)
+        storage.load_user_from_id = load_user_from_id
+        self.assertIsNone(self.backend.delete_user(USER_DATA['email']))
+
+
+class InProcessAuthenticationTests(InMemoryStorageTests):
+    """
+    Tests for the authentication service using ``InProcessStorageBackend``.
+    """
+
+    def setUp(self):
+        super(InProcessAuthenticationTests, self).setUp()
+        self.original_backend = authentication.storage_backend
+        authentication.storage_backend = InProcessStorageBackend()
+        self.app = authentication.app.test_client()
+
+    def tearDown(self):
+        authentication.storage_backend = self.original_backend
+        super(InProcessAuthenticationTests, self).tearDown()
+
+    def test_signup_login_status(self):
+        """
+        A user can sign up, log in and see that they are logged in without
+        the storage service's HTTP API.
+        """
+        user = {'email': USER_DATA['email'], 'password': 'secret'}
+        response = self.app.post(
+            '/signup',
+            content_type='application/json',
+            data=json.dumps(user))
+        self.assertEqual(response.status_code, codes.CREATED)
+        response = self.app.post(
+            '/login',
+            content_type='application/json',
+            data=json.dumps(user))
+        self.assertEqual(response.status_code, codes.OK)
+        response = self.app.get('/status', content_type='application/json')
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {'is_authenticated': True, 'email': USER_DATA['email']},
+        )
@@ -0,0 +1,432 @@
+"""
+Tests for authentication.bloom.
+"""
+
+import os
+import time
+import unittest
+
+from requests.exceptions import ConnectionError
+
+from authentication.bloom import BloomFilter, UserFilter
+
+
+def in_child_process(function):
+    """
+    Call a function in a forked process.
+
+    :return: Whether the function returned a true value.
+    :rtype: bool
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if function():
+                status = 0
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    return status == 0
+
+
+class BloomFilterTests(unittest.TestCase):
+    """
+    Tests for ``BloomFilter``.
+    """
+
+    def test_added(self):
+        """
+        Added items are always reported as present.
+        """
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        emails = ['user{index}@example.com'.format(index=index)
+                  for index in range(1000)]
+        for email in emails:
+            bloom.add(email)
+        self.assertTrue(all(email in bloom for email in emails))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        """
+        Items which were not added are reported as present at about the
+        given error rate once the filter is full, and the expected rate is
+        reported.
+        """
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        for index in range(10000):
+            bloom.add('user{index}@example.com'.format(index=index))
+        false_positives = sum(
+            'other{index}@example.com'.format(index=index) in bloom
+            for index in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, places=3)
+
+    def test_memory(self):
+        """
+        A filter uses about 1.2 bytes per item for a 1% error rate.
+        """
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        self.assertEqual(bloom.memory_bytes(), 11982)
+
+    def test_empty(self):
+        """
+        An empty filter reports nothing as present.
+        """
+        bloom = BloomFilter(capacity=10, error_rate=0.01)
+        self.assertNotIn('alice@example.com', bloom)
+        self.assertEqual(bloom.false_positive_rate(), 0)
+
+    def test_clear(self):
+        """
+        A cleared filter reports nothing as present.
+        """
+        bloom = BloomFilter(capacity=10, error_rate=0.01)
+        bloom.add('alice@example.com')
+        bloom.clear()
+        self.assertNotIn('alice@example.com', bloom)
+        self.assertEqual(bloom.count, 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is not available.')
+    def test_shared(self):
+        """
+        Items added to a shared filter by a forked process are present in
+        the parent process.
+        """
+        bloom = BloomFilter(capacity=10, error_rate=0.01, shared=True)
+        self.assertTrue(in_child_process(
+            lambda: bloom.add('alice@example.com') or True))
+        self.assertIn('alice@example.com', bloom)
+        self.assertEqual(bloom.count, 1)
+
+
+class FakeBackend(object):
+    """
+    A backend with some users, which can run code between pages.
+    """
+
+    def __init__(self, emails):
+        self.emails = sorted(emails)
+        # The time at which each user was added, by a clock which only
+        # moves when ``now`` is changed. The first users were added long
+        # before.
+        self.now = 1000.0
+        self.added_at = dict.fromkeys(self.emails, 0.0)
+        self.pages = 0
+        self.between_pages = lambda: None
+        self.unavailable = False
+        self.error = None
+
+    def create(self, email):
+        """
+        Add a user other than through the filter.
+        """
+        self.emails.append(email)
+        self.emails.sort()
+        self.added_at[email] = self.now
+
+    def get_new_users(self, since, after, limit):
+        if self.unavailable:
+            raise ConnectionError('Storage is down.')
+        if self.error is not None:
+            raise self.error
+        if self.pages:
+            self.between_pages()
+        self.pages += 1
+        emails = [email for email in self.emails
+                  if (after is None or email > after) and
+                  (since is None or self.added_at[email] >= since)]
+        page = emails[:limit]
+        next_after = page[-1] if len(emails) > limit else None
+        users = [{'email': email, 'password_hash': 'hash'} for email in page]
+        return users, next_after, self.now
+
+
+class UserFilterTests(unittest.TestCase):
+    """
+    Tests for ``UserFilter``.
+    """
+
+    def setUp(self):
+        self.backend = FakeBackend(
+            ['user{index}@example.com'.format(index=index)
+             for index in range(25)])
+        self.user_filter = UserFilter(
+            backend=self.backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+        )
+
+    def test_not_built(self):
+        """
+        Before the filter is built, any user might exist.
+        """
+        self.assertFalse(self.user_filter.ready)
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+        self.assertEqual(self.user_filter.stats()['entries'], 0)
+
+    def test_build(self):
+        """
+        Building the filter reads all users a page at a time, after which
+        users who do not exist are ruled out.
+        """
+        self.user_filter.build()
+        self.assertEqual(self.backend.pages, 3)
+        for email in self.backend.emails:
+            self.assertTrue(self.user_filter.might_exist(email))
+        self.assertFalse(self.user_filter.might_exist('alice@example.com'))
+        stats = self.user_filter.stats()
+        self.assertEqual(stats['entries'], 25)
+        self.assertGreater(stats['bytes'], 0)
+        self.assertLess(stats['false_positive_rate'], 0.01)
+
+    def test_add(self):
+        """
+        Added users might exist.
+        """
+        self.user_filter.build()
+        self.user_filter.add('alice@example.com')
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_add_during_build(self):
+        """
+        Users added while the filter is rebuilt are in the new filter.
+        """
+        self.backend.between_pages = lambda: self.user_filter.add(
+            'alice@example.com')
+        self.user_filter.build()
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_rebuild_drops_deleted(self):
+        """
+        Users who have been deleted are ruled out after a rebuild.
+        """
+        self.user_filter.build()
+        deleted = self.backend.emails.pop()
+        self.user_filter.build()
+        self.assertFalse(self.user_filter.might_exist(deleted))
+
+    def test_build_fails(self):
+        """
+        If the storage service cannot be reached, the current filter is kept.
+        """
+        self.user_filter.build()
+        self.backend.unavailable = True
+        with self.assertRaises(ConnectionError):
+            self.user_filter.build()
+        self.assertTrue(self.user_filter.ready)
+        self.user_filter.add('alice@example.com')
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_build_in_progress(self):
+        """
+        A build is skipped while another is in progress, and the other
+        build's filter is used.
+        """
+        skipped = []
+        self.backend.between_pages = lambda: skipped.append(
+            self.user_filter.build())
+        self.assertTrue(self.user_filter.build())
+        self.assertEqual(set(skipped), {False})
+        self.assertTrue(self.user_filter.ready)
+
+    def test_stale_build_taken_over(self):
+        """
+        A build which has been in progress for ``rebuild_interval`` seconds
+        is assumed to have died. Another build takes over, and the stale
+        build does not replace the filter when it finishes.
+        """
+        self.user_filter.rebuild_interval = 0
+        results = []
+
+        def build_again():
+            self.backend.between_pages = lambda: None
+            self.backend.emails.pop()
+            results.append(self.user_filter.build())
+
+        self.backend.between_pages = build_again
+        self.assertFalse(self.user_filter.build())
+        self.assertEqual(results, [True])
+        self.assertEqual(self.user_filter.stats()['entries'], 24)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is not available.')
+    def test_shared(self):
+        """
+        Users added through a process forked after a shared filter is made
+        might exist in every process, and filters built by one process are
+        used by all.
+        """
+        user_filter = UserFilter(
+            backend=self.backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+            shared=True,
+        )
+        self.assertTrue(in_child_process(user_filter.build))
+        self.assertTrue(user_filter.ready)
+        self.assertFalse(user_filter.might_exist('alice@example.com'))
+        self.assertTrue(in_child_process(
+            lambda: user_filter.add('alice@example.com') or True))
+        self.assertTrue(user_filter.might_exist('alice@example.com'))
+
+    def test_sync(self):
+        """
+        Syncing adds users added to the storage service since a little
+        before the filter was built, without reading the others again.
+        """
+        self.user_filter.build()
+        self.backend.pages = 0
+        self.backend.now += 5
+        self.backend.create('alice@example.com')
+        self.assertFalse(self.user_filter.might_exist('alice@example.com'))
+        self.assertTrue(self.user_filter.sync())
+        self.assertEqual(self.backend.pages, 1)
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+        self.assertEqual(self.user_filter.stats()['entries'], 26)
+
+    def test_sync_overlap(self):
+        """
+        Each sync reads again the users added in the ``sync_overlap``
+        seconds before the last one, so users which could only be read
+        after it are not missed.
+        """
+        self.user_filter.build()
+        self.backend.now += 60
+        self.user_filter.sync()
+        # Added by a request which started before the last sync and was only
+        # committed after it.
+        self.backend.added_at['alice@example.com'] = self.backend.now - 5
+        self.backend.emails.append('alice@example.com')
+        self.backend.emails.sort()
+        self.backend.now += 1
+        self.user_filter.sync()
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_sync_before_build(self):
+        """
+        Nothing is synced before the filter is first built.
+        """
+        self.assertFalse(self.user_filter.sync())
+        self.assertEqual(self.backend.pages, 0)
+        self.assertFalse(self.user_filter.ready)
+
+    def test_sync_during_build(self):
+        """
+        Users synced while the filter is rebuilt are in the new filter.
+        """
+        self.user_filter.build()
+
+        def create_and_sync():
+            self.backend.between_pages = lambda: None
+            self.backend.now += 5
+            self.backend.create('alice@example.com')
+            self.user_filter.sync()
+
+        self.backend.between_pages = create_and_sync
+        self.user_filter.build()
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_sync_fails(self):
+        """
+        If the storage service cannot be reached, users added to it are read
+        by the next sync.
+        """
+        self.user_filter.build()
+        self.backend.now += 5
+        self.backend.create('alice@example.com')
+        self.backend.unavailable = True
+        with self.assertRaises(ConnectionError):
+            self.user_filter.sync()
+        self.backend.unavailable = False
+        self.backend.now += 60
+        self.assertTrue(self.user_filter.sync())
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+
+    def test_lagging(self):
+        """
+        A filter which has not been built or synced for ``max_lag`` seconds
+        rules out nobody until it is synced again.
+        """
+        self.user_filter.max_lag = 0.01
+        self.user_filter.build()
+        time.sleep(0.02)
+        self.assertFalse(self.user_filter.ready)
+        self.assertTrue(self.user_filter.might_exist('alice@example.com'))
+        self.user_filter.sync()
+        self.assertTrue(self.user_filter.ready)
+        self.assertFalse(self.user_filter.might_exist('alice@example.com'))
+
+    def test_start(self):
+        """
+        Starting the filter builds it in the background.
+        """
+        self.user_filter.start()
+        self.user_filter.stop()
+        self.assertTrue(self.user_filter.ready)
+
+    def test_syncs_in_background(self):
+        """
+        Once started, users added to the storage service are synced in the
+        background.
+        """
+        user_filter = UserFilter(
+            backend=self.backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+            sync_interval=0.01,
+        )
+        user_filter.start()
+        self.addCleanup(user_filter.stop)
+        deadline = time.time() + 5
+        while not user_filter.ready and time.time() < deadline:
+            time.sleep(0.01)
+        self.backend.create('alice@example.com')
+        while (not user_filter.might_exist('alice@example.com') and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertTrue(user_filter.might_exist('alice@example.com'))
+
+    def test_rebuilds_after_error(self):
+        """
+        The background thread keeps rebuilding the filter after a build fails
+        with an error other than a request error, such as a database error
+        from an in-process backend.
+        """
+        self.backend.error = RuntimeError('Database is locked.')
+        user_filter = UserFilter(
+            backend=self.backend,
+            capacity=100,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=0.01,
+        )
+        user_filter.start()
+        self.addCleanup(user_filter.stop)
+        time.sleep(0.05)
+        self.assertFalse(user_filter.ready)
+        self.backend.error = None
+        deadline = time.time() + 5
+        while not user_filter.ready and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(user_filter.ready)
+
+    def test_disabled(self):
+        """
+        A filter with no capacity is not built when started.
+        """
+        user_filter = UserFilter(
+            backend=self.backend,
+            capacity=0,
+            error_rate=0.01,
+            page_size=10,
+            rebuild_interval=60,
+        )
+        user_filter.start()
+        user_filter.stop()
+        self.assertFalse(user_filter.ready)
@@ -0,0 +1,93 @@
+"""
+Tests for authentication.cache.
+"""
+
+import unittest
+
+from authentication.cache import UserCache
+
+
+class FakeClock(object):
+    """
+    A clock which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class UserCacheTests(unittest.TestCase):
+    """
+    Tests for ``UserCache``.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = UserCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_miss(self):
+        """
+        Looking up a key which has not been stored is a miss.
+        """
+        self.assertEqual(self.cache.lookup('alice'), (False, None))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_hit(self):
+        """
+        Looking up a key which has been stored is a hit.
+        """
+        self.cache.store('alice', 'user')
+        self.assertEqual(self.cache.lookup('alice'), (True, 'user'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_negative_entry(self):
+        """
+        ``None`` can be cached.
+        """
+        self.cache.store('alice', None)
+        self.assertEqual(self.cache.lookup('alice'), (True, None))
+
+    def test_expiry(self):
+        """
+        Entries are not found once their time to live has passed.
+        """
+        self.cache.store('alice', 'user')
+        self.clock.now = 10
+        self.assertEqual(self.cache.lookup('alice'), (False, None))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_evicted(self):
+        """
+        When the cache is full, the least recently used entry is evicted.
+        """
+        self.cache.store('alice', 'alice_user')
+        self.cache.store('bob', 'bob_user')
+        self.cache.lookup('alice')
+        self.cache.store('carol', 'carol_user')
+        self.assertEqual(self.cache.lookup('bob'), (False, None))
+        self.assertEqual(self.cache.lookup('alice'), (True, 'alice_user'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate(self):
+        """
+        An invalidated entry is not found.
+        """
+        self.cache.store('alice', 'user')
+        self.cache.invalidate('alice')
+        self.assertEqual(self.cache.lookup('alice'), (False, None))
+
+    def test_disabled(self):
+        """
+        A cache with no space stores nothing and counts nothing.
+        """
+        cache = UserCache(max_entries=0, ttl=10)
+        cache.store('alice', 'user')
+        self.assertEqual(cache.lookup('alice'), (False, None))
+        self.assertEqual(
+            cache.stats(),
+            {'size': 0, 'max_entries': 0, 'hits': 0, 'misses': 0,
+             'evictions': 0},
+        )
@@ -0,0 +1,84 @@
+"""
+Tests for authentication.cost.
+"""
+
+import unittest
+
+import bcrypt
+
+from authentication.cost import calibrate_rounds, check_seconds, hash_rounds
+
+
+class HashRoundsTests(unittest.TestCase):
+    """
+    Tests for ``hash_rounds``.
+    """
+
+    def test_bcrypt_hash(self):
+        """
+        The work factor of a bcrypt hash is given.
+        """
+        password_hash = bcrypt.hashpw(b'secret', bcrypt.gensalt(5))
+        self.assertEqual(hash_rounds(password_hash.decode('utf8')), 5)
+
+    def test_not_bcrypt_hash(self):
+        """
+        ``None`` is given for something which is not a bcrypt hash.
+        """
+        self.assertIsNone(hash_rounds('123abc'))
+        self.assertIsNone(hash_rounds('$2b$xx$abc'))
+
+
+class CheckSecondsTests(unittest.TestCase):
+    """
+    Tests for ``check_seconds``.
+    """
+
+    def test_positive(self):
+        """
+        Checking a password takes some time.
+        """
+        self.assertGreater(check_seconds(rounds=4, samples=1), 0)
+
+
+class CalibrateRoundsTests(unittest.TestCase):
+    """
+    Tests for ``calibrate_rounds``.
+    """
+
+    def measure(self, rounds):
+        """
+        A fake measurement in which the work factor 4 takes a millisecond.
+        """
+        self.measured.append(rounds)
+        return 0.001 * 2 ** (rounds - 4)
+
+    def setUp(self):
+        self.measured = []
+
+    def test_highest_within_target(self):
+        """
+        The highest work factor which takes no longer than the target is
+        chosen, and no slower work factors are measured.
+        """
+        self.assertEqual(
+            calibrate_rounds(target_seconds=0.1, measure=self.measure), 10)
+        self.assertEqual(self.measured, list(range(4, 12)))
+
+    def test_minimum(self):
+        """
+        The minimum work factor is chosen if it is too slow.
+        """
+        self.assertEqual(
+            calibrate_rounds(target_seconds=0.0001, min_rounds=6,
+                             measure=self.measure),
+            6)
+
+    def test_maximum(self):
+        """
+        No work factor above the maximum is chosen.
+        """
+        self.assertEqual(
+            calibrate_rounds(target_seconds=10, max_rounds=8,
+                             measure=self.measure),
+            8)
@@ -0,0 +1,101 @@
+"""
+Tests for authentication.hashing.
+"""
+
+import threading
+import unittest
+
+from authentication.hashing import HashingPool, pool_size, PoolFull
+
+
+class HashingPoolTests(unittest.TestCase):
+    """
+    Tests for ``HashingPool``.
+    """
+
+    def setUp(self):
+        self.pool = HashingPool(workers=1, queue_depth=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def test_run(self):
+        """
+        ``run`` returns the result of the given function.
+        """
+        self.assertEqual(self.pool.run(pow, 2, 3), 8)
+
+    def test_full(self):
+        """
+        Once as many tasks are running and waiting as the pool allows, more
+        tasks are refused.
+        """
+        self.pool.submit(self.release.wait)
+        self.pool.submit(self.release.wait)
+        with self.assertRaises(PoolFull):
+            self.pool.submit(self.release.wait)
+
+    def test_space_freed(self):
+        """
+        Tasks are accepted again once earlier tasks finish.
+        """
+        first = self.pool.submit(self.release.wait)
+        second = self.pool.submit(self.release.wait)
+        self.release.set()
+        first.result()
+        second.result()
+        self.assertEqual(self.pool.run(pow, 2, 3), 8)
+
+    def test_exception(self):
+        """
+        An exception raised by a task is raised by ``run`` and frees its
+        space in the pool.
+        """
+        pool = HashingPool(workers=1, queue_depth=0)
+        with self.assertRaises(ZeroDivisionError):
+            pool.run(divmod, 1, 0)
+        self.assertEqual(pool.run(pow, 2, 3), 8)
+        pool.shutdown()
+
+    def test_map(self):
+        """
+        ``map`` returns the results of calling a function on each item, in
+        order, even when there are more items than the pool has space for.
+        """
+        self.assertEqual(
+            list(self.pool.map(abs, range(-5, 0))),
+            [5, 4, 3, 2, 1],
+        )
+
+
+class PoolSizeTests(unittest.TestCase):
+    """
+    Tests for ``pool_size``.
+    """
+
+    def test_cores_shared(self):
+        """
+        The cores are shared between the processes, with at least one
+        worker in each.
+        """
+        self.assertEqual(pool_size(cpus=8, processes=2, threads=8)[0], 4)
+        self.assertEqual(pool_size(cpus=4, processes=9, threads=4)[0], 1)
+
+    def test_queue_below_threads(self):
+        """
+        Fewer tasks can run and wait than there are request threads, so that
+        a full pool refuses work.
+        """
+        workers, queue_depth = pool_size(cpus=4, processes=9, threads=4)
+        self.assertEqual(queue_depth, 2)
+        self.assertLess(workers + queue_depth, 4)
+
+    def test_workers_below_threads(self):
+        """
+        A process has fewer workers than request threads even if it has more
+        cores than that, so that a thread is left free when the pool is full.
+        """
+        self.assertEqual(pool_size(cpus=8, processes=1, threads=4), (3, 0))
+        self.assertEqual(pool_size(cpus=8, processes=1, threads=1), (1, 0))
@@ -0,0 +1,288 @@
+"""
+Tests for authentication.resilience.
+"""
+
+import threading
+import time
+import unittest
+
+from requests.exceptions import ConnectionError
+
+from authentication.resilience import (
+    BulkheadFull,
+    CircuitBreaker,
+    CircuitOpen,
+    LatencyWindow,
+    ResilientStorageBackend,
+)
+
+
+class FakeClock(object):
+    """
+    A clock which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowStorageBackend(object):
+    """
+    A storage backend whose calls wait until they are released, or fail.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+        self._lock = threading.Lock()
+
+    def get_user(self, email):
+        with self._lock:
+            self.calls.append(email)
+            number = len(self.calls)
+        if number == 1:
+            self.release.wait()
+        if self.fail:
+            raise ConnectionError('Storage is down.')
+        return {'email': email, 'password_hash': str(number)}
+
+    def create_user(self, email, password_hash):
+        with self._lock:
+            self.calls.append(email)
+        self.release.wait()
+        if self.fail:
+            raise ConnectionError('Storage is down.')
+        return True
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    """
+    Tests for ``CircuitBreaker``.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            failure_threshold=2, reset_timeout=10, clock=self.clock)
+
+    def test_closed(self):
+        """
+        Calls are allowed while there are fewer consecutive failures than
+        the threshold.
+        """
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_open(self):
+        """
+        Calls are refused after as many consecutive failures as the
+        threshold, until the reset timeout has passed.
+        """
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 9
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self):
+        """
+        After the reset timeout one trial call is allowed, and if it succeeds
+        the breaker is closed.
+        """
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 10
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_fails(self):
+        """
+        If the trial call fails, the breaker is opened again.
+        """
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 10
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.clock.now = 19
+        self.assertFalse(self.breaker.allow())
+
+    def test_disabled(self):
+        """
+        A breaker with a threshold of 0 is never opened.
+        """
+        breaker = CircuitBreaker(failure_threshold=0, reset_timeout=10)
+        for _ in range(100):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+
+class LatencyWindowTests(unittest.TestCase):
+    """
+    Tests for ``LatencyWindow``.
+    """
+
+    def test_percentile(self):
+        """
+        The nearest-rank percentile of the most recent latencies is given.
+        """
+        window = LatencyWindow(size=100, min_samples=1)
+        for latency in range(200):
+            window.observe(latency)
+        self.assertEqual(window.percentile(0.95), 194)
+
+    def test_too_few_samples(self):
+        """
+        There is no estimate until there are enough latencies.
+        """
+        window = LatencyWindow(min_samples=2)
+        window.observe(1)
+        self.assertIsNone(window.percentile(0.95))
+
+
+class ResilientStorageBackendTests(unittest.TestCase):
+    """
+    Tests for ``ResilientStorageBackend``.
+    """
+
+    def setUp(self):
+        self.storage = SlowStorageBackend()
+
+    def backend(self, **kwargs):
+        options = {
+            'backend': self.storage,
+            'max_in_flight': 1,
+            'breaker': CircuitBreaker(failure_threshold=2, reset_timeout=60),
+        }
+        options.update(kwargs)
+        return ResilientStorageBackend(**options)
+
+    def test_call(self):
+        """
+        Calls are passed on to the backend.
+        """
+        backend = self.backend()
+        self.assertEqual(backend.get_user(email='alice'),
+                         {'email': 'alice', 'password_hash': '1'})
+        self.assertEqual(backend.stats()['in_flight'], 0)
+
+    def test_bulkhead_full(self):
+        """
+        A call is refused while as many calls as are allowed are in flight.
+        """
+        backend = self.backend()
+        self.storage.release.clear()
+        thread = threading.Thread(
+            target=backend.create_user, args=('alice', 'hash'))
+        thread.start()
+        while not self.storage.calls:
+            time.sleep(0.001)
+
+        with self.assertRaises(BulkheadFull):
+            backend.get_user(email='bob')
+        self.assertEqual(backend.stats()['in_flight'], 1)
+
+        self.storage.release.set()
+        thread.join()
+        self.assertEqual(self.storage.calls, ['alice'])
+        self.assertEqual(backend.stats()['rejected_bulkhead_full'], 1)
+
+    def test_circuit_opens(self):
+        """
+        After repeated failures, calls are refused without reaching the
+        backend.
+        """
+        backend = self.backend()
+        self.storage.fail = True
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                backend.create_user(email='alice', password_hash='hash')
+        with self.assertRaises(CircuitOpen):
+            backend.create_user(email='alice', password_hash='hash')
+
+        self.assertEqual(len(self.storage.calls), 2)
+        stats = backend.stats()
+        self.assertEqual(stats['state'], 'open')
+        self.assertEqual(stats['failures'], 2)
+        self.assertEqual(stats['rejected_circuit_open'], 1)
+
+    def test_hedged_read(self):
+        """
+        A read which is slower than the hedge delay is sent again, and the
+        first result to arrive is used.
+        """
+        backend = self.backend(
+            max_in_flight=2, hedging=True, min_hedge_delay=0.01)
+        self.storage.release.clear()
+        try:
+            user = backend.get_user(email='alice')
+        finally:
+            self.storage.release.set()
+
+        self.assertEqual(user, {'email': 'alice', 'password_hash': '2'})
+        self.assertEqual(self.storage.calls, ['alice', 'alice'])
+        stats = backend.stats()
+        self.assertEqual(stats['hedges_sent'], 1)
+        self.assertEqual(stats['hedges_won'], 1)
+
+    def test_fast_read_not_hedged(self):
+        """
+        A read which finishes before the hedge delay is not sent again.
+        """
+        backend = self.backend(
+            max_in_flight=2, hedging=True, min_hedge_delay=5)
+        backend.get_user(email='alice')
+        self.assertEqual(self.storage.calls, ['alice'])
+        self.assertEqual(backend.stats()['hedges_sent'], 0)
+
+    def test_no_hedge_without_space(self):
+        """
+        A read is not sent again if there is no space in the bulkhead, and
+        the first result is waited for.
+        """
+        backend = self.backend(
+            max_in_flight=1, hedging=True, min_hedge_delay=0.01)
+        self.storage.release.clear()
+        threading.Timer(0.05, self.storage.release.set).start()
+        user = backend.get_user(email='alice')
+
+        self.assertEqual(user, {'email': 'alice', 'password_hash': '1'})
+        self.assertEqual(backend.stats()['hedges_sent'], 0)
+
+    def test_hedged_reads_fail(self):
+        """
+        If both a read and its duplicate fail, the error is raised.
+        """
+        backend = self.backend(
+            max_in_flight=2, hedging=True, min_hedge_delay=0.01)
+        self.storage.fail = True
+        self.storage.release.clear()
+        threading.Timer(0.05, self.storage.release.set).start()
+        with self.assertRaises(ConnectionError):
+            backend.get_user(email='alice')
+        self.assertEqual(backend.stats()['failures'], 2)
+
+    def test_writes_not_hedged(self):
+        """
+        Writes are never sent twice.
+        """
+        backend = self.backend(
+            max_in_flight=2, hedging=True, min_hedge_delay=0.01)
+        self.storage.release.clear()
+        threading.Timer(0.05, self.storage.release.set).start()
+        backend.create_user(email='alice', password_hash='hash')
+        self.assertEqual(self.storage.calls, ['alice'])
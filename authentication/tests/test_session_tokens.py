@@ -0,0 +1,108 @@
+"""
+Tests for authentication.session_tokens.
+"""
+
+import unittest
+
+from authentication.session_tokens import (
+    password_hash_fingerprint,
+    SessionTokens,
+)
+
+
+class FakeClock(object):
+    """
+    A clock which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SessionTokensTests(unittest.TestCase):
+    """
+    Tests for ``SessionTokens``.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tokens = SessionTokens(
+            secret_keys=['new', 'old'],
+            max_age=100,
+            revalidate_after=10,
+            clock=self.clock,
+        )
+
+    def test_issue_and_verify(self):
+        """
+        An issued token can be verified to give its claims.
+        """
+        token = self.tokens.issue(email='alice@example.com',
+                                  password_hash='hash')
+        self.assertEqual(self.tokens.verify(token), {
+            'email': 'alice@example.com',
+            'password': password_hash_fingerprint('hash'),
+            'expires': 1100.0,
+            'checked': 1000.0,
+        })
+
+    def test_expired(self):
+        """
+        A token is not accepted once it has expired.
+        """
+        token = self.tokens.issue(email='alice@example.com',
+                                  password_hash='hash')
+        self.clock.now += 100
+        self.assertIsNone(self.tokens.verify(token))
+
+    def test_tampered(self):
+        """
+        A token which has been changed is not accepted.
+        """
+        token = self.tokens.issue(email='alice@example.com',
+                                  password_hash='hash')
+        self.assertIsNone(self.tokens.verify('x' + token))
+
+    def test_rotated_key(self):
+        """
+        Tokens signed with any of the keys are accepted, and tokens signed
+        with other keys are not.
+        """
+        for secret_key, accepted in (('old', True), ('other', False)):
+            signer = SessionTokens(
+                secret_keys=[secret_key],
+                max_age=100,
+                revalidate_after=10,
+                clock=self.clock,
+            )
+            token = signer.issue(email='alice@example.com',
+                                 password_hash='hash')
+            self.assertEqual(self.tokens.verify(token) is not None, accepted)
+
+    def test_needs_revalidation(self):
+        """
+        A token needs revalidation once ``revalidate_after`` seconds have
+        passed since it was checked. Refreshing it resets this but not its
+        expiry.
+        """
+        token = self.tokens.issue(email='alice@example.com',
+                                  password_hash='hash')
+        claims = self.tokens.verify(token)
+        self.assertFalse(self.tokens.needs_revalidation(claims))
+
+        self.clock.now += 10
+        self.assertTrue(self.tokens.needs_revalidation(claims))
+
+        refreshed = self.tokens.verify(self.tokens.refresh(claims))
+        self.assertFalse(self.tokens.needs_revalidation(refreshed))
+        self.assertEqual(refreshed['expires'], claims['expires'])
+
+    def test_fingerprint_changes(self):
+        """
+        The fingerprint of a password hash changes with the hash.
+        """
+        self.assertNotEqual(password_hash_fingerprint('hash'),
+                            password_hash_fingerprint('other'))
@@ -0,0 +1,121 @@
+"""
+Tests for authentication.single_flight.
+"""
+
+import threading
+import time
+import unittest
+
+from authentication.single_flight import SingleFlight
+
+
+class BlockingFunction(object):
+    """
+    A function which waits until it is released and then returns how many
+    times it has been called, or raises ``error`` if one is set.
+    """
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.calls
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out.')
+        time.sleep(0.001)
+
+
+class SingleFlightTests(unittest.TestCase):
+    """
+    Tests for ``SingleFlight``.
+    """
+
+    def setUp(self):
+        self.flight = SingleFlight()
+
+    def call_concurrently(self, key, function, callers):
+        """
+        Call ``function`` through the single flight from ``callers``
+        threads at once, and release it once they are all waiting.
+
+        :return: The result or exception of each caller.
+        """
+        outcomes = []
+        lock = threading.Lock()
+
+        def caller():
+            try:
+                outcome = self.flight.do(key, function)
+            except Exception as error:
+                outcome = error
+            with lock:
+                outcomes.append(outcome)
+
+        threads = [threading.Thread(target=caller) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        wait_for(lambda: self.flight.stats()['collapsed'] == callers - 1)
+        function.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_shared_result(self):
+        """
+        Concurrent callers with the same key share one call and its result.
+        """
+        function = BlockingFunction()
+        outcomes = self.call_concurrently('alice', function, callers=5)
+        self.assertEqual(outcomes, [1] * 5)
+        self.assertEqual(function.calls, 1)
+        self.assertEqual(
+            self.flight.stats(),
+            {'in_flight': 0, 'executed': 1, 'collapsed': 4})
+
+    def test_shared_error(self):
+        """
+        If the shared call raises an exception, every caller gets it.
+        """
+        error = ValueError('Storage is down.')
+        function = BlockingFunction(error=error)
+        outcomes = self.call_concurrently('alice', function, callers=3)
+        self.assertEqual(outcomes, [error] * 3)
+        self.assertEqual(function.calls, 1)
+
+    def test_not_cached(self):
+        """
+        Once a call has finished, the next caller makes a new call.
+        """
+        function = BlockingFunction()
+        function.release.set()
+        self.assertEqual(self.flight.do('alice', function), 1)
+        self.assertEqual(self.flight.do('alice', function), 2)
+        self.assertEqual(self.flight.stats()['collapsed'], 0)
+
+    def test_different_keys(self):
+        """
+        Callers with different keys do not share calls.
+        """
+        function = BlockingFunction()
+        function.release.set()
+        self.flight.do('alice', function)
+        self.flight.do('bob', function)
+        self.assertEqual(function.calls, 2)
+
+    def test_arguments(self):
+        """
+        The function is called with the given arguments.
+        """
+        self.assertEqual(
+            self.flight.do('numbers', sorted, [1, 3], reverse=True), [3, 1])
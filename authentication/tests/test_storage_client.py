@@ -0,0 +1,88 @@
+"""
+Tests for authentication.storage_client.
+"""
+
+import unittest
+
+from requests import codes
+import responses
+
+from authentication.storage_client import StorageClient
+
+
+class StorageClientTests(unittest.TestCase):
+    """
+    Tests for ``StorageClient``.
+    """
+
+    def setUp(self):
+        self.client = StorageClient(
+            base_url='http://storage:5001',
+            pool_size=3,
+            connect_timeout=0.5,
+            read_timeout=2,
+            retries=4,
+        )
+
+    def tearDown(self):
+        self.client.close()
+
+    @responses.activate
+    def test_request_url(self):
+        """
+        Requests are made to paths relative to the base URL, with a JSON
+        Content-Type.
+        """
+        responses.add(responses.GET, 'http://storage:5001/users/alice',
+                      body='{}', status=codes.OK)
+        response = self.client.get('users/alice')
+        self.assertEqual(response.status_code, codes.OK)
+        request = responses.calls[0].request
+        self.assertEqual(request.url, 'http://storage:5001/users/alice')
+        self.assertEqual(request.headers['Content-Type'], 'application/json')
+
+    def test_one_pool_shared(self):
+        """
+        HTTP and HTTPS requests share one adapter, which has a pool of the
+        given size.
+        """
+        adapter = self.client.session.get_adapter('http://storage:5001')
+        self.assertIs(
+            adapter, self.client.session.get_adapter('https://storage:5001'))
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    def test_retries(self):
+        """
+        Only reads are retried if the storage service has been reached.
+        """
+        adapter = self.client.session.get_adapter('http://storage:5001')
+        retry = adapter.max_retries
+        self.assertEqual(retry.total, 4)
+        # ``allowed_methods`` was called ``method_whitelist`` before urllib3
+        # 1.26.
+        methods = getattr(retry, 'allowed_methods', None)
+        if methods is None:
+            methods = retry.method_whitelist
+        self.assertIn('GET', methods)
+        self.assertNotIn('POST', methods)
+
+    def test_default_timeout(self):
+        """
+        Requests are given the default connect and read timeouts unless
+        another timeout is given.
+        """
+        timeouts = []
+
+        def send(request, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            raise RuntimeError()
+
+        adapter = self.client.session.get_adapter('http://storage:5001')
+        adapter.send = send
+
+        with self.assertRaises(RuntimeError):
+            self.client.get('users')
+        with self.assertRaises(RuntimeError):
+            self.client.delete('users/alice', timeout=10)
+
+        self.assertEqual(timeouts, [(0.5, 2), 10])
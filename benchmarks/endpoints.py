@@ -0,0 +1,386 @@
+"""
+Benchmark throughput and latency of the authentication service's endpoints.
+
+By default this runs the authentication service in process, with requests to
+the storage service routed to an in memory storage service in the same way as
+the tests do. With ``--url`` and ``--storage-url`` it sends requests over real
+sockets to running services instead.
+
+Run with, for example::
+
+    python benchmarks/endpoints.py --users 1000 10000 --output results.json
+    python benchmarks/endpoints.py --baseline results.json
+
+Requests are only sent from several threads, with ``--concurrency``, to
+running services. Users are stored with password hashes made with the work
+factor configured here, by ``BCRYPT_LOG_ROUNDS`` or ``BCRYPT_TARGET_SECONDS``,
+which should match the running authentication service's.
+"""
+
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import sys
+import threading
+import time
+
+import bcrypt
+import requests
+import responses
+
+from authentication.authentication import app
+from authentication.tests.test_authentication import AuthenticationTests
+from storage.storage import app as storage_app, create_users
+
+PASSWORD = 'secret'
+
+SCENARIOS = ['signup', 'login', 'status_cookie', 'status_token', 'delete']
+
+# ``time.perf_counter`` is more precise, but is not available on Python 2.
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class InProcessClient(object):
+    """
+    Send requests to the authentication service in this process.
+    """
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(
+            path,
+            method=method,
+            content_type='application/json',
+            data=data)
+        return response.status_code
+
+    def use_only_remember_token(self):
+        """
+        Forget any session, so that only the remember token identifies the
+        user.
+        """
+        jar = self.client.cookie_jar
+        token = [
+            cookie.value for cookie in jar
+            if cookie.name == 'remember_token'][0]
+        jar.clear()
+        self.client.set_cookie('localhost', 'remember_token', token)
+
+
+class HTTPClient(object):
+    """
+    Send requests to a running authentication service.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def request(self, method, path, data=None):
+        response = self.session.request(method, self.url + path, data=data)
+        return response.status_code
+
+    def use_only_remember_token(self):
+        token = self.session.cookies['remember_token']
+        self.session.cookies.clear()
+        self.session.cookies.set('remember_token', token)
+
+
+class InProcessStorage(object):
+    """
+    An in memory storage service which the authentication service reaches
+    through mocked ``requests``, as in the tests.
+    """
+
+    def __init__(self):
+        self.wiring = AuthenticationTests(methodName='request_callback')
+
+    def start(self):
+        self.wiring.setUp()
+        responses.start()
+
+    def stop(self):
+        responses.stop()
+        responses.reset()
+        self.wiring.tearDown()
+
+    def add_users(self, users):
+        with storage_app.app_context():
+            create_users(records=users)
+
+
+class HTTPStorage(object):
+    """
+    A running storage service.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def add_users(self, users):
+        requests.post(
+            self.url + '/users/batch',
+            headers={'Content-Type': 'application/json'},
+            data=json.dumps({'users': users}),
+        ).raise_for_status()
+
+
+def percentile(sorted_values, fraction):
+    """
+    :return: The nearest-rank percentile of some sorted values.
+    """
+    if not sorted_values:
+        return None
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def user_data(email):
+    return json.dumps({'email': email, 'password': PASSWORD})
+
+
+def run_scenario(scenario, make_client, size, operations, concurrency):
+    """
+    Time ``operations`` requests for a scenario, spread over ``concurrency``
+    threads which each have their own client.
+
+    :return: Throughput and latency percentiles for the scenario.
+    """
+    per_thread = operations // concurrency
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    # Each thread says when it is ready, and then waits for all of them to
+    # be ready before timing requests.
+    ready = threading.Semaphore(0)
+    start = threading.Event()
+
+    def worker(thread_index):
+        try:
+            client = make_client()
+            requests_to_time = []
+            for index in range(per_thread):
+                number = thread_index * per_thread + index
+                if scenario == 'signup':
+                    email = 'signup{number}@example.com'.format(
+                        number=number)
+                    requests_to_time.append(
+                        ('POST', '/signup', user_data(email)))
+                elif scenario == 'login':
+                    email = 'user{number}@example.com'.format(
+                        number=random.randrange(size))
+                    requests_to_time.append(
+                        ('POST', '/login', user_data(email)))
+                elif scenario in ('status_cookie', 'status_token'):
+                    requests_to_time.append(('GET', '/status', None))
+                elif scenario == 'delete':
+                    email = 'delete{number}@example.com'.format(
+                        number=number)
+                    requests_to_time.append(
+                        ('DELETE', '/users/' + email, None))
+
+            if scenario in ('status_cookie', 'status_token'):
+                email = 'user{number}@example.com'.format(
+                    number=random.randrange(size))
+                status_code = client.request(
+                    'POST', '/login', user_data(email))
+                if status_code != 200:
+                    raise RuntimeError(
+                        'Logging in before timing {scenario} failed with '
+                        'status {status_code}.'.format(
+                            scenario=scenario, status_code=status_code))
+                if scenario == 'status_token':
+                    client.use_only_remember_token()
+        finally:
+            # The main thread waits for every thread to be ready, so a thread
+            # which fails must still say so. Its error is raised by
+            # ``future.result()``.
+            ready.release()
+
+        timings = []
+        failures = 0
+        start.wait()
+        for method, path, data in requests_to_time:
+            started = clock()
+            status_code = client.request(method, path, data)
+            timings.append(clock() - started)
+            if status_code >= 300:
+                failures += 1
+
+        with lock:
+            latencies.extend(timings)
+            errors.append(failures)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(worker, thread_index)
+            for thread_index in range(concurrency)]
+        for _ in range(concurrency):
+            ready.acquire()
+        started = clock()
+        start.set()
+        for future in futures:
+            future.result()
+        elapsed = clock() - started
+
+    latencies.sort()
+    result = {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+    }
+    for name, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95),
+                           ('p99_ms', 0.99)):
+        value = percentile(latencies, fraction)
+        result[name] = None if value is None else value * 1000
+    return result
+
+
+def run(storage, make_client, size, operations, concurrency):
+    """
+    Run every scenario against a user table with ``size`` users.
+
+    :return: The results of each scenario.
+    """
+    storage.start()
+    try:
+        # Users are given hashes with the configured work factor, so that
+        # logging in does not replace them.
+        password_hash = bcrypt.hashpw(
+            PASSWORD.encode('utf8'),
+            bcrypt.gensalt(rounds=app.config['BCRYPT_LOG_ROUNDS']),
+        ).decode('utf8')
+        for prefix, count in (('user', size), ('delete', operations)):
+            storage.add_users([
+                {'email': '{prefix}{number}@example.com'.format(
+                    prefix=prefix, number=number),
+                 'password_hash': password_hash}
+                for number in range(count)])
+
+        return {
+            scenario: run_scenario(
+                scenario=scenario,
+                make_client=make_client,
+                size=size,
+                operations=operations,
+                concurrency=concurrency,
+            )
+            for scenario in SCENARIOS}
+    finally:
+        storage.stop()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how results differ from a baseline.
+
+    :return: Whether any throughput fell by more than ``tolerance``.
+    """
+    regressed = False
+    for size, scenarios in sorted(results.items()):
+        for scenario, result in sorted(scenarios.items()):
+            base = baseline.get(size, {}).get(scenario)
+            if (base is None or not base['requests_per_second'] or
+                    base['p99_ms'] is None or result['p99_ms'] is None):
+                continue
+            ratio = result['requests_per_second'] / base['requests_per_second']
+            flag = ''
+            if ratio < 1 - tolerance:
+                regressed = True
+                flag = '  REGRESSION'
+            print('{size:>10} {scenario:<14} {ratio:6.2f}x requests/s, '
+                  'p99 {base_p99:.2f}ms -> {p99:.2f}ms{flag}'.format(
+                      size=size, scenario=scenario, ratio=ratio,
+                      base_p99=base['p99_ms'], p99=result['p99_ms'],
+                      flag=flag),
+                  file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000],
+                        help='Sizes of the user table to benchmark with.')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Requests to time for each scenario.')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--url', help='URL of a running authentication '
+                        'service. Requires --storage-url.')
+    parser.add_argument('--storage-url', help='URL of a running storage '
+                        'service with an empty database.')
+    parser.add_argument('--output', help='File to write JSON results to.')
+    parser.add_argument('--baseline', help='JSON results to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fraction by which throughput may fall before '
+                        'it is reported as a regression.')
+    args = parser.parse_args()
+    if bool(args.url) != bool(args.storage_url):
+        parser.error('--url and --storage-url must be given together.')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1.')
+    if args.concurrency > 1 and not args.url:
+        # Requests to the in memory storage service are routed through
+        # ``responses`` and one in memory SQLite database, which are not
+        # safe to use from several threads.
+        parser.error('--concurrency above 1 needs --url and --storage-url.')
+    if args.requests < args.concurrency:
+        parser.error('--requests must be at least --concurrency, so that '
+                     'each thread makes a request.')
+
+    if args.url:
+        storage = HTTPStorage(url=args.storage_url)
+
+        def make_client():
+            return HTTPClient(url=args.url)
+    else:
+        storage = InProcessStorage()
+        make_client = InProcessClient
+
+    results = {}
+    for size in args.users:
+        results[str(size)] = run(
+            storage=storage,
+            make_client=make_client,
+            size=size,
+            operations=args.requests,
+            concurrency=args.concurrency,
+        )
+        if args.url:
+            # Users cannot be removed in bulk from a running service, so a
+            # service can only be benchmarked with one table size.
+            break
+
+    output = {
+        'config': {
+            'mode': 'http' if args.url else 'inprocess',
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    print(json.dumps(output, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmark read throughput of the storage service with different numbers of
+replica databases.
+
+Reads are routed as for ``GET`` requests to the storage service: each read
+goes to a randomly chosen replica. By default the primary and replicas are
+SQLite files in a temporary directory, with each replica a copy of the
+primary. These share one disk and one process, so they mostly show the cost
+of routing. With ``--primary`` and ``--replica`` the databases are ones which
+are already running, such as local Postgres instances with replication set
+up and users already created, and throughput should grow with the number of
+replicas.
+
+Run with, for example::
+
+    python benchmarks/replicas.py --replicas 0 1 2 4 --concurrency 8
+    python benchmarks/replicas.py --primary postgres://localhost:5432/users \\
+        --replica postgres://localhost:5433/users \\
+        --replica postgres://localhost:5434/users --replicas 0 1 2
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from storage.storage import create_app, create_users, db, User
+
+
+def populate(directory, users, replicas):
+    """
+    Create a SQLite primary database with users, and copies of it.
+
+    :return: The location of the primary and of each replica.
+    """
+    path = os.path.join(directory, 'primary.db')
+    # Write-ahead logging is turned off so that the whole database is in the
+    # one file which is copied.
+    app = create_app(
+        database_uri='sqlite:///' + path,
+        config={'SQLITE_JOURNAL_MODE': 'DELETE'},
+    )
+    with app.app_context():
+        create_users(records=[
+            {'email': 'user{index}@example.com'.format(index=index),
+             'password_hash': 'hash'}
+            for index in range(users)])
+        db.get_engine(app).dispose()
+
+    replica_uris = []
+    for index in range(replicas):
+        replica_path = os.path.join(
+            directory, 'replica{index}.db'.format(index=index))
+        shutil.copy(path, replica_path)
+        replica_uris.append('sqlite:///' + replica_path)
+    return 'sqlite:///' + path, replica_uris
+
+
+def run(primary_uri, replica_uris, users, concurrency, seconds):
+    """
+    Read random users from ``concurrency`` threads for ``seconds``.
+
+    :return: Reads per second.
+    """
+    app = create_app(database_uri=primary_uri, replica_uris=replica_uris)
+    counts = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def reader():
+        done = 0
+        while not stop.is_set():
+            email = 'user{index}@example.com'.format(
+                index=random.randrange(users))
+            with app.test_request_context(method='GET'):
+                # This chooses a replica as for a request.
+                app.preprocess_request()
+                User.query.filter_by(email=email).first()
+                db.session.remove()
+            done += 1
+        with lock:
+            counts.append(done)
+
+    threads = [threading.Thread(target=reader) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        for bind in [None] + app.config['REPLICA_BINDS']:
+            db.get_engine(app, bind=bind).dispose()
+
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--replicas', type=int, nargs='+', default=[0, 1, 2],
+                        help='Numbers of replicas to benchmark with.')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--primary', help='URI of a running primary '
+                        'database with at least --users users.')
+    parser.add_argument('--replica', action='append', default=[],
+                        help='URI of a running replica of --primary. Give '
+                        'this once for each replica.')
+    args = parser.parse_args()
+
+    results = {}
+    for replicas in args.replicas:
+        directory = tempfile.mkdtemp()
+        try:
+            if args.primary:
+                primary_uri = args.primary
+                replica_uris = args.replica[:replicas]
+            else:
+                primary_uri, replica_uris = populate(
+                    directory=directory, users=args.users, replicas=replicas)
+            results[str(len(replica_uris))] = {
+                'reads_per_second': run(
+                    primary_uri=primary_uri,
+                    replica_uris=replica_uris,
+                    users=args.users,
+                    concurrency=args.concurrency,
+                    seconds=args.seconds,
+                ),
+            }
+        finally:
+            shutil.rmtree(directory)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
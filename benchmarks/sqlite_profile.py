@@ -0,0 +1,143 @@
+"""
+Benchmark concurrent reads and writes against a SQLite file with and without
+the storage service's engine profile.
+
+Without the profile, SQLite uses a rollback journal and readers wait for
+writers. With it, write-ahead logging lets readers continue while there is a
+writer.
+
+Run with, for example::
+
+    python benchmarks/sqlite_profile.py --readers 8 --writers 2 --seconds 5
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from storage.storage import create_app, db, User
+
+# SQLite's own defaults, with tracked modifications as before the profile.
+DEFAULT_CONFIG = {
+    'SQLALCHEMY_TRACK_MODIFICATIONS': True,
+    'SQLITE_JOURNAL_MODE': 'DELETE',
+    'SQLITE_SYNCHRONOUS': 'FULL',
+    'SQLITE_MMAP_SIZE': None,
+    'SQLITE_BUSY_TIMEOUT': None,
+}
+
+
+def run(config, users, readers, writers, seconds):
+    """
+    Run reader and writer threads against a new database for ``seconds``.
+
+    :return: Reads and writes per second, and the number of operations which
+        failed because the database was locked.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        app = create_app(
+            database_uri='sqlite:///' + os.path.join(directory, 'users.db'),
+            config=config,
+        )
+        with app.app_context():
+            for start in range(0, users, 1000):
+                db.session.add_all([
+                    User(email='user{index}@example.com'.format(index=index),
+                         password_hash='hash')
+                    for index in range(start, min(start + 1000, users))])
+                db.session.commit()
+
+        counts = {'reads': 0, 'writes': 0, 'locked': 0}
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def reader():
+            done = 0
+            locked = 0
+            with app.app_context():
+                while not stop.is_set():
+                    email = 'user{index}@example.com'.format(
+                        index=random.randrange(users))
+                    try:
+                        User.query.filter_by(email=email).first()
+                        done += 1
+                    except OperationalError:
+                        locked += 1
+                    db.session.remove()
+            with lock:
+                counts['reads'] += done
+                counts['locked'] += locked
+
+        def writer(number):
+            done = 0
+            locked = 0
+            with app.app_context():
+                while not stop.is_set():
+                    email = 'writer{number}-{index}@example.com'.format(
+                        number=number, index=done + locked)
+                    try:
+                        db.session.add(User(email=email, password_hash='hash'))
+                        db.session.commit()
+                        done += 1
+                    except OperationalError:
+                        db.session.rollback()
+                        locked += 1
+                    db.session.remove()
+            with lock:
+                counts['writes'] += done
+                counts['locked'] += locked
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        threads += [
+            threading.Thread(target=writer, args=(number,))
+            for number in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+        return {
+            'reads_per_second': counts['reads'] / seconds,
+            'writes_per_second': counts['writes'] / seconds,
+            'locked': counts['locked'],
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for name, config in (('default', DEFAULT_CONFIG), ('profile', {})):
+        results[name] = run(
+            config=config,
+            users=args.users,
+            readers=args.readers,
+            writers=args.writers,
+            seconds=args.seconds,
+        )
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark looking up a user from a remember token in the storage service.
+
+This shows that ``GET /tokens/<fingerprint>`` does not get slower as the
+number of users grows.
+
+Run with, for example::
+
+    python benchmarks/token_lookup.py --sizes 1000 10000 100000 1000000
+"""
+
+import argparse
+import json
+import random
+import time
+
+from storage.storage import app, db, token_fingerprint, User
+
+# ``time.perf_counter`` is more precise, but is not available on Python 2.
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def populate(count, start=0, chunk_size=10000):
+    """
+    Add users to the storage database in bulk.
+
+    :param count: The number of users to add.
+    :param start: The number of users which already exist.
+    :param chunk_size: The number of users to insert per transaction.
+    """
+    for chunk_start in range(start, start + count, chunk_size):
+        rows = []
+        for index in range(chunk_start,
+                           min(chunk_start + chunk_size, start + count)):
+            email = 'user{index}@example.com'.format(index=index)
+            password_hash = 'hash{index}'.format(index=index)
+            rows.append({
+                'email': email,
+                'password_hash': password_hash,
+                'token_fingerprint': token_fingerprint(email, password_hash),
+            })
+        db.session.execute(User.__table__.insert(), rows)
+        db.session.commit()
+
+
+def time_lookups(client, count, lookups):
+    """
+    :return: The median time in seconds of ``lookups`` token lookups for
+        random users out of ``count`` users.
+    """
+    timings = []
+    for _ in range(lookups):
+        index = random.randrange(count)
+        fingerprint = token_fingerprint(
+            'user{index}@example.com'.format(index=index),
+            'hash{index}'.format(index=index),
+        )
+        started = clock()
+        response = client.get(
+            '/tokens/{fingerprint}'.format(fingerprint=fingerprint),
+            content_type='application/json',
+        )
+        timings.append(clock() - started)
+        assert response.status_code == 200
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--lookups', type=int, default=500)
+    args = parser.parse_args()
+
+    client = app.test_client()
+    results = []
+    existing = 0
+    with app.app_context():
+        db.create_all()
+        for size in sorted(args.sizes):
+            populate(count=size - existing, start=existing)
+            existing = size
+            median = time_lookups(client, size, args.lookups)
+            results.append({'users': size, 'median_seconds': median})
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark the cost of validating one request body against each schema.
+
+Each schema of both services is timed three ways: with
+``jsonschema.validate``, which ``flask_jsonschema`` calls on every request,
+with a compiled ``jsonschema`` validator, and with ``CompiledSchema`` as used
+by ``instrumentation.validation``, which takes a fast path for simple
+schemas.
+
+Run with, for example::
+
+    python benchmarks/validation.py --number 10000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import timeit
+
+import jsonschema
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from instrumentation.validation import CompiledSchema
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA_FILES = {
+    'authentication': os.path.join(ROOT, 'authentication', 'schemas'),
+    'storage': os.path.join(ROOT, 'storage', 'schemas'),
+}
+
+USER = {
+    'email': 'alice@example.com',
+    'password': 'secret',
+    'password_hash': '$2b$12$' + 'x' * 53,
+}
+
+
+# A valid request body for each schema, by schema name. Add one here for
+# each new schema.
+BODIES = {
+    'create': USER,
+    'get': USER,
+    'update': USER,
+    'batch_create': {'users': [dict(USER) for _ in range(10)]},
+    'lookup': {
+        'emails': ['user{index}@example.com'.format(index=index)
+                   for index in range(10)],
+    },
+    'record_logins': {
+        'logins': [
+            {'email': 'user{index}@example.com'.format(index=index),
+             'count': 1, 'last_login': 1500000000.0}
+            for index in range(10)],
+    },
+}
+
+
+def body(name):
+    """
+    :return: A valid request body for the schema called ``name``.
+    :raises KeyError: There is no body for the schema in ``BODIES``.
+    """
+    try:
+        return BODIES[name]
+    except KeyError:
+        raise KeyError(
+            'No request body for the schema "{name}". Add one to '
+            'BODIES.'.format(name=name))
+
+
+def compiled_jsonschema(schema):
+    validator = validator_for(schema)(schema)
+
+    def validate(instance):
+        error = best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise error
+    return validate
+
+
+def time_per_call(function, instance, number):
+    """
+    :return: Microseconds per call of ``function(instance)``.
+    """
+    seconds = timeit.timeit(lambda: function(instance), number=number)
+    return seconds / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Validations to time for each schema and way.')
+    args = parser.parse_args()
+
+    results = {}
+    for service, directory in sorted(SCHEMA_FILES.items()):
+        for filename in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, filename)) as schema_file:
+                schemas = json.load(schema_file)
+            for name, schema in sorted(schemas.items()):
+                instance = body(name)
+                key = '{service}/{file}/{name}'.format(
+                    service=service, file=filename.split('.')[0], name=name)
+                results[key] = {
+                    'jsonschema_validate_us': time_per_call(
+                        lambda instance: jsonschema.validate(
+                            instance, schema),
+                        instance, args.number),
+                    'compiled_jsonschema_us': time_per_call(
+                        compiled_jsonschema(schema), instance, args.number),
+                    'compiled_schema_us': time_per_call(
+                        CompiledSchema(schema=schema).validate, instance,
+                        args.number),
+                }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Benchmark how throughput grows with the number of worker processes.
+
+For each number of workers this starts the storage service with
+``python -m storage.serve``, and for the authentication service also
+``python -m authentication.serve``, on a SQLite database in a temporary
+directory. Client processes then send requests for ``--seconds``. The storage
+service is benchmarked with ``GET /users/<email>`` and the authentication
+service with ``GET /status`` using session tokens, as neither of these waits
+on bcrypt. Throughput should grow with the number of workers up to about the
+number of cores, less those used by the clients.
+
+Run with, for example::
+
+    python benchmarks/workers.py --workers 1 2 4 8 --clients 4
+    python benchmarks/workers.py --service authentication --workers 1 2 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+STORAGE_PORT = 5601
+AUTHENTICATION_PORT = 5600
+HEADERS = {'Content-Type': 'application/json'}
+
+
+def start_server(module, port, workers, environment):
+    """
+    Start a service and wait until it responds.
+
+    :return: The server process.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-m', module,
+         '--bind', '127.0.0.1:{port}'.format(port=port),
+         '--workers', str(workers)],
+        env=dict(os.environ, **environment),
+    )
+    url = 'http://127.0.0.1:{port}/metrics'.format(port=port)
+    for _ in range(100):
+        try:
+            requests.get(url)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('{module} did not start.'.format(module=module))
+
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+
+def client(service, users, seconds, results):
+    """
+    Send requests to one service until ``seconds`` have passed, and put the
+    number of successful requests in ``results``.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    if service == 'storage':
+        url = 'http://127.0.0.1:{port}/users/'.format(port=STORAGE_PORT)
+
+        def send():
+            email = 'user{index}@example.com'.format(
+                index=random.randrange(users))
+            return session.get(url + email)
+    else:
+        url = 'http://127.0.0.1:{port}'.format(port=AUTHENTICATION_PORT)
+        email = 'client{pid}@example.com'.format(pid=os.getpid())
+        session.post(url + '/signup', data=json.dumps(
+            {'email': email, 'password': 'secret'}))
+        response = session.post(url + '/login', data=json.dumps(
+            {'email': email, 'password': 'secret'}))
+        session.headers['Authorization'] = (
+            'Bearer ' + response.json()['token'])
+
+        def send():
+            return session.get(url + '/status')
+
+    done = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if send().status_code == requests.codes.OK:
+            done += 1
+    results.put(done)
+
+
+def run(service, workers, users, clients, seconds):
+    """
+    Start the services with ``workers`` worker processes each and measure
+    throughput.
+
+    :return: Requests per second.
+    """
+    directory = tempfile.mkdtemp()
+    environment = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+            directory, 'users.db'),
+        'STORAGE_URL': 'http://127.0.0.1:{port}'.format(port=STORAGE_PORT),
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'secret'),
+        'SESSION_TOKENS': 'true',
+        'BCRYPT_LOG_ROUNDS': '4',
+    }
+    servers = []
+    try:
+        servers.append(start_server(
+            module='storage.serve', port=STORAGE_PORT,
+            workers=workers, environment=environment))
+        requests.post(
+            'http://127.0.0.1:{port}/users/batch'.format(port=STORAGE_PORT),
+            headers=HEADERS,
+            data=json.dumps({'users': [
+                {'email': 'user{index}@example.com'.format(index=index),
+                 'password_hash': 'hash'}
+                for index in range(users)]}),
+        ).raise_for_status()
+        if service == 'authentication':
+            servers.append(start_server(
+                module='authentication.serve', port=AUTHENTICATION_PORT,
+                workers=workers, environment=environment))
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=client, args=(service, users, seconds, results))
+            for _ in range(clients)]
+        for process in processes:
+            process.start()
+        done = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return done / float(seconds)
+    finally:
+        for server in reversed(servers):
+            stop_server(server)
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--service', choices=['storage', 'authentication'],
+                        default='storage')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of worker processes to benchmark.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--clients', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Client processes sending requests.')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for workers in args.workers:
+        results[str(workers)] = {
+            'requests_per_second': run(
+                service=args.service,
+                workers=workers,
+                users=args.users,
+                clients=args.clients,
+                seconds=args.seconds,
+            ),
+        }
+
+    print(json.dumps({
+        'config': {
+            'service': args.service,
+            'clients': args.clients,
+            'cores': multiprocessing.cpu_count(),
+        },
+        'results': results,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
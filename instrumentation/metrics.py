@@ -0,0 +1,493 @@
+"""
+Lightweight metrics, published in the Prometheus text format.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/.
+
+Metrics are kept in memory in each process. When an application is served by
+several worker processes, each can write its metrics to a directory which
+they share, so that whichever worker is asked for metrics publishes those of
+all of them. See ``Registry``.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import errno
+import json
+import os
+import threading
+import time
+
+from flask import g, make_response, request
+
+# Request latencies in seconds, from a fast cached lookup to a slow login.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    """
+    :return: Labels in the form ``{name="value",...}``, or an empty string if
+        there are no labels.
+    """
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{name}="{value}"'.format(
+            name=name,
+            value=str(value).replace('\\', r'\\').replace('"', r'\"'),
+        ) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    """
+    A metric with a value for each combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def snapshot(self):
+        """
+        :return: The metric's description and values, which can be encoded
+            as JSON.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            values = [
+                [list(key), list(value) if isinstance(value, list) else value]
+                for key, value in self._values.items()]
+        return {
+            'name': self.name,
+            'documentation': self.documentation,
+            'kind': self.kind,
+            'labelnames': list(self.labelnames),
+            'values': values,
+        }
+
+    def header(self):
+        return [
+            '# HELP {name} {documentation}'.format(
+                name=self.name, documentation=self.documentation),
+            '# TYPE {name} {kind}'.format(name=self.name, kind=self.kind),
+        ]
+
+
+class Counter(_Metric):
+    """
+    A value which only goes up.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """
+        Set the value, for a total which is counted elsewhere.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            self.name + _format_labels(self.labelnames, key) + ' ' +
+            _format_value(value) for key, value in values]
+
+
+class Gauge(Counter):
+    """
+    A value which can go up and down.
+    """
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Counts of observations in cumulative buckets, with their sum.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    def observe(self, value, **labels):
+        """
+        Record an observation.
+
+        :param value: The observed value, usually a number of seconds.
+        :type value: float
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the +Inf bucket, then the sum.
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the number of seconds taken by a block of code.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def timed(self, function, **labels):
+        """
+        :return: A function which calls ``function`` and observes the number
+            of seconds that it takes.
+        """
+        def timed_function(*args, **kwargs):
+            with self.time(**labels):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def render(self):
+        with self._lock:
+            values = sorted(
+                (key, list(counts)) for key, counts in self._values.items())
+
+        lines = self.header()
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(
+                    self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append(
+                    self.name + '_bucket' +
+                    _format_labels(self.labelnames, key,
+                                   [('le', _format_value(bound))]) +
+                    ' ' + str(cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append(
+                self.name + '_sum' + labels + ' ' + _format_value(counts[-1]))
+            lines.append(self.name + '_count' + labels + ' ' + str(cumulative))
+        return lines
+
+
+def _process_exists(pid):
+    """
+    :return: Whether there is a process with the given ID.
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _merge(snapshots):
+    """
+    Combine the metrics of several processes.
+
+    Counters and histograms are summed. Gauges, such as the number of
+    requests in flight or the size of a cache, describe one process, so each
+    process's values are given with a ``worker`` label, and only for
+    processes which still exist.
+
+    :param snapshots: Tuples of a worker's ID, whether it still exists and
+        the snapshots of its metrics.
+    :return: Metrics with the combined values.
+    :rtype: list
+    """
+    merged = OrderedDict()
+    for worker, alive, metric_snapshots in snapshots:
+        for snapshot in metric_snapshots:
+            gauge = snapshot['kind'] == Gauge.kind
+            if gauge and not alive:
+                continue
+            metric = merged.get(snapshot['name'])
+            if metric is None:
+                labelnames = snapshot['labelnames'] + (
+                    ['worker'] if gauge else [])
+                if snapshot['kind'] == Histogram.kind:
+                    metric = Histogram(
+                        snapshot['name'], snapshot['documentation'],
+                        labelnames, buckets=snapshot['buckets'])
+                else:
+                    kind = Gauge if gauge else Counter
+                    metric = kind(
+                        snapshot['name'], snapshot['documentation'],
+                        labelnames)
+                merged[snapshot['name']] = metric
+            for key, value in snapshot['values']:
+                key = tuple(key) + ((worker,) if gauge else ())
+                existing = metric._values.get(key)
+                if existing is None:
+                    metric._values[key] = value
+                elif isinstance(value, list):
+                    metric._values[key] = [
+                        total + count for total, count in zip(existing, value)]
+                else:
+                    metric._values[key] = existing + value
+    return list(merged.values())
+
+
+class Registry(object):
+    """
+    A collection of metrics to publish together.
+
+    With a ``directory``, each process which uses the registry writes its
+    metrics to a file there every ``sync_interval`` seconds once
+    ``start_sync`` is called, and publishes the combined metrics of every
+    process which has written there. This is for worker processes forked
+    from one process which made the registry, so that metrics do not depend
+    on which worker answers. The published values of other workers are up
+    to ``sync_interval`` seconds old.
+    """
+
+    def __init__(self, directory=None, sync_interval=5):
+        """
+        :param directory: A directory to share metrics between processes
+            through, or ``None`` to publish only this process's metrics. It
+            should be empty when the first process starts, as files left
+            from other runs are included.
+        :type directory: string
+        :param sync_interval: The number of seconds between writes of this
+            process's metrics to ``directory``.
+        :type sync_interval: float
+        """
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self._metrics = []
+        self._collectors = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def counter(self, *args, **kwargs):
+        return self._add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._add(Histogram(*args, **kwargs))
+
+    def _add(self, metric):
+        # Adding a metric which is already here, for example when several
+        # applications are instrumented with one registry, gives the existing
+        # one, so that each metric is published once.
+        for existing in self._metrics:
+            if (existing.name == metric.name and
+                    type(existing) is type(metric)):
+                return existing
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Add a function which is called whenever metrics are published, for
+        values which are kept elsewhere.
+
+        :param collector: A function which takes no arguments and returns
+            metrics, for example ``Gauge`` objects with values set.
+        :return: ``collector``, so that this can be used as a decorator.
+        """
+        self._collectors.append(collector)
+        return collector
+
+    def _collect(self):
+        """
+        :return: This process's metrics, including those from collectors.
+        :rtype: list
+        """
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def write_snapshot(self):
+        """
+        Write this process's metrics to the ``directory``, replacing those
+        written before.
+        """
+        path = os.path.join(
+            self.directory, '{pid}.json'.format(pid=os.getpid()))
+        # The file is replaced in one step so that it is never read half
+        # written.
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as snapshot_file:
+            json.dump(
+                [metric.snapshot() for metric in self._collect()],
+                snapshot_file)
+        os.rename(temporary, path)
+
+    def _read_snapshots(self):
+        """
+        :return: Tuples of each process's ID, whether it still exists and
+            the snapshots of its metrics, starting with this process.
+        :rtype: list
+        """
+        pid = os.getpid()
+        snapshots = [(pid, True, [
+            metric.snapshot() for metric in self._collect()])]
+        for filename in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != '.json' or not name.isdigit() or \
+                    int(name) == pid:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as file_:
+                    metric_snapshots = json.load(file_)
+            except (IOError, OSError, ValueError):
+                # The file was removed or could not be read.
+                continue
+            snapshots.append(
+                (int(name), _process_exists(int(name)), metric_snapshots))
+        return snapshots
+
+    def start_sync(self):
+        """
+        Write this process's metrics to the ``directory`` now and then every
+        ``sync_interval`` seconds, in a background thread. Threads do not
+        survive a fork, so call this in each worker process after it is
+        forked. This does nothing without a ``directory``.
+        """
+        if self.directory is None or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_sync(self):
+        """
+        Stop writing this process's metrics.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.write_snapshot()
+            except (IOError, OSError):
+                # Other workers see this process's older metrics until the
+                # next write.
+                pass
+            if self._stop.wait(self.sync_interval):
+                return
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text format. With a
+            ``directory``, these are the combined metrics of every process
+            which has written there.
+        :rtype: string
+        """
+        if self.directory is None:
+            metrics = self._collect()
+        else:
+            metrics = _merge(self._read_snapshots())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_app(app, registry):
+    """
+    Record the latency and number of in-flight requests of each route of a
+    Flask application, and publish these and all other metrics in
+    ``registry`` at ``/metrics``.
+
+    Routes are identified by their URL rules, such as ``/users/<email>``, so
+    that the number of label values stays small.
+
+    :param app: The application to instrument.
+    :type app: ``Flask``
+    :param registry: The registry to add request metrics to.
+    :type registry: ``Registry``
+    """
+    latency = registry.histogram(
+        'http_request_duration_seconds',
+        'Time taken to respond to requests.',
+        ['route', 'method', 'status'],
+    )
+    in_flight = registry.gauge(
+        'http_requests_in_flight',
+        'Requests which are being handled.',
+        ['route', 'method'],
+    )
+
+    def route():
+        rule = request.url_rule
+        return rule.rule if rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.time()
+        g.metrics_status = 500
+        in_flight.inc(route=route(), method=request.method)
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def stop_timer(exception):
+        started = getattr(g, 'metrics_started', None)
+        if started is None:
+            return
+        labels = {'route': route(), 'method': request.method}
+        in_flight.dec(**labels)
+        latency.observe(time.time() - started, status=g.metrics_status,
+                        **labels)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """
+        Get metrics in the Prometheus text format.
+
+        :resheader Content-Type: text/plain
+        :status 200:
+        """
+        return make_response(
+            registry.render(), 200, {'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,498 @@
+"""
+Opt-in profiling of a Flask application's requests in production.
+
+Two kinds of profile are kept for each route:
+
+* A sample of requests is profiled with ``cProfile``, which records every
+  function call and so slows those requests down. The results are given in
+  the ``pstats`` text format.
+* Requests which take longer than a threshold have their call stacks
+  sampled by a background thread every few milliseconds, which costs the
+  requests little. The results are given as collapsed stacks, one line per
+  distinct stack with the number of samples of it, which tools such as
+  ``flamegraph.pl`` draw as flame graphs.
+
+Memory can be traced with ``tracemalloc`` to find what allocates between two
+points in time, such as before and after many ``GET /users`` requests.
+
+Profiles and memory traces are given at ``/debug/...`` routes, which are
+only added if there is a token for them. Callers must give that token in an
+``X-Profiling-Token`` header.
+"""
+
+from collections import Counter
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+from flask import g, jsonify, make_response, request
+from requests import codes
+
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+# Requests for the results are not themselves profiled.
+DEBUG_ENDPOINTS = ('debug_profile', 'debug_memory')
+
+
+def _route():
+    """
+    :return: The method and URL rule of the current request, such as
+        ``GET /users/<email>``.
+    :rtype: string
+    """
+    rule = request.url_rule
+    return '{method} {rule}'.format(
+        method=request.method,
+        rule=rule.rule if rule is not None else 'unmatched')
+
+
+def collapse_stack(frame):
+    """
+    :param frame: The innermost frame of a call stack.
+    :return: The functions of the stack from the outermost, in the form
+        ``file.py:function`` and separated by ``;``.
+    :rtype: string
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{file}:{function}'.format(
+            file=os.path.basename(code.co_filename),
+            function=code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfiler(object):
+    """
+    Profile a sample of requests with ``cProfile``, and sample the stacks of
+    slow requests, keeping the results for each route.
+    """
+
+    def __init__(self, sample_rate=0.0, slow_seconds=0.0, interval=0.005,
+                 random=random.random):
+        """
+        :param sample_rate: The fraction of requests to profile with
+            ``cProfile``, from ``0`` for none to ``1`` for all.
+        :type sample_rate: float
+        :param slow_seconds: Keep stack samples of requests which take at
+            least this many seconds. If this is ``0`` stacks are not sampled.
+        :type slow_seconds: float
+        :param interval: The number of seconds between stack samples.
+        :type interval: float
+        :param random: A function which returns a number from ``0`` up to
+            ``1``, to choose the requests to profile.
+        """
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.enabled = sample_rate > 0 or slow_seconds > 0
+        self._random = random
+        self._lock = threading.Lock()
+        # ``pstats.Stats`` and the number of requests profiled, by route.
+        self._profiles = {}
+        # Counts of collapsed stacks and the number of slow requests, by
+        # route.
+        self._stacks = {}
+        # Counts of the stacks of requests in progress, by thread.
+        self._active = {}
+        self._sampler_pid = None
+
+    def _start_sampler(self):
+        """
+        Start sampling stacks in a background thread, unless this process
+        already is. Threads do not survive a fork, so a forked worker process
+        starts its own on its first request.
+        """
+        with self._lock:
+            if self._sampler_pid == os.getpid():
+                return
+            self._sampler_pid = os.getpid()
+        thread = threading.Thread(target=self._sample_stacks)
+        thread.daemon = True
+        thread.start()
+
+    def _sample_stacks(self):
+        pid = os.getpid()
+        while self._sampler_pid == pid:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse_stack(frame)] += 1
+
+    def start_request(self):
+        """
+        Start profiling the current request if it is chosen, and sampling its
+        stack in case it is slow. This is a ``before_request`` function.
+        """
+        if request.endpoint in DEBUG_ENDPOINTS:
+            return
+
+        if self.slow_seconds > 0:
+            self._start_sampler()
+            g.profiling_started = time.time()
+            with self._lock:
+                self._active[threading.current_thread().ident] = Counter()
+
+        if self.sample_rate > 0 and self._random() < self.sample_rate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already running in this process.
+                return
+            g.profile = profile
+
+    def finish_request(self, exception):
+        """
+        Keep the profile and the stack samples of the current request, if
+        there are any. This is a ``teardown_request`` function.
+        """
+        route = _route()
+
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            g.profile = None
+            profile.disable()
+            with self._lock:
+                if route in self._profiles:
+                    stats, count = self._profiles[route]
+                    stats.add(profile)
+                else:
+                    stats, count = pstats.Stats(profile), 0
+                self._profiles[route] = (stats, count + 1)
+
+        started = getattr(g, 'profiling_started', None)
+        if started is not None:
+            g.profiling_started = None
+            slow = time.time() - started >= self.slow_seconds
+            with self._lock:
+                stacks = self._active.pop(
+                    threading.current_thread().ident, Counter())
+                if slow:
+                    kept, count = self._stacks.get(route, (Counter(), 0))
+                    kept.update(stacks)
+                    self._stacks[route] = (kept, count + 1)
+
+    def pstats_text(self, route=None, limit=30):
+        """
+        :param route: Only give the profile of this route, such as
+            ``GET /users``, or ``None`` for every route.
+        :type route: string or ``None``
+        :param limit: The most functions to list for each route, by
+            cumulative time.
+        :type limit: int
+        :return: The ``pstats`` listing of each route's profile.
+        :rtype: string
+        """
+        stream = StringIO()
+        with self._lock:
+            for name, (stats, count) in sorted(self._profiles.items()):
+                if route is not None and name != route:
+                    continue
+                stream.write('{route}: {count} requests profiled\n'.format(
+                    route=name, count=count))
+                stats.stream = stream
+                stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def collapsed_stacks(self, route=None):
+        """
+        :param route: Only give the stacks of this route, or ``None`` for
+            every route.
+        :type route: string or ``None``
+        :return: Each distinct stack sampled during slow requests, with the
+            route as its outermost frame, and its number of samples.
+        :rtype: string
+        """
+        lines = []
+        with self._lock:
+            for name, (stacks, _) in sorted(self._stacks.items()):
+                if route is not None and name != route:
+                    continue
+                for stack, samples in sorted(stacks.items()):
+                    lines.append('{route};{stack} {samples}'.format(
+                        route=name, stack=stack, samples=samples))
+        return ''.join(line + '\n' for line in lines)
+
+    def stats(self):
+        """
+        :return: The number of requests profiled and of slow requests
+            sampled, by route.
+        :rtype: ``dict``
+        """
+        with self._lock:
+            return {
+                'profiled': {
+                    route: count
+                    for route, (_, count) in self._profiles.items()},
+                'slow': {
+                    route: count
+                    for route, (_, count) in self._stacks.items()},
+            }
+
+    def reset(self):
+        """
+        Forget all profiles and stack samples.
+        """
+        with self._lock:
+            self._profiles = {}
+            self._stacks = {}
+
+
+class MemoryTracer(object):
+    """
+    Compare the memory allocated now with a snapshot taken earlier, using
+    ``tracemalloc``.
+    """
+
+    def __init__(self, frames=10):
+        """
+        :param frames: The number of frames to keep of the stack of each
+            allocation.
+        :type frames: int
+        """
+        self.frames = frames
+        self.available = tracemalloc is not None
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _take_snapshot(self):
+        # Allocations by the tracer and by profiles of requests are not of
+        # interest.
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, module.__file__)
+            for module in (tracemalloc, cProfile, pstats)])
+
+    def start(self):
+        """
+        Start tracing allocations, if they are not being traced, and take a
+        snapshot to compare with later.
+
+        :return: The number of bytes of traced memory currently allocated.
+        :rtype: int
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self._snapshot = self._take_snapshot()
+            return tracemalloc.get_traced_memory()[0]
+
+    @property
+    def started(self):
+        """
+        Whether a snapshot has been taken to compare with.
+        """
+        return self._snapshot is not None
+
+    def diff(self, group_by='lineno', limit=30):
+        """
+        :param group_by: ``'lineno'``, ``'filename'`` or ``'traceback'``,
+            for how to group allocations.
+        :type group_by: string
+        :param limit: The most groups to list.
+        :type limit: int
+        :return: The groups of allocations whose size changed most since the
+            snapshot, one per line. For ``'traceback'`` each group is
+            followed by its stack.
+        :rtype: string
+        """
+        with self._lock:
+            differences = self._take_snapshot().compare_to(
+                self._snapshot, group_by)
+        lines = []
+        for difference in differences[:limit]:
+            lines.append(str(difference))
+            if group_by == 'traceback':
+                lines.extend(
+                    '    ' + line for line in difference.traceback.format())
+        return ''.join(line + '\n' for line in lines)
+
+    def stop(self):
+        """
+        Stop tracing allocations and forget the snapshot.
+        """
+        with self._lock:
+            self._snapshot = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+def _text_response(text):
+    return make_response(text, codes.OK, {'Content-Type': TEXT_CONTENT_TYPE})
+
+
+def profile_app(app, profiler, token, tracer=None):
+    """
+    Profile the requests of a Flask application, and add routes at
+    ``/debug/profile`` and ``/debug/memory`` for the results.
+
+    :param app: The application to profile.
+    :type app: ``Flask``
+    :param profiler: The profiler to use. Nothing is profiled if it is not
+        ``enabled``.
+    :type profiler: ``RequestProfiler``
+    :param token: The token which callers of the ``/debug/...`` routes must
+        give in an ``X-Profiling-Token`` header. If this is empty the routes
+        are not added.
+    :type token: string or ``None``
+    :param tracer: The memory tracer to use, or ``None`` for a new one.
+    :type tracer: ``MemoryTracer``
+    """
+    if profiler.enabled:
+        app.before_request(profiler.start_request)
+        app.teardown_request(profiler.finish_request)
+
+    if not token:
+        return
+    if tracer is None:
+        tracer = MemoryTracer()
+
+    def authorized():
+        given = request.headers.get('X-Profiling-Token', '')
+        return hmac.compare_digest(given.encode('utf8'), token.encode('utf8'))
+
+    def forbidden():
+        return jsonify(
+            title='A profiling token is required.',
+            detail='Give the profiling token in an X-Profiling-Token header.',
+        ), codes.FORBIDDEN
+
+    @app.route('/debug/profile', methods=['GET', 'DELETE'])
+    def debug_profile():
+        """
+        **GET**:
+
+        Get the profiles of requests.
+
+        :reqheader X-Profiling-Token: The profiling token.
+        :query format: ``pstats`` for ``cProfile`` results, the default, or
+            ``collapsed`` for stacks sampled during slow requests.
+        :query route: Only give results for this route, such as
+            ``GET /users/<email>``.
+        :query limit: With ``pstats``, the most functions to list for each
+            route. The default is 30.
+        :resheader Content-Type: text/plain
+        :status 200: The profiles are returned.
+        :status 400: The ``format`` is not known.
+        :status 403: The profiling token was not given.
+
+        **DELETE**:
+
+        Forget all profiles.
+
+        :reqheader X-Profiling-Token: The profiling token.
+        :status 200: The profiles have been forgotten.
+        :status 403: The profiling token was not given.
+        """
+        if not authorized():
+            return forbidden()
+
+        if request.method == 'DELETE':
+            profiler.reset()
+            return jsonify({})
+
+        route = request.args.get('route')
+        output_format = request.args.get('format', 'pstats')
+        if output_format == 'pstats':
+            return _text_response(profiler.pstats_text(
+                route=route,
+                limit=request.args.get('limit', 30, type=int)))
+        if output_format == 'collapsed':
+            return _text_response(profiler.collapsed_stacks(route=route))
+        return jsonify(
+            title='There was an error validating the given arguments.',
+            detail='format must be "pstats" or "collapsed"',
+        ), codes.BAD_REQUEST
+
+    @app.route('/debug/memory', methods=['GET', 'POST', 'DELETE'])
+    def debug_memory():
+        """
+        **POST**:
+
+        Start tracing memory allocations, and take a snapshot to compare
+        with.
+
+        :reqheader X-Profiling-Token: The profiling token.
+        :resheader Content-Type: application/json
+        :resjson int traced_bytes: The memory allocated since tracing
+            started.
+        :status 200: A snapshot has been taken.
+        :status 403: The profiling token was not given.
+        :status 501: Memory cannot be traced with this version of Python.
+
+        **GET**:
+
+        Compare the memory allocated now with the snapshot.
+
+        :reqheader X-Profiling-Token: The profiling token.
+        :query group_by: ``lineno``, the default, ``filename`` or
+            ``traceback``.
+        :query limit: The most groups of allocations to list. The default
+            is 30.
+        :resheader Content-Type: text/plain
+        :status 200: The largest changes in allocations are returned.
+        :status 400: The ``group_by`` value is not known.
+        :status 403: The profiling token was not given.
+        :status 409: No snapshot has been taken.
+        :status 501: Memory cannot be traced with this version of Python.
+
+        **DELETE**:
+
+        Stop tracing memory allocations.
+
+        :reqheader X-Profiling-Token: The profiling token.
+        :status 200: Memory allocations are not being traced.
+        :status 403: The profiling token was not given.
+        :status 501: Memory cannot be traced with this version of Python.
+        """
+        if not authorized():
+            return forbidden()
+
+        if not tracer.available:
+            return jsonify(
+                title='Memory cannot be traced.',
+                detail='tracemalloc is not available in this version of '
+                       'Python.',
+            ), codes.NOT_IMPLEMENTED
+
+        if request.method == 'POST':
+            return jsonify(traced_bytes=tracer.start())
+
+        if request.method == 'DELETE':
+            tracer.stop()
+            return jsonify({})
+
+        if not tracer.started:
+            return jsonify(
+                title='No memory snapshot has been taken.',
+                detail='Take a snapshot with POST /debug/memory first.',
+            ), codes.CONFLICT
+        group_by = request.args.get('group_by', 'lineno')
+        if group_by not in ('lineno', 'filename', 'traceback'):
+            return jsonify(
+                title='There was an error validating the given arguments.',
+                detail='group_by must be "lineno", "filename" or '
+                       '"traceback"',
+            ), codes.BAD_REQUEST
+        return _text_response(tracer.diff(
+            group_by=group_by,
+            limit=request.args.get('limit', 30, type=int)))
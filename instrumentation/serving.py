@@ -0,0 +1,95 @@
+"""
+Run a Flask application in production with a pre-forking WSGI server.
+
+The application is loaded once and then worker processes are forked from the
+loading process, so that they share its memory until they write to it.
+Anything which holds connections or threads must be set up again in each
+worker, which the ``after_fork`` function given to ``serve`` does. Work
+which a worker has not finished, such as writes held back to be made in
+batches, can be finished by the ``before_exit`` function.
+"""
+
+import multiprocessing
+import os
+
+
+def worker_count(cpus=None):
+    """
+    :param cpus: The number of CPU cores, or ``None`` to count them.
+    :type cpus: int
+    :return: ``WEB_CONCURRENCY`` if that is set, and otherwise two workers
+        for each core and one more, so that a core is not left idle while a
+        worker waits on the network.
+    :rtype: int
+    """
+    if 'WEB_CONCURRENCY' in os.environ:
+        return int(os.environ['WEB_CONCURRENCY'])
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    return 2 * cpus + 1
+
+
+def thread_count():
+    """
+    :return: ``WEB_THREADS`` if that is set, and otherwise 4, for the number
+        of threads which serve requests in each worker.
+    :rtype: int
+    """
+    return int(os.environ.get('WEB_THREADS', 4))
+
+
+def server_options(bind, after_fork, workers=None, before_exit=None):
+    """
+    :param bind: The address to listen on, such as ``'0.0.0.0:5000'``.
+    :type bind: string
+    :param after_fork: A function to call with no arguments in each worker
+        process after it is forked.
+    :param workers: The number of worker processes, or ``None`` for the
+        ``worker_count``.
+    :type workers: int
+    :param before_exit: A function to call with no arguments in each worker
+        process before it exits, or ``None``.
+    :return: Gunicorn settings for serving an application.
+    :rtype: ``dict``
+    """
+    options = {
+        'bind': bind,
+        'workers': workers or worker_count(),
+        # Each worker also handles requests on a few threads, as most of
+        # their time is spent waiting for the database or the storage
+        # service.
+        'worker_class': 'gthread',
+        'threads': thread_count(),
+        'preload_app': True,
+        'post_fork': lambda server, worker: after_fork(),
+    }
+    if before_exit is not None:
+        options['worker_exit'] = lambda server, worker: before_exit()
+    return options
+
+
+def serve(app, bind, after_fork, workers=None, before_exit=None):
+    """
+    Serve an application with Gunicorn until the server is stopped. See
+    ``server_options`` for the arguments.
+
+    :param app: The application to serve.
+    :type app: ``Flask``
+    """
+    # Gunicorn is only needed to serve in production, so it is imported
+    # here rather than for every use of this module.
+    from gunicorn.app.base import BaseApplication
+
+    options = server_options(bind=bind, after_fork=after_fork,
+                             workers=workers, before_exit=before_exit)
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
@@ -0,0 +1,263 @@
+"""
+Tests for instrumentation.metrics.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+from instrumentation.metrics import Registry, instrument_app
+
+
+class RegistryTests(unittest.TestCase):
+    """
+    Tests for ``Registry`` and the metrics it makes.
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        """
+        Counters are rendered with their help text, type and a value for each
+        combination of labels.
+        """
+        counter = self.registry.counter('events_total', 'Events.', ['kind'])
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b')
+        self.assertEqual(
+            self.registry.render(),
+            '# HELP events_total Events.\n'
+            '# TYPE events_total counter\n'
+            'events_total{kind="a"} 3.0\n'
+            'events_total{kind="b"} 1.0\n',
+        )
+
+    def test_repeated_metric(self):
+        """
+        Adding a metric with the name and type of one already in the registry
+        gives the existing metric, which is rendered once.
+        """
+        first = self.registry.counter('events_total', 'Events.')
+        second = self.registry.counter('events_total', 'Events.')
+        self.assertIs(first, second)
+        second.inc()
+        self.assertEqual(
+            self.registry.render(),
+            '# HELP events_total Events.\n'
+            '# TYPE events_total counter\n'
+            'events_total 1.0\n',
+        )
+
+    def test_gauge(self):
+        """
+        Gauges can go down.
+        """
+        gauge = self.registry.gauge('in_flight', 'In flight.')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertIn('in_flight 1.0\n', self.registry.render())
+
+    def test_histogram(self):
+        """
+        Histograms are rendered with cumulative buckets, a sum and a count.
+        """
+        histogram = self.registry.histogram(
+            'latency_seconds', 'Latency.', ['route'], buckets=(0.1, 1))
+        histogram.observe(0.05, route='/')
+        histogram.observe(0.5, route='/')
+        histogram.observe(5, route='/')
+        self.assertEqual(
+            self.registry.render(),
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{route="/",le="0.1"} 1\n'
+            'latency_seconds_bucket{route="/",le="1.0"} 2\n'
+            'latency_seconds_bucket{route="/",le="+Inf"} 3\n'
+            'latency_seconds_sum{route="/"} 5.55\n'
+            'latency_seconds_count{route="/"} 3\n',
+        )
+
+    def test_timed(self):
+        """
+        A timed function returns the result of the function it wraps and
+        records one observation.
+        """
+        histogram = self.registry.histogram(
+            'call_seconds', 'Calls.', ['operation'])
+        timed_pow = histogram.timed(pow, operation='pow')
+        self.assertEqual(timed_pow(2, 3), 8)
+        self.assertIn('call_seconds_count{operation="pow"} 1\n',
+                      self.registry.render())
+
+    def test_collector(self):
+        """
+        Metrics from collectors are rendered.
+        """
+        @self.registry.add_collector
+        def collect():
+            from instrumentation.metrics import Gauge
+            gauge = Gauge('collected', 'Collected.')
+            gauge.set(7)
+            return [gauge]
+
+        self.assertIn('collected 7.0\n', self.registry.render())
+
+    def test_label_escaping(self):
+        """
+        Quotes and backslashes in label values are escaped.
+        """
+        counter = self.registry.counter('escaped', 'Escaped.', ['value'])
+        counter.inc(value='a"b\\c')
+        self.assertIn(r'escaped{value="a\"b\\c"} 1.0', self.registry.render())
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'os.fork is not available.')
+class SharedRegistryTests(unittest.TestCase):
+    """
+    Tests for sharing the metrics of worker processes forked after a
+    ``Registry`` is made through a directory.
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.registry = Registry(directory=directory, sync_interval=60)
+        self.counter = self.registry.counter(
+            'events_total', 'Events.', ['kind'])
+        self.gauge = self.registry.gauge('in_flight', 'In flight.')
+        self.histogram = self.registry.histogram(
+            'latency_seconds', 'Latency.', buckets=(0.1, 1))
+
+    def fork_worker(self):
+        """
+        Fork a worker which records some metrics and writes them to the
+        directory, and then waits until its pipe is closed.
+
+        :return: The worker's process ID and the pipe to close.
+        """
+        read_end, write_end = os.pipe()
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(write_end)
+                self.counter.inc(2, kind='a')
+                self.gauge.inc(3)
+                self.histogram.observe(0.5)
+                self.registry.write_snapshot()
+                os.write(ready_write, b'x')
+                os.read(read_end, 1)
+            finally:
+                os._exit(0)
+        os.close(read_end)
+        os.read(ready_read, 1)
+        return pid, write_end
+
+    def test_combined(self):
+        """
+        Counters and histograms are summed over the workers, and gauges are
+        given for each worker.
+        """
+        pid, pipe = self.fork_worker()
+        self.addCleanup(os.waitpid, pid, 0)
+        self.addCleanup(os.close, pipe)
+        self.counter.inc(kind='a')
+        self.gauge.inc()
+        self.histogram.observe(0.05)
+        text = self.registry.render()
+        self.assertIn('events_total{kind="a"} 3.0\n', text)
+        self.assertIn(
+            'in_flight{{worker="{pid}"}} 1.0\n'.format(pid=os.getpid()),
+            text)
+        self.assertIn('in_flight{{worker="{pid}"}} 3.0\n'.format(pid=pid),
+                      text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2\n', text)
+        self.assertIn('latency_seconds_count 2\n', text)
+
+    def test_exited_worker(self):
+        """
+        The counts of a worker which has exited are kept, but its gauges are
+        not given.
+        """
+        pid, pipe = self.fork_worker()
+        os.close(pipe)
+        os.waitpid(pid, 0)
+        text = self.registry.render()
+        self.assertIn('events_total{kind="a"} 2.0\n', text)
+        self.assertNotIn('worker="{pid}"'.format(pid=pid), text)
+
+    def test_sync(self):
+        """
+        Once started, a worker writes its metrics to the directory.
+        """
+        self.counter.inc(kind='a')
+        self.registry.start_sync()
+        self.registry.stop_sync()
+        self.assertEqual(
+            os.listdir(self.registry.directory),
+            ['{pid}.json'.format(pid=os.getpid())])
+
+
+class InstrumentAppTests(unittest.TestCase):
+    """
+    Tests for ``instrument_app``.
+    """
+
+    def setUp(self):
+        app = Flask(__name__)
+
+        @app.route('/items/<name>')
+        def item(name):
+            return name
+
+        self.registry = Registry()
+        instrument_app(app=app, registry=self.registry)
+        self.client = app.test_client()
+
+    def test_request_latency(self):
+        """
+        Request latency is recorded by URL rule, method and status code, and
+        requests are no longer in flight once they are done.
+        """
+        self.client.get('/items/a')
+        self.client.get('/items/b')
+        self.client.get('/missing')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            'text/plain'))
+        text = response.data.decode('utf8')
+        self.assertIn(
+            'http_request_duration_seconds_count'
+            '{route="/items/<name>",method="GET",status="200"} 2\n',
+            text)
+        self.assertIn(
+            'http_request_duration_seconds_count'
+            '{route="unmatched",method="GET",status="404"} 1\n',
+            text)
+        self.assertIn(
+            'http_requests_in_flight{route="/items/<name>",method="GET"} 0.0',
+            text)
+
+    def test_several_apps(self):
+        """
+        Applications instrumented with the same registry share their request
+        metrics, which are published once.
+        """
+        other = Flask(__name__)
+        instrument_app(app=other, registry=self.registry)
+        self.client.get('/items/a')
+        other.test_client().get('/missing')
+        text = self.registry.render()
+        self.assertEqual(
+            text.count('# TYPE http_request_duration_seconds histogram'), 1)
+        self.assertIn(
+            'http_request_duration_seconds_count'
+            '{route="unmatched",method="GET",status="404"} 1\n',
+            text)
@@ -0,0 +1,223 @@
+"""
+Tests for instrumentation.profiling.
+"""
+
+import json
+import sys
+import time
+import unittest
+
+from flask import Flask, jsonify
+from requests import codes
+
+from instrumentation.profiling import (
+    collapse_stack,
+    MemoryTracer,
+    profile_app,
+    RequestProfiler,
+    tracemalloc,
+)
+
+TOKEN = 'profiling-secret'
+HEADERS = {'X-Profiling-Token': TOKEN}
+
+# Allocations in the route are kept here so that they show in memory diffs.
+allocations = []
+
+
+def handle_users():
+    return jsonify(users=[str(index) for index in range(100)])
+
+
+def handle_slow():
+    time.sleep(0.05)
+    return jsonify({})
+
+
+def handle_allocate():
+    allocations.append([str(index) * 10 for index in range(10000)])
+    return jsonify({})
+
+
+def make_app(profiler, token=TOKEN):
+    app = Flask(__name__)
+    app.add_url_rule('/users', 'users', handle_users)
+    app.add_url_rule('/slow', 'slow', handle_slow)
+    app.add_url_rule('/allocate', 'allocate', handle_allocate)
+    profile_app(app=app, profiler=profiler, token=token)
+    return app
+
+
+class CollapseStackTests(unittest.TestCase):
+    """
+    Tests for ``collapse_stack``.
+    """
+
+    def test_outermost_first(self):
+        """
+        A stack is given from the outermost function to the innermost.
+        """
+        def inner():
+            return collapse_stack(sys._getframe())
+
+        stack = inner()
+        self.assertTrue(stack.endswith(
+            'test_profiling.py:test_outermost_first;'
+            'test_profiling.py:inner'))
+
+
+class RequestProfilerTests(unittest.TestCase):
+    """
+    Tests for profiling requests with ``RequestProfiler`` and getting the
+    results from ``/debug/profile``.
+    """
+
+    def test_disabled(self):
+        """
+        With no sample rate or slow threshold, nothing is profiled.
+        """
+        profiler = RequestProfiler()
+        self.assertFalse(profiler.enabled)
+        client = make_app(profiler).test_client()
+        client.get('/users')
+        self.assertEqual(profiler.stats(), {'profiled': {}, 'slow': {}})
+
+    def test_sample(self):
+        """
+        Requests chosen by the sample rate are profiled, and their profiles
+        are given for each route in the ``pstats`` format.
+        """
+        choices = iter([0.1, 0.9, 0.1])
+        profiler = RequestProfiler(
+            sample_rate=0.5, random=lambda: next(choices))
+        client = make_app(profiler).test_client()
+        for _ in range(3):
+            client.get('/users')
+        self.assertEqual(
+            profiler.stats()['profiled'], {'GET /users': 2})
+
+        response = client.get('/debug/profile', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.OK)
+        text = response.data.decode('utf8')
+        self.assertIn('GET /users: 2 requests profiled', text)
+        self.assertIn('handle_users', text)
+
+    def test_route(self):
+        """
+        The results can be limited to one route.
+        """
+        profiler = RequestProfiler(sample_rate=1)
+        client = make_app(profiler).test_client()
+        client.get('/users')
+        client.get('/slow')
+        text = client.get(
+            '/debug/profile?route=GET /slow',
+            headers=HEADERS).data.decode('utf8')
+        self.assertIn('handle_slow', text)
+        self.assertNotIn('handle_users', text)
+
+    def test_slow_requests(self):
+        """
+        The stacks of requests which take at least the slow threshold are
+        sampled and given as collapsed stacks, and faster requests are not
+        kept.
+        """
+        profiler = RequestProfiler(slow_seconds=0.03, interval=0.001)
+        client = make_app(profiler).test_client()
+        client.get('/slow')
+        client.get('/users')
+        self.assertEqual(profiler.stats()['slow'], {'GET /slow': 1})
+
+        response = client.get(
+            '/debug/profile?format=collapsed', headers=HEADERS)
+        lines = response.data.decode('utf8').splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, samples = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('GET /slow;'))
+            self.assertGreater(int(samples), 0)
+        self.assertTrue(any('handle_slow' in line for line in lines))
+
+    def test_reset(self):
+        """
+        Profiles can be forgotten.
+        """
+        profiler = RequestProfiler(sample_rate=1)
+        client = make_app(profiler).test_client()
+        client.get('/users')
+        response = client.delete('/debug/profile', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(profiler.stats()['profiled'], {})
+
+    def test_unknown_format(self):
+        """
+        Asking for an unknown format returns a BAD_REQUEST status code.
+        """
+        client = make_app(RequestProfiler()).test_client()
+        response = client.get('/debug/profile?format=svg', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.BAD_REQUEST)
+
+    def test_token_required(self):
+        """
+        The results are only given to callers with the profiling token.
+        """
+        client = make_app(RequestProfiler(sample_rate=1)).test_client()
+        for headers in ({}, {'X-Profiling-Token': 'wrong'}):
+            for path in ('/debug/profile', '/debug/memory'):
+                response = client.get(path, headers=headers)
+                self.assertEqual(response.status_code, codes.FORBIDDEN)
+
+    def test_no_token(self):
+        """
+        Without a profiling token the routes are not added.
+        """
+        client = make_app(RequestProfiler(), token=None).test_client()
+        response = client.get('/debug/profile', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.NOT_FOUND)
+
+
+@unittest.skipIf(tracemalloc is None, 'tracemalloc is not available.')
+class MemoryTracerTests(unittest.TestCase):
+    """
+    Tests for tracing memory with ``/debug/memory``.
+    """
+
+    def setUp(self):
+        self.client = make_app(RequestProfiler()).test_client()
+        self.addCleanup(MemoryTracer().stop)
+        self.addCleanup(allocations.__delitem__, slice(None))
+
+    def test_diff(self):
+        """
+        Allocations made since a snapshot are listed by where they were
+        made.
+        """
+        response = self.client.post('/debug/memory', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertIn(
+            'traced_bytes', json.loads(response.data.decode('utf8')))
+        self.client.get('/allocate')
+
+        for group_by in ('lineno', 'traceback'):
+            response = self.client.get(
+                '/debug/memory?group_by=' + group_by, headers=HEADERS)
+            self.assertEqual(response.status_code, codes.OK)
+            self.assertIn('test_profiling.py', response.data.decode('utf8'))
+
+    def test_no_snapshot(self):
+        """
+        Comparing before a snapshot is taken returns a CONFLICT status code.
+        """
+        response = self.client.get('/debug/memory', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.CONFLICT)
+
+    def test_stop(self):
+        """
+        Tracing can be stopped.
+        """
+        self.client.post('/debug/memory', headers=HEADERS)
+        response = self.client.delete('/debug/memory', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertFalse(tracemalloc.is_tracing())
+        response = self.client.get('/debug/memory', headers=HEADERS)
+        self.assertEqual(response.status_code, codes.CONFLICT)
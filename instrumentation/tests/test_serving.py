@@ -0,0 +1,79 @@
+"""
+Tests for instrumentation.serving.
+"""
+
+import os
+import unittest
+
+from instrumentation.serving import server_options, worker_count
+
+
+class WorkerCountTests(unittest.TestCase):
+    """
+    Tests for ``worker_count``.
+    """
+
+    def setUp(self):
+        self.original = os.environ.pop('WEB_CONCURRENCY', None)
+
+    def tearDown(self):
+        os.environ.pop('WEB_CONCURRENCY', None)
+        if self.original is not None:
+            os.environ['WEB_CONCURRENCY'] = self.original
+
+    def test_from_cores(self):
+        """
+        There are two workers for each core and one more.
+        """
+        self.assertEqual(worker_count(cpus=1), 3)
+        self.assertEqual(worker_count(cpus=4), 9)
+
+    def test_counts_cores(self):
+        """
+        The cores are counted if they are not given.
+        """
+        self.assertGreaterEqual(worker_count(), 3)
+
+    def test_web_concurrency(self):
+        """
+        ``WEB_CONCURRENCY`` overrides the number of workers.
+        """
+        os.environ['WEB_CONCURRENCY'] = '2'
+        self.assertEqual(worker_count(cpus=4), 2)
+
+
+class ServerOptionsTests(unittest.TestCase):
+    """
+    Tests for ``server_options``.
+    """
+
+    def test_options(self):
+        """
+        The application is loaded before forking, and the given function is
+        called in each worker after it is forked.
+        """
+        forked = []
+        options = server_options(
+            bind='127.0.0.1:5000',
+            after_fork=lambda: forked.append(True),
+            workers=3,
+        )
+        self.assertEqual(options['bind'], '127.0.0.1:5000')
+        self.assertEqual(options['workers'], 3)
+        self.assertTrue(options['preload_app'])
+        options['post_fork'](None, None)
+        self.assertEqual(forked, [True])
+        self.assertNotIn('worker_exit', options)
+
+    def test_before_exit(self):
+        """
+        The given function is called in each worker before it exits.
+        """
+        exited = []
+        options = server_options(
+            bind='127.0.0.1:5000',
+            after_fork=lambda: None,
+            before_exit=lambda: exited.append(True),
+        )
+        options['worker_exit'](None, None)
+        self.assertEqual(exited, [True])
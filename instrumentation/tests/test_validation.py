@@ -0,0 +1,181 @@
+"""
+Tests for instrumentation.validation.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask, jsonify
+import jsonschema
+from jsonschema import SchemaError, ValidationError
+
+from instrumentation.validation import (
+    compile_fast_check,
+    CompiledSchema,
+    SchemaValidators,
+)
+
+USER_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'email': {'type': 'string'},
+        'password': {},
+    },
+    'required': ['email', 'password'],
+}
+
+BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'users': {'type': 'array', 'items': USER_SCHEMA},
+    },
+    'required': ['users'],
+}
+
+INSTANCES = [
+    {'email': 'alice@example.com', 'password': 'secret'},
+    {'email': 'alice@example.com', 'password': 1},
+    {'email': 1, 'password': 'secret'},
+    {'email': 'alice@example.com'},
+    {},
+    [],
+    'alice',
+    None,
+    {'users': []},
+    {'users': [{'email': 'alice@example.com', 'password': 'secret'}]},
+    {'users': [{'email': 'alice@example.com'}]},
+    {'users': {}},
+]
+
+
+def jsonschema_error(instance, schema):
+    """
+    :return: The message of the error which ``jsonschema.validate`` raises,
+        or ``None`` if it raises nothing.
+    """
+    try:
+        jsonschema.validate(instance, schema)
+    except ValidationError as error:
+        return error.message
+    return None
+
+
+def compiled_error(instance, schema):
+    try:
+        CompiledSchema(schema=schema).validate(instance)
+    except ValidationError as error:
+        return error.message
+    return None
+
+
+class CompileFastCheckTests(unittest.TestCase):
+    """
+    Tests for ``compile_fast_check``.
+    """
+
+    def test_same_as_jsonschema(self):
+        """
+        Fast checks accept exactly the instances which ``jsonschema``
+        accepts.
+        """
+        for schema in (USER_SCHEMA, BATCH_SCHEMA):
+            check = compile_fast_check(schema)
+            for instance in INSTANCES:
+                self.assertEqual(
+                    check(instance),
+                    jsonschema_error(instance, schema) is None,
+                    (schema, instance))
+
+    def test_unsupported(self):
+        """
+        Schemas using anything other than the supported keywords and types
+        have no fast check.
+        """
+        self.assertIsNone(compile_fast_check({'type': 'integer'}))
+        self.assertIsNone(compile_fast_check(
+            {'type': 'string', 'maxLength': 10}))
+        self.assertIsNone(compile_fast_check({
+            'type': 'object',
+            'properties': {'email': {'format': 'email'}},
+        }))
+
+
+class CompiledSchemaTests(unittest.TestCase):
+    """
+    Tests for ``CompiledSchema``.
+    """
+
+    def test_same_errors_as_jsonschema(self):
+        """
+        Validation errors are the same as those of ``jsonschema.validate``,
+        with and without a fast check.
+        """
+        slow_schema = dict(USER_SCHEMA, additionalProperties=True)
+        for schema in (USER_SCHEMA, BATCH_SCHEMA, slow_schema):
+            for instance in INSTANCES:
+                self.assertEqual(
+                    compiled_error(instance, schema),
+                    jsonschema_error(instance, schema),
+                    (schema, instance))
+
+    def test_invalid_schema(self):
+        """
+        An invalid schema is rejected when it is compiled.
+        """
+        with self.assertRaises(SchemaError):
+            CompiledSchema(schema={'type': 'no such type'})
+
+
+class SchemaValidatorsTests(unittest.TestCase):
+    """
+    Tests for ``SchemaValidators``.
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'user.json'), 'w') as schemas:
+            json.dump({'create': USER_SCHEMA}, schemas)
+        with open(os.path.join(directory, 'notes.txt'), 'w') as other:
+            other.write('Not a schema.')
+
+        self.app = Flask(__name__)
+        self.app.config['JSONSCHEMA_DIR'] = directory
+        validators = SchemaValidators(self.app)
+
+        @self.app.route('/users', methods=['POST'])
+        @validators.validate('user', 'create')
+        def create():
+            return jsonify(created=True)
+
+        @self.app.errorhandler(ValidationError)
+        def on_validation_error(error):
+            return jsonify(detail=error.message), 400
+
+    def test_valid(self):
+        """
+        A request with a valid body reaches the view.
+        """
+        response = self.app.test_client().post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps({'email': 'alice@example.com',
+                             'password': 'secret'}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid(self):
+        """
+        A request with an invalid body is given to the error handler with
+        the ``jsonschema`` error.
+        """
+        response = self.app.test_client().post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps({'email': 'alice@example.com'}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {'detail': "'password' is a required property"})
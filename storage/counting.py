@@ -0,0 +1,120 @@
+"""
+Keeping stored counts up to date without writing them on every change.
+"""
+
+import threading
+
+
+class PendingCounts(object):
+    """
+    Changes to counts kept in memory and written by a background thread, so
+    that many changes to one count are combined into one write.
+
+    Changes to the same count are added together while they wait, and are
+    written at least every ``flush_interval`` seconds. Changes which fail to
+    be written are kept to retry with the next write. Changes which are
+    pending when the process is killed are lost.
+    """
+
+    def __init__(self, write, flush_interval):
+        """
+        :param write: A function which adds a difference to a stored count.
+            It is given the key of the count and the difference.
+        :param flush_interval: The most seconds to wait between writes.
+        :type flush_interval: float
+        """
+        self.write = write
+        self.flush_interval = flush_interval
+        # Differences which have not been written, keyed by count.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, key, difference):
+        """
+        Change a count.
+
+        :param key: The count to change.
+        :param difference: The amount to add to the count.
+        :type difference: int
+        """
+        if not difference:
+            return
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + difference
+
+    def pending(self, key):
+        """
+        :param key: A count.
+        :return: The sum of the changes to the count which have not been
+            written.
+        :rtype: int
+        """
+        with self._lock:
+            return self._pending.get(key, 0)
+
+    def flush(self):
+        """
+        Write all pending changes.
+
+        If a change cannot be written, whatever the error, it is kept for
+        the next flush.
+
+        :return: The number of counts written.
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+
+            written = 0
+            for key, difference in pending.items():
+                if not difference:
+                    continue
+                try:
+                    self.write(key, difference)
+                except Exception:
+                    # The database may be unreachable or busy.
+                    self.add(key, difference)
+                    continue
+                written += 1
+            return written
+
+    def start(self):
+        """
+        Write pending changes in a background thread every
+        ``flush_interval`` seconds.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Try to write all pending changes, and stop the background thread if
+        it is running.
+        """
+        if self._thread is None:
+            self.flush()
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Failed changes are kept by ``flush``, and the thread must
+                # keep running or counts would stop being written.
+                pass
+            if stopping:
+                return
@@ -0,0 +1,37 @@
+"""
+Store the fingerprint of every user's remember token again.
+
+The ``token_fingerprint`` column is set whenever a user is added or their
+password hash changes, and filled in for users stored before the column was
+added when the storage service starts. Run this after changing
+``SECRET_KEY``, which changes every remember token::
+
+    python -m storage.fingerprints
+
+With ``--missing-only`` only users without a fingerprint are updated.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from storage.storage import app, recompute_fingerprints
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--missing-only', action='store_true',
+                        help='Only update users without a fingerprint.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        updated = recompute_fingerprints(
+            page_size=args.page_size, missing_only=args.missing_only)
+
+    print(json.dumps({'updated': updated}))
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
@@ -0,0 +1,110 @@
+"""
+Move users to the shards which they belong to, after shards are added.
+
+Stop the storage service, add the new shards to ``SQLALCHEMY_SHARD_URIS``
+after the existing ones, and run::
+
+    python -m storage.rebalance
+
+Each user is copied to its new shard before it is removed from its old one,
+so if this is interrupted it can be run again.
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import Counter
+import json
+
+from storage.storage import (
+    app,
+    count_users,
+    db,
+    insert_users,
+    shard_for,
+    User,
+    user_counts,
+    using_shard,
+)
+
+
+def rebalance(page_size=1000, dry_run=False):
+    """
+    Move each user whose email address belongs to a different shard to the
+    one it belongs to. This must be called in an application context.
+
+    :param page_size: The number of users to read from a shard at a time.
+    :type page_size: int
+    :param dry_run: Count the users which would be moved without moving
+        them.
+    :type dry_run: bool
+    :return: The number of users moved, keyed by pairs of the shard they
+        were in and the shard they were moved to.
+    :rtype: ``collections.Counter``
+    """
+    moved = Counter()
+    for source in app.config['SHARD_BINDS']:
+        after = None
+        while True:
+            with using_shard(source):
+                query = User.query.order_by(User.email)
+                if after is not None:
+                    query = query.filter(User.email > after)
+                users = [
+                    {
+                        'email': user.email,
+                        'password_hash': user.password_hash,
+                        'last_login': user.last_login,
+                        'login_count': user.login_count,
+                    }
+                    for user in query.limit(page_size)]
+                db.session.remove()
+            if not users:
+                break
+            after = users[-1]['email']
+
+            by_target = {}
+            for user in users:
+                target = shard_for(user['email'])
+                if target != source:
+                    by_target.setdefault(target, []).append(user)
+
+            for target, target_users in sorted(by_target.items()):
+                moved[(source, target)] += len(target_users)
+                if dry_run:
+                    continue
+                with using_shard(target):
+                    # Users which were copied before an interruption are
+                    # skipped.
+                    insert_users(records=target_users)
+                with using_shard(source):
+                    emails = [user['email'] for user in target_users]
+                    removed = User.query.filter(
+                        User.email.in_(emails)).delete(
+                            synchronize_session=False)
+                    db.session.commit()
+                    count_users(difference=-removed)
+                    db.session.remove()
+    user_counts.flush()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Count the users which would be moved without '
+                        'moving them.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        moved = rebalance(page_size=args.page_size, dry_run=args.dry_run)
+
+    print(json.dumps(
+        {'{source} -> {target}'.format(source=source, target=target): count
+         for (source, target), count in sorted(moved.items())},
+        indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
@@ -0,0 +1,32 @@
+"""
+Count the users in each shard again, and store the counts.
+
+The number of users given by ``GET /users`` is changed some time after users
+are added and removed, rather than counted on each request. If it drifts,
+for example after users are removed from the database by hand, run::
+
+    python -m storage.recount
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from storage.storage import app, recount_users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.parse_args()
+
+    with app.app_context():
+        totals = recount_users()
+
+    print(json.dumps(
+        {str(bind): total for bind, total in totals.items()},
+        indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
@@ -0,0 +1,45 @@
+"""
+Serve the storage service in production, with a worker process for each
+share of the CPU cores. See ``instrumentation.serving``.
+
+Run with, for example::
+
+    python -m storage.serve --bind 0.0.0.0:5001
+"""
+
+import argparse
+import os
+import tempfile
+
+from instrumentation.serving import serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--bind', default='0.0.0.0:5001')
+    parser.add_argument('--workers', type=int,
+                        help='Worker processes to run. By default this is '
+                        'WEB_CONCURRENCY or based on the number of cores.')
+    args = parser.parse_args()
+
+    # Workers share their metrics through a directory which is new for
+    # each run, unless one is given.
+    if 'METRICS_DIR' not in os.environ:
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='storage-metrics-')
+    elif not os.path.isdir(os.environ['METRICS_DIR']):
+        os.makedirs(os.environ['METRICS_DIR'])
+
+    # The storage service is only set up when this is run as a command.
+    from storage.storage import app, dispose_engines, metrics, user_counts
+
+    def after_fork():
+        dispose_engines(app=app)
+        metrics.start_sync()
+        user_counts.start()
+
+    serve(app=app, bind=args.bind, after_fork=after_fork,
+          workers=args.workers, before_exit=user_counts.stop)
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
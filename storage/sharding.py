@@ -0,0 +1,50 @@
+"""
+Consistent hashing of email addresses to database shards.
+"""
+
+from bisect import bisect
+import hashlib
+
+
+def _point(key):
+    """
+    :return: The position of ``key`` on a ring of 2 ** 64 positions.
+    """
+    digest = hashlib.md5(key.encode('utf8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+class HashRing(object):
+    """
+    Shards placed at many points on a ring. A key belongs to the shard at the
+    first point at or after the key's position.
+
+    Adding a shard only moves keys to the new shard, about ``1 / n`` of them
+    for ``n`` shards, and never between existing shards.
+    """
+
+    def __init__(self, shards, points_per_shard=128):
+        """
+        :param shards: The names of the shards.
+        :type shards: list of strings
+        :param points_per_shard: The number of points for each shard. More
+            points spread keys more evenly.
+        :type points_per_shard: int
+        """
+        self.shards = list(shards)
+        ring = sorted(
+            (_point('{shard}-{index}'.format(shard=shard, index=index)),
+             shard)
+            for shard in self.shards for index in range(points_per_shard))
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def shard_for(self, key):
+        """
+        :param key: A key, such as an email address.
+        :type key: string
+        :return: The name of the shard which ``key`` belongs to.
+        :rtype: string
+        """
+        index = bisect(self._points, _point(key)) % len(self._points)
+        return self._owners[index]
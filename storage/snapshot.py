@@ -0,0 +1,146 @@
+"""
+A compact binary format for snapshots of all users.
+
+A snapshot starts with ``MAGIC``. Each user is then the length of their
+email address and of their password hash as big-endian unsigned 16 bit
+integers, followed by the UTF-8 email address and password hash. A pair of
+zero lengths ends the users, and is followed by the number of users as a
+big-endian unsigned 64 bit integer so that a truncated snapshot is noticed.
+
+Token fingerprints are not included. They are made again on import, with the
+importing service's ``SECRET_KEY``.
+
+Export the storage service's users to a file, or import them, with::
+
+    python -m storage.snapshot export users.snapshot
+    python -m storage.snapshot import users.snapshot
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import struct
+import sys
+
+MAGIC = b'JENCA-USERS-1\n'
+
+_LENGTHS = struct.Struct('>HH')
+_COUNT = struct.Struct('>Q')
+_MAX_LENGTH = 2 ** 16 - 1
+
+
+class SnapshotError(ValueError):
+    """
+    Raised when a snapshot cannot be read.
+    """
+
+
+def dump_records(pages):
+    """
+    Encode users as a snapshot, one page at a time.
+
+    :param pages: An iterable of lists of ``(email, password_hash)`` tuples.
+    :return: An iterator of ``bytes``, one for the start of the snapshot, one
+        for each page and one for the end.
+    """
+    yield MAGIC
+    count = 0
+    for page in pages:
+        parts = []
+        for email, password_hash in page:
+            email = email.encode('utf8')
+            password_hash = password_hash.encode('utf8')
+            if not email or max(len(email), len(password_hash)) > _MAX_LENGTH:
+                raise SnapshotError(
+                    'Cannot store the user "{email}" in a snapshot.'.format(
+                        email=email.decode('utf8')))
+            parts.append(_LENGTHS.pack(len(email), len(password_hash)))
+            parts.append(email)
+            parts.append(password_hash)
+        count += len(page)
+        yield b''.join(parts)
+    yield _LENGTHS.pack(0, 0) + _COUNT.pack(count)
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise SnapshotError('The snapshot ends unexpectedly.')
+        data += chunk
+    return data
+
+
+def load_records(stream):
+    """
+    Decode users from a snapshot.
+
+    :param stream: A binary file-like object to read the snapshot from.
+    :return: An iterator of ``(email, password_hash)`` tuples.
+    :raises SnapshotError: The snapshot is not valid. This is raised after
+        the users before the problem have been given.
+    """
+    if _read_exactly(stream, len(MAGIC)) != MAGIC:
+        raise SnapshotError('This is not a snapshot of users.')
+
+    count = 0
+    while True:
+        email_length, hash_length = _LENGTHS.unpack(
+            _read_exactly(stream, _LENGTHS.size))
+        if email_length == 0:
+            break
+        email = _read_exactly(stream, email_length).decode('utf8')
+        password_hash = _read_exactly(stream, hash_length).decode('utf8')
+        count += 1
+        yield email, password_hash
+
+    expected, = _COUNT.unpack(_read_exactly(stream, _COUNT.size))
+    if expected != count:
+        raise SnapshotError(
+            'The snapshot has {count} users but should have {expected}.'
+            .format(count=count, expected=expected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='The snapshot file, or - for standard '
+                        'output or input.')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='Users to import in each transaction.')
+    args = parser.parse_args()
+
+    # The storage service is only set up when this is run as a command.
+    from storage.storage import app, export_users, import_users, user_counts
+
+    binary_stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    binary_stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+
+    with app.app_context():
+        if args.command == 'export':
+            output = (binary_stdout if args.path == '-' else
+                      open(args.path, 'wb'))
+            try:
+                for chunk in export_users():
+                    output.write(chunk)
+            finally:
+                if output is not binary_stdout:
+                    output.close()
+        else:
+            stream = (binary_stdin if args.path == '-' else
+                      open(args.path, 'rb'))
+            try:
+                created, skipped = import_users(
+                    stream=stream, batch_size=args.batch_size)
+            finally:
+                if stream is not binary_stdin:
+                    stream.close()
+                user_counts.flush()
+            print(json.dumps({'created': created, 'skipped': skipped}),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':   # pragma: no cover
+    main()
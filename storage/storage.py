@@ -2,47 +2,722 @@
 A storage service for use by a Jenca Cloud authentication service.
 """
 
+from builtins import chr
+from contextlib import contextmanager
+import hashlib
 import os
+import random
+import sys
+import time
 
-from flask import Flask, json, jsonify, request, make_response
+from flask import (
+    current_app,
+    Flask,
+    g,
+    has_app_context,
+    json,
+    jsonify,
+    request,
+    make_response,
+    Response,
+    stream_with_context,
+)
 
-from flask.ext.sqlalchemy import SQLAlchemy
-from flask_jsonschema import JsonSchema, ValidationError
+from flask.ext.login import make_secure_token
+from flask.ext.sqlalchemy import SignallingSession, SQLAlchemy
+from flask_jsonschema import ValidationError
 from flask_negotiate import consumes
 
 from requests import codes
+from sqlalchemy import (
+    bindparam,
+    case,
+    event,
+    func,
+    inspect,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
 
-db = SQLAlchemy()
+from instrumentation.metrics import Registry, instrument_app
+from instrumentation.profiling import profile_app, RequestProfiler
+from instrumentation.validation import SchemaValidators
+from storage.counting import PendingCounts
+from storage.sharding import HashRing
+from storage.snapshot import dump_records, load_records, SnapshotError
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session which sends queries to the shard chosen with ``using_shard``,
+    if there is one. Otherwise queries go to the replica database chosen
+    for the current request, if one was chosen, and otherwise to the
+    primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = replica = None
+        if has_app_context():
+            shard = getattr(g, 'shard_bind', None)
+            replica = getattr(g, 'replica_bind', None)
+        if shard is not None:
+            return self.db.get_engine(self.app, bind=shard)
+        # Changes are always written to the primary.
+        if replica is not None and not self._flushing:
+            return self.db.get_engine(self.app, bind=replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with extra engine settings from an application's
+    configuration, and with queries routed to replicas. See
+    ``engine_profile`` and ``create_app``.
+    """
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(ProfiledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            options['pool_pre_ping'] = True
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(ProfiledSQLAlchemy, self).get_engine(app, bind)
+        # Engines are created once and then reused, so this adds the listener
+        # before the engine has made any connections.
+        if (engine.dialect.name == 'sqlite' and
+                not getattr(engine, 'pragmas_listener', None)):
+            pragmas = sqlite_pragmas(config=self.get_app(app).config)
+
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+
+            event.listen(engine, 'connect', set_pragmas)
+            engine.pragmas_listener = set_pragmas
+        return engine
+
+
+def engine_profile(database_uri):
+    """
+    :param database_uri: The location of a database.
+    :type database_uri: string
+    :return: Configuration to tune the engine for the database. For SQLite
+        this sets pragmas which let readers continue while there is a writer.
+        For other databases this sizes the connection pool and checks that
+        pooled connections are alive before they are used.
+    :rtype: ``dict``
+    """
+    if database_uri.startswith('sqlite'):
+        return {
+            'SQLITE_JOURNAL_MODE': os.environ.get(
+                'SQLITE_JOURNAL_MODE', 'WAL'),
+            'SQLITE_SYNCHRONOUS': os.environ.get(
+                'SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'SQLITE_MMAP_SIZE': int(os.environ.get(
+                'SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+            'SQLITE_BUSY_TIMEOUT': int(os.environ.get(
+                'SQLITE_BUSY_TIMEOUT', 5000)),
+        }
+
+    return {
+        'SQLALCHEMY_POOL_SIZE': int(os.environ.get(
+            'SQLALCHEMY_POOL_SIZE', 10)),
+        'SQLALCHEMY_MAX_OVERFLOW': int(os.environ.get(
+            'SQLALCHEMY_MAX_OVERFLOW', 20)),
+        'SQLALCHEMY_POOL_PRE_PING': os.environ.get(
+            'SQLALCHEMY_POOL_PRE_PING', 'true').lower() == 'true',
+    }
+
+
+def sqlite_pragmas(config):
+    """
+    :param config: An application's configuration.
+    :return: The SQLite pragma statements to run on each new connection.
+        Settings which are ``None`` are left at SQLite's defaults.
+    :rtype: ``list``
+    """
+    settings = [
+        ('journal_mode', config.get('SQLITE_JOURNAL_MODE')),
+        ('synchronous', config.get('SQLITE_SYNCHRONOUS')),
+        ('mmap_size', config.get('SQLITE_MMAP_SIZE')),
+        ('busy_timeout', config.get('SQLITE_BUSY_TIMEOUT')),
+    ]
+    return [
+        'PRAGMA {name}={value}'.format(name=name, value=value)
+        for name, value in settings if value is not None]
+
+
+db = ProfiledSQLAlchemy()
+
+# Requests with these methods can be served from a replica.
+READ_METHODS = ('GET', 'HEAD')
+# Requests to these endpoints only read, though they are not ``GET``
+# requests, and so can also be served from a replica.
+READ_ENDPOINTS = ('users_lookup_route',)
+# Writes to these endpoints are made in the background, after the requests
+# which caused them, so nothing waits to read them and callers are not sent
+# to the primary after them.
+BACKGROUND_WRITE_ENDPOINTS = ('users_activity_route',)
+# Writes give, and reads which depend on them send, the time until which
+# reads are served from the primary database.
+PRIMARY_UNTIL_HEADER = 'X-Primary-Until'
+
+# Hash rings are made once for each list of shards.
+_rings = {}
+
+
+def shard_for(email):
+    """
+    :param email: The email address of a user.
+    :type email: string
+    :return: The bind of the shard which holds the user with the given
+        ``email``, or ``None`` if users are not sharded.
+    :rtype: string or ``None``
+    """
+    shards = tuple(current_app.config['SHARD_BINDS'])
+    if not shards:
+        return None
+    ring = _rings.get(shards)
+    if ring is None:
+        ring = _rings[shards] = HashRing(shards=shards)
+    return ring.shard_for(email)
+
+
+def shard_binds():
+    """
+    :return: The binds of all shards, or ``[None]`` for the one database if
+        users are not sharded.
+    :rtype: ``list``
+    """
+    return current_app.config['SHARD_BINDS'] or [None]
+
+
+@contextmanager
+def using_shard(bind):
+    """
+    Send queries made within this block to a shard.
+
+    :param bind: The bind of a shard, from ``shard_for`` or ``shard_binds``.
+        If this is ``None``, queries are sent where they would be outside the
+        block.
+    """
+    previous = getattr(g, 'shard_bind', None)
+    g.shard_bind = bind
+    try:
+        yield
+    finally:
+        g.shard_bind = previous
+
+
+# Request latencies and SQL execution times are published at /metrics.
+# With ``METRICS_DIR`` set, worker processes share their metrics through that
+# directory every ``METRICS_SYNC_INTERVAL`` seconds, so that /metrics gives
+# the metrics of all of them. See ``instrumentation.metrics.Registry``.
+metrics = Registry(
+    directory=os.environ.get('METRICS_DIR'),
+    sync_interval=float(os.environ.get('METRICS_SYNC_INTERVAL', 5)),
+)
+SQL_SECONDS = metrics.histogram(
+    'storage_sql_seconds',
+    'Time taken to execute SQL statements.',
+    ['statement'],
+)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_sql_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+    """
+    Note when a SQL statement starts to execute.
+    """
+    context.metrics_started = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_sql_timer(conn, cursor, statement, parameters, context,
+                   executemany):
+    """
+    Record how long a SQL statement took, labelled with its first keyword,
+    such as ``SELECT``.
+    """
+    SQL_SECONDS.observe(
+        time.time() - context.metrics_started,
+        statement=statement.split(None, 1)[0].upper(),
+    )
+
+
+def token_fingerprint(email, password_hash):
+    """
+    The authentication service gives each user a remember token made with
+    ``make_secure_token(email, password_hash)``. This is a digest of that
+    token, so that a user can be found from their token without storing the
+    token itself.
+
+    :param email: The email address of a user.
+    :type email: string
+    :param password_hash: The password hash of a user.
+    :type password_hash: string
+    :return: A SHA-256 hex digest of the user's remember token.
+    :rtype: string
+    """
+    token = make_secure_token(email, password_hash)
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
 
 
 class User(db.Model):
     """
     A user has an email address and a password hash.
+
+    The time of a user's last login, in seconds since the epoch, and their
+    number of logins are recorded by the authentication service in batches,
+    some time after the logins. See ``record_logins``.
+
+    The time at which a user was added, in seconds since the epoch, lets
+    the authentication service find users added since it last looked. It is
+    ``NULL`` for users added before it was recorded.
     """
 
-    email = db.Column(db.String, primary_key=True)
+    # Email addresses are compared by code point, as Python compares them,
+    # so that users merged from several shards are in the order which each
+    # shard gives them. This is SQLite's default, but not PostgreSQL's.
+    email = db.Column(
+        db.String().with_variant(db.String(collation='C'), 'postgresql'),
+        primary_key=True)
     password_hash = db.Column(db.String)
+    token_fingerprint = db.Column(db.String, index=True)
+    last_login = db.Column(db.Float)
+    login_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.Float, index=True, default=time.time)
+
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def set_token_fingerprint(mapper, connection, target):
+    """
+    Keep a user's ``token_fingerprint`` up to date whenever their email
+    address or password hash changes.
+    """
+    target.token_fingerprint = token_fingerprint(
+        email=target.email,
+        password_hash=target.password_hash,
+    )
+
+
+class UserCount(db.Model):
+    """
+    A single row holding the number of users, so that the number of users
+    can be found without counting them. This is changed some time after users
+    are added and removed. See ``count_users``.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False)
+
+
+def adjust_user_count(connection, difference):
+    """
+    Change the stored number of users, as part of the transaction on
+    ``connection``.
+
+    :param connection: The connection which is adding or removing users.
+    :param difference: The number of users added, or minus the number of
+        users removed.
+    :type difference: int
+    """
+    table = UserCount.__table__
+    connection.execute(
+        table.update().values(total=table.c.total + difference))
+
+
+def write_user_count(engine, difference):
+    """
+    Change the stored number of users in a transaction of its own.
+
+    :param engine: The engine of the database whose count to change.
+    :param difference: The number of users added, or minus the number of
+        users removed.
+    :type difference: int
+    """
+    with engine.begin() as connection:
+        adjust_user_count(connection=connection, difference=difference)
+
+
+# Changes to the number of users are written to ``UserCount`` every
+# ``USER_COUNT_FLUSH_INTERVAL`` seconds, rather than in each transaction
+# which adds or removes users, as those would otherwise all wait for each
+# other to update the one row which holds a database's count.
+# See ``storage.counting``.
+user_counts = PendingCounts(
+    write=write_user_count,
+    flush_interval=float(os.environ.get('USER_COUNT_FLUSH_INTERVAL', 5)),
+)
+
+
+def shard_engine(bind):
+    """
+    :param bind: The bind of a shard, from ``shard_for`` or ``shard_binds``.
+    :return: The engine of the shard, or of the primary database if ``bind``
+        is ``None``.
+    """
+    return db.get_engine(current_app, bind=bind)
+
+
+def count_users(difference):
+    """
+    Note that users have been added to or removed from the shard chosen by
+    ``using_shard``, once the change is committed. The stored number of
+    users is changed later, by ``user_counts``.
 
+    :param difference: The number of users added, or minus the number of
+        users removed.
+    :type difference: int
+    """
+    user_counts.add(
+        shard_engine(bind=getattr(g, 'shard_bind', None)), difference)
+
+
+def recount_users():
+    """
+    Set the stored number of users of each shard to the number of users in
+    it, for example if it has drifted. Changes to the number which this
+    process has not written yet are written first. This must be called in an
+    application context.
+
+    :return: The number of users in each shard, keyed by the shard's bind,
+        which is ``None`` if users are not sharded.
+    :rtype: ``dict``
+    """
+    user_counts.flush()
+    table = UserCount.__table__
+    totals = {}
+    for bind in shard_binds():
+        with using_shard(bind):
+            # Counting in the same statement as the update means that no
+            # user can be added or removed between the two.
+            db.session.execute(table.update().values(
+                total=select([func.count()]).select_from(
+                    User.__table__).as_scalar()))
+            db.session.commit()
+            totals[bind] = db.session.query(UserCount.total).scalar()
+    return totals
+
+
+def recompute_fingerprints(page_size=1000, missing_only=False):
+    """
+    Set the token fingerprint of each user from the current ``SECRET_KEY``,
+    a page of users at a time in each shard. This must be called in an
+    application context.
+
+    :param page_size: The number of users to update in each transaction.
+    :type page_size: int
+    :param missing_only: Only update users who have no fingerprint.
+    :type missing_only: bool
+    :return: The number of users updated.
+    :rtype: int
+    """
+    table = User.__table__
+    # Bound parameters cannot share the names of the columns which they set.
+    statement = table.update().where(
+        table.c.email == bindparam('user_email'),
+    ).values(token_fingerprint=bindparam('new_fingerprint'))
+
+    updated = 0
+    for bind in shard_binds():
+        after = None
+        while True:
+            with using_shard(bind):
+                query = db.session.query(
+                    User.email, User.password_hash).order_by(User.email)
+                if after is not None:
+                    query = query.filter(User.email > after)
+                if missing_only:
+                    query = query.filter(User.token_fingerprint.is_(None))
+                users = query.limit(page_size).all()
+                if users:
+                    db.session.execute(statement, [
+                        {
+                            'user_email': email,
+                            'new_fingerprint': token_fingerprint(
+                                email=email, password_hash=password_hash),
+                        }
+                        for email, password_hash in users])
+                db.session.commit()
+                db.session.remove()
+            if not users:
+                break
+            updated += len(users)
+            after = users[-1][0]
+    return updated
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def initialise_user_count(target, connection, **kwargs):
+    """
+    Count the existing users once, when the tables are created.
+    """
+    table = UserCount.__table__
+    if connection.execute(select([table.c.id])).first() is None:
+        total = connection.execute(
+            select([func.count()]).select_from(User.__table__)).scalar()
+        connection.execute(table.insert().values(id=1, total=total))
+
+
+def create_shard_tables(app):
+    """
+    Create the tables in each of an application's shards which does not
+    have them.
+
+    :param app: An application.
+    :type app: ``Flask``
+    """
+    for bind in app.config['SHARD_BINDS']:
+        db.Model.metadata.create_all(db.get_engine(app, bind=bind))
+
+
+def add_missing_columns(engine):
+    """
+    Add the columns of ``User`` which the users table of a database does not
+    have, with their indexes, for example to a database created before the
+    columns were added to ``User``. This does nothing to a table which is up
+    to date.
+
+    :param engine: The engine of a database which has a users table.
+    :return: The names of the columns which were added.
+    :rtype: ``list``
+    """
+    table = User.__table__
+    inspector = inspect(engine)
+    columns = set(
+        column['name'] for column in inspector.get_columns(table.name))
+    indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+
+    added = []
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            # Columns which cannot be null have a server default, which
+            # existing rows are given.
+            connection.execute(
+                'ALTER TABLE {table} ADD COLUMN {column}'.format(
+                    table=engine.dialect.identifier_preparer.format_table(
+                        table),
+                    column=CreateColumn(column).compile(
+                        dialect=engine.dialect),
+                ))
+            added.append(column.name)
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=connection)
+    return added
+
+
+def pin_email_collation(engine):
+    """
+    Make a PostgreSQL users table compare email addresses by code point, as
+    new tables do, if it was made with another collation. Other databases are
+    left as they are.
+
+    :param engine: The engine of a database which has a users table.
+    :return: Whether the collation was changed.
+    :rtype: bool
+    """
+    if engine.dialect.name != 'postgresql':
+        return False
+    table = User.__table__
+    collation = engine.execute(
+        text(
+            'SELECT collation_name FROM information_schema.columns '
+            'WHERE table_schema = current_schema() '
+            'AND table_name = :table AND column_name = :column'),
+        table=table.name,
+        column=table.c.email.name,
+    ).scalar()
+    if collation == 'C':
+        return False
+    preparer = engine.dialect.identifier_preparer
+    engine.execute(
+        'ALTER TABLE {table} ALTER COLUMN {column} TYPE {type}'.format(
+            table=preparer.format_table(table),
+            column=preparer.format_column(table.c.email),
+            type=table.c.email.type.compile(dialect=engine.dialect),
+        ))
+    return True
+
+
+def upgrade_tables(app):
+    """
+    Bring the users tables of an application's databases up to date with
+    ``User``, by adding missing columns, comparing email addresses by code
+    point and filling in the token fingerprints of users who have none. This
+    can be run any number of times, and is run
+    whenever an application is created, so that databases made by earlier
+    versions of the service keep working.
 
-def create_app(database_uri):
+    :param app: An application.
+    :type app: ``Flask``
+    """
+    with app.app_context():
+        for bind in shard_binds():
+            engine = db.get_engine(app, bind=bind)
+            add_missing_columns(engine=engine)
+            pin_email_collation(engine=engine)
+        recompute_fingerprints(missing_only=True)
+
+
+def is_read(request):
+    """
+    :param request: A request to the storage service.
+    :type request: ``flask.Request``
+    :return: Whether the request only reads users.
+    :rtype: bool
+    """
+    return (request.method in READ_METHODS or
+            request.endpoint in READ_ENDPOINTS)
+
+
+def create_app(database_uri, config=None, replica_uris=(), shard_uris=()):
     """
     Create an application with a database in a given location.
 
-    :param database_uri: The location of the database for the application.
+    If there are shards, users are spread across them by consistent hashing
+    of their email addresses, and a request about one user only uses that
+    user's shard. Replicas are not used for sharded users.
+
+    ``GET`` and ``HEAD`` requests are served from a randomly chosen replica,
+    if there are any, and other requests from the primary database. After a
+    successful write, the response has an ``X-Primary-Until`` header. Reads
+    which send that header back go to the primary for the next
+    ``READ_YOUR_WRITES_SECONDS``, so that they see the write even if the
+    replicas lag behind. This is a header rather than a cookie so that a
+    client shared by many callers, like the authentication service's, sends
+    it only with the reads which depend on the write.
+
+    :param database_uri: The location of the primary database for the
+        application.
     :type database_uri: string
+    :param config: Configuration to use instead of the defaults, which
+        include the ``engine_profile`` for the database.
+    :type config: ``dict``
+    :param replica_uris: The locations of read-only replicas of the primary
+        database. These are kept up to date by the databases, not by this
+        service.
+    :type replica_uris: list of strings
+    :param shard_uris: The locations of databases to spread users across.
+        Adding a shard moves some users to it, which ``storage.rebalance``
+        does.
+    :type shard_uris: list of strings
     :return: An application instance.
     :rtype: ``Flask``
     """
     app = Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+    app.config['REPLICA_BINDS'] = [
+        'replica{index}'.format(index=index)
+        for index in range(len(replica_uris))]
+    app.config['SHARD_BINDS'] = [
+        'shard{index}'.format(index=index)
+        for index in range(len(shard_uris))]
+    app.config['SQLALCHEMY_BINDS'] = dict(
+        zip(app.config['REPLICA_BINDS'], replica_uris))
+    app.config['SQLALCHEMY_BINDS'].update(
+        zip(app.config['SHARD_BINDS'], shard_uris))
+    app.config['READ_YOUR_WRITES_SECONDS'] = float(
+        os.environ.get('READ_YOUR_WRITES_SECONDS', 2))
+    # Tracking modifications adds overhead to every commit and nothing here
+    # uses the signals which it sends.
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Token fingerprints are derived from the remember tokens which the
+    # authentication service makes, so this must match its ``SECRET_KEY``.
+    # There is no default, as with a different key no user could be found
+    # from their remember token.
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config.update(engine_profile(database_uri=database_uri))
+    app.config.update(config or {})
+    if not app.config['SECRET_KEY']:
+        raise ValueError(
+            'SECRET_KEY must be set to the secret key of the authentication '
+            'service.')
     db.init_app(app)
 
     with app.app_context():
-        db.create_all()
+        # Tables are only created in the primary database and the shards.
+        # Replicas copy them from the primary.
+        db.create_all(bind=None)
+        create_shard_tables(app=app)
+    upgrade_tables(app=app)
+
+    @app.url_value_preprocessor
+    def choose_shard(endpoint, values):
+        """
+        Send the queries of a request about one user to that user's shard.
+        """
+        if values and 'email' in values:
+            g.shard_bind = shard_for(values['email'])
+
+    @app.before_request
+    def choose_replica():
+        """
+        Send the queries of a read to a replica, unless it depends on a
+        recent write.
+        """
+        replicas = app.config['REPLICA_BINDS']
+        if not replicas or not is_read(request):
+            return
+        try:
+            primary_until = float(
+                request.headers.get(PRIMARY_UNTIL_HEADER, 0))
+        except ValueError:
+            primary_until = 0
+        if primary_until <= time.time():
+            g.replica_bind = random.choice(replicas)
+
+    @app.after_request
+    def pin_to_primary(response):
+        """
+        After a write, give the time until which reads which send it back
+        go to the primary.
+        """
+        window = app.config['READ_YOUR_WRITES_SECONDS']
+        if (app.config['REPLICA_BINDS'] and
+                not is_read(request) and
+                request.endpoint not in BACKGROUND_WRITE_ENDPOINTS and
+                response.status_code < 400 and window > 0):
+            response.headers[PRIMARY_UNTIL_HEADER] = repr(
+                time.time() + window)
+        return response
 
     return app
 
+
+def dispose_engines(app):
+    """
+    Close the pooled connections to every database of an application, so
+    that a process forked from this one opens its own.
+
+    :param app: The application whose databases to disconnect from.
+    :type app: ``Flask``
+    """
+    with app.app_context():
+        binds = app.config['REPLICA_BINDS'] + app.config['SHARD_BINDS']
+        for bind in [None] + binds:
+            db.get_engine(app, bind=bind).dispose()
+
+
 SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI',
                                          'sqlite:///:memory:')
 
@@ -61,17 +736,106 @@ if POSTGRES_HOST is not None:
         POSTGRES_DATABASE
     )
 
-app = create_app(database_uri=SQLALCHEMY_DATABASE_URI)
+# Reads can be sent to replicas of the database. Give their locations as a
+# comma separated ``SQLALCHEMY_REPLICA_URIS``.
+SQLALCHEMY_REPLICA_URIS = [
+    uri for uri in os.environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',')
+    if uri]
+
+# Users can be spread across several databases. Give their locations as a
+# comma separated ``SQLALCHEMY_SHARD_URIS``.
+SQLALCHEMY_SHARD_URIS = [
+    uri for uri in os.environ.get('SQLALCHEMY_SHARD_URIS', '').split(',')
+    if uri]
+
+app = create_app(
+    database_uri=SQLALCHEMY_DATABASE_URI,
+    replica_uris=SQLALCHEMY_REPLICA_URIS,
+    shard_uris=SQLALCHEMY_SHARD_URIS,
+)
+instrument_app(app=app, registry=metrics)
+# Requests can be profiled to see where time goes. Set
+# ``PROFILE_SAMPLE_RATE`` to the fraction of requests to profile with
+# cProfile, and ``PROFILE_SLOW_SECONDS`` to sample the stacks of requests
+# which take at least that long every ``PROFILE_SAMPLE_INTERVAL`` seconds.
+# Results, and memory traces, are given at /debug/profile and /debug/memory
+# to callers with the ``PROFILING_TOKEN``. These routes are only added if
+# that is set. See ``instrumentation.profiling``.
+profile_app(
+    app=app,
+    profiler=RequestProfiler(
+        sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+        slow_seconds=float(os.environ.get('PROFILE_SLOW_SECONDS', 0)),
+        interval=float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005)),
+    ),
+    token=os.environ.get('PROFILING_TOKEN'),
+)
 
 # Inputs can be validated using JSON schema.
-# Schemas are in app.config['JSONSCHEMA_DIR'].
-# See https://github.com/mattupstate/flask-jsonschema for details.
+# Schemas are in app.config['JSONSCHEMA_DIR'], and are compiled when the
+# application is set up. See ``instrumentation.validation``.
 app.config['JSONSCHEMA_DIR'] = os.path.join(app.root_path, 'schemas')
-jsonschema = JsonSchema(app)
+jsonschema = SchemaValidators(app)
+
+# The largest page of users which can be requested.
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+# The number of users to add in each transaction when creating users in bulk.
+# This is kept below SQLite's default limit of 999 parameters in a query.
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 500))
+
+# The number of users to add in each transaction when importing a snapshot.
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 10000))
+
+
+def prefix_end(prefix):
+    """
+    :param prefix: The start of some strings.
+    :type prefix: string
+    :return: The first string in code point order which is after every
+        string which starts with ``prefix``, or ``None`` if there is no such
+        string.
+    :rtype: string or ``None``
+    """
+    characters = list(prefix)
+    while characters:
+        code_point = ord(characters.pop()) + 1
+        if code_point > sys.maxunicode:
+            continue
+        if 0xD800 <= code_point <= 0xDFFF:
+            # Surrogates cannot be encoded, and come before the code points
+            # after them.
+            code_point = 0xE000
+        characters.append(chr(code_point))
+        return ''.join(characters)
+    return None
+
+
+def filter_email_prefix(query, prefix):
+    """
+    Filter a query for users to those with email addresses which start with
+    ``prefix``, in the case given. This is written as a range of email
+    addresses so that it can use the index on them. Databases compare email
+    addresses by code point (see ``User.email``), so the range holds exactly
+    the email addresses with the prefix.
+
+    :param query: A query for users.
+    :param prefix: The start of the email addresses to include.
+    :type prefix: string
+    :return: The filtered query.
+    """
+    query = query.filter(User.email >= prefix)
+    end = prefix_end(prefix)
+    if end is not None:
+        query = query.filter(User.email < end)
+    return query
 
 
 def load_user_from_id(user_id):
     """
+    If users are sharded, this must be called with the user's shard chosen
+    by ``using_shard``.
+
     :param user_id: The ID of the user Flask is trying to load.
     :type user_id: string
     :return: The user which has the email address ``user_id`` or ``None`` if
@@ -81,6 +845,138 @@ def load_user_from_id(user_id):
     return User.query.filter_by(email=user_id).first()
 
 
+def load_users(emails):
+    """
+    Get many users, each from their shard, in queries of at most
+    ``BATCH_CHUNK_SIZE`` email addresses.
+
+    :param emails: The email addresses of the users to get.
+    :type emails: list of strings
+    :return: A tuple of the users which exist and the email addresses of
+        those which do not, each in the order given and without repeats.
+    :rtype: ``tuple``
+    """
+    unique = []
+    seen = set()
+    by_shard = {}
+    for email in emails:
+        if email in seen:
+            continue
+        seen.add(email)
+        unique.append(email)
+        by_shard.setdefault(shard_for(email), []).append(email)
+
+    found = {}
+    for bind, shard_emails in by_shard.items():
+        with using_shard(bind):
+            for start in range(0, len(shard_emails), BATCH_CHUNK_SIZE):
+                chunk = shard_emails[start:start + BATCH_CHUNK_SIZE]
+                for user in User.query.filter(User.email.in_(chunk)):
+                    found[user.email] = user
+
+    users = [found[email] for email in unique if email in found]
+    missing = [email for email in unique if email not in found]
+    return users, missing
+
+
+def delete_user(email):
+    """
+    Delete a user with a single ``DELETE`` statement, so that of concurrent
+    deletions of the same user only one finds it. If users are sharded, this
+    must be called with the user's shard chosen by ``using_shard``.
+
+    :param email: The email address of the user to delete.
+    :type email: string
+    :return: Whether there was a user to delete.
+    :rtype: bool
+    """
+    table = User.__table__
+    deleted = db.session.execute(
+        table.delete().where(table.c.email == email)).rowcount
+    db.session.commit()
+    count_users(difference=-deleted)
+    return deleted > 0
+
+
+def user_etag(user):
+    """
+    :param user: A user.
+    :type user: ``User``
+    :return: A tag which is the same for as long as the user's details are
+        the same, for use as an HTTP ``ETag``.
+    :rtype: string
+    """
+    details = user.email + '\0' + user.password_hash
+    return hashlib.sha256(details.encode('utf8')).hexdigest()[:32]
+
+
+def load_user_from_token_fingerprint(fingerprint):
+    """
+    Fingerprints do not say which shard a user is in, so if users are
+    sharded this searches each shard in turn.
+
+    :param fingerprint: The SHA-256 hex digest of a user's remember token.
+    :type fingerprint: string
+    :return: The user with the given token ``fingerprint`` or ``None`` if
+        there is no such user.
+    :rtype: ``User`` or ``None``.
+    """
+    for bind in shard_binds():
+        with using_shard(bind):
+            user = User.query.filter_by(token_fingerprint=fingerprint).first()
+        if user is not None:
+            return user
+    return None
+
+
+def get_users_page(limit, after=None, prefix=None, created_since=None):
+    """
+    Get users in order of email address, merged from all shards.
+
+    :param limit: The largest number of users to get.
+    :type limit: int
+    :param after: Only get users with email addresses after this one.
+    :type after: string or ``None``
+    :param prefix: Only get users with email addresses which start with
+        this.
+    :type prefix: string or ``None``
+    :param created_since: Only get users added at or after this time, in
+        seconds since the epoch.
+    :type created_since: float or ``None``
+    :return: A tuple of up to ``limit`` users, the ``after`` value for the
+        next page or ``None`` if this is the last page, and the total number
+        of users, whatever the ``prefix``. The total includes changes made
+        by this process, but may not include the most recent changes made by
+        others.
+    :rtype: ``tuple``
+    """
+    query = User.query
+    if prefix:
+        query = filter_email_prefix(query=query, prefix=prefix)
+    if created_since is not None:
+        query = query.filter(User.created_at >= created_since)
+    if after is not None:
+        query = query.filter(User.email > after)
+
+    # One more user than requested is fetched from each shard to find out
+    # whether there is another page.
+    users = []
+    total = 0
+    for bind in shard_binds():
+        with using_shard(bind):
+            users.extend(
+                query.order_by(User.email).limit(limit + 1).all())
+            total += db.session.query(UserCount.total).scalar()
+        total += user_counts.pending(shard_engine(bind=bind))
+
+    # Each shard orders email addresses by code point, as this does. See
+    # ``User.email``.
+    users.sort(key=lambda user: user.email)
+    page = users[:limit]
+    next_after = page[-1].email if len(users) > limit else None
+    return page, next_after, total
+
+
 @app.errorhandler(ValidationError)
 def on_validation_error(error):
     """
@@ -117,10 +1013,60 @@ def specific_user_route(email):
     Get information about particular user.
 
     :reqheader Content-Type: application/json
+    :reqheader If-None-Match: An ``ETag`` from an earlier response. If the
+        user is unchanged, no information is returned.
     :resheader Content-Type: application/json
+    :resheader ETag: A tag which changes whenever the user changes.
     :resjson string email: The email address of the user.
     :resjson string password_hash: The password hash of the user.
     :status 200: The requested user's information is returned.
+    :status 304: The user matches the ``If-None-Match`` header.
+    :status 404: There is no user with the given ``email``.
+    """
+    user = load_user_from_id(email)
+
+    if user is not None and request.method == 'DELETE':
+        return_data = jsonify(
+            email=user.email, password_hash=user.password_hash)
+        if delete_user(email=email):
+            return return_data, codes.OK
+        # Another request deleted the user since it was loaded.
+        user = None
+
+    if user is None:
+        return jsonify(
+            title='The requested user does not exist.',
+            detail='No user exists with the email "{email}"'.format(
+                email=email),
+        ), codes.NOT_FOUND
+
+    etag = user_etag(user)
+    if etag in request.if_none_match:
+        response = make_response('', codes.NOT_MODIFIED)
+    else:
+        response = jsonify(email=user.email, password_hash=user.password_hash)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/users/<email>', methods=['PATCH'])
+@consumes('application/json')
+@jsonschema.validate('users', 'update')
+def update_user_route(email):
+    """
+    Update a particular user's password hash, for example to store a hash
+    with a different work factor.
+
+    The user's remember token changes with the password hash.
+
+    :param password_hash: The new password hash.
+    :type password_hash: string
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resheader ETag: A tag for the updated user. See ``GET``.
+    :resjson string email: The email address of the user.
+    :resjson string password_hash: The new password hash of the user.
+    :status 200: The user has been updated.
     :status 404: There is no user with the given ``email``.
     """
     user = load_user_from_id(email)
@@ -132,12 +1078,41 @@ def specific_user_route(email):
                 email=email),
         ), codes.NOT_FOUND
 
-    elif request.method == 'DELETE':
-        db.session.delete(user)
-        db.session.commit()
+    user.password_hash = request.json['password_hash']
+    db.session.commit()
+
+    response = jsonify(email=user.email, password_hash=user.password_hash)
+    response.set_etag(user_etag(user))
+    return response
+
+
+@app.route('/tokens/<fingerprint>', methods=['GET'])
+@consumes('application/json')
+def token_route(fingerprint):
+    """
+    Get information about the user with a particular remember token.
+
+    This is an indexed lookup, so its cost does not depend on the number of
+    users.
+
+    :param fingerprint: The SHA-256 hex digest of a user's remember token.
+    :type fingerprint: string
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson string email: The email address of the user.
+    :resjson string password_hash: The password hash of the user.
+    :status 200: The requested user's information is returned.
+    :status 404: There is no user with the given token ``fingerprint``.
+    """
+    user = load_user_from_token_fingerprint(fingerprint)
+
+    if user is None:
+        return jsonify(
+            title='The requested user does not exist.',
+            detail='No user exists with the given token.',
+        ), codes.NOT_FOUND
 
-    return_data = jsonify(email=user.email, password_hash=user.password_hash)
-    return return_data, codes.OK
+    return jsonify(email=user.email, password_hash=user.password_hash)
 
 
 @jsonschema.validate('users', 'create')
@@ -148,17 +1123,28 @@ def create_user():
     email = request.json['email']
     password_hash = request.json['password_hash']
 
-    if load_user_from_id(email) is not None:
+    # The insert is attempted without first checking for an existing user.
+    # The primary key constraint makes this fail if there is one, so the
+    # check and the insert cannot be separated by another request.
+    with using_shard(shard_for(email)):
+        user = User(email=email, password_hash=password_hash)
+        db.session.add(user)
+        try:
+            db.session.commit()
+            created = True
+        except IntegrityError:
+            db.session.rollback()
+            created = False
+        if created:
+            count_users(difference=1)
+
+    if not created:
         return jsonify(
             title='There is already a user with the given email address.',
             detail='A user already exists with the email "{email}"'.format(
                 email=email),
         ), codes.CONFLICT
 
-    user = User(email=email, password_hash=password_hash)
-    db.session.add(user)
-    db.session.commit()
-
     return jsonify(email=email, password_hash=password_hash), codes.CREATED
 
 
@@ -187,28 +1173,491 @@ def users_route():
 
     Get information about all users.
 
+    Without ``limit``, all users are returned in one array. With ``limit``,
+    users are returned a page at a time in order of email address.
+
+    :query limit: The maximum number of users to return, at most
+        ``MAX_PAGE_SIZE``. Giving this opts in to pagination.
+    :query after: Only return users with email addresses after this one. Use
+        the ``next`` value of a page to get the following page.
+    :query prefix: Only return users with email addresses which start with
+        this, in the same case.
+    :query created_since: With ``limit``, only return users added at or
+        after this time, in seconds since the epoch. Use an ``as_of`` value
+        a little earlier than the latest, as users are added some time
+        before they can be read.
     :reqheader Content-Type: application/json
     :resheader Content-Type: application/json
     :resjsonarr string email: The email address of a user.
     :resjsonarr string password_hash: The password hash of a user.
+    :resjson array users: With ``limit``, the users in this page.
+    :resjson string next: With ``limit``, the ``after`` value for the next
+        page, or ``null`` if this is the last page.
+    :resjson int total: With ``limit``, the number of users in total,
+        including those without the given ``prefix``. This may not include
+        users added or removed in the last few seconds.
+    :resjson number as_of: With ``limit``, the time at which the users were
+        read, in seconds since the epoch.
     :status 200: Information about all users is returned.
+    :status 400: The given ``limit`` is not valid.
     """
 
     if request.method == 'POST':
         return create_user()
 
     # It the method type is not POST it is GET.
-    details = [
-        {'email': user.email, 'password_hash': user.password_hash} for user
-        in User.query.all()]
+    query = User.query
+
+    prefix = request.args.get('prefix')
+    if prefix:
+        query = filter_email_prefix(query=query, prefix=prefix)
+
+    if 'limit' not in request.args:
+        details = []
+        for bind in shard_binds():
+            with using_shard(bind):
+                details.extend(
+                    {'email': user.email, 'password_hash': user.password_hash}
+                    for user in query.all())
+
+        return make_response(
+            json.dumps(details),
+            codes.OK,
+            {'Content-Type': 'application/json'})
+
+    limit = request.args.get('limit', type=int)
+    if limit is None or not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify(
+            title='There was an error validating the given arguments.',
+            detail='limit must be an integer from 1 to {maximum}'.format(
+                maximum=MAX_PAGE_SIZE),
+        ), codes.BAD_REQUEST
+
+    created_since = request.args.get('created_since', type=float)
+    if 'created_since' in request.args and created_since is None:
+        return jsonify(
+            title='There was an error validating the given arguments.',
+            detail='created_since must be a number',
+        ), codes.BAD_REQUEST
+
+    as_of = time.time()
+    page, next_after, total = get_users_page(
+        limit=limit,
+        after=request.args.get('after'),
+        prefix=prefix,
+        created_since=created_since,
+    )
+
+    return jsonify(
+        users=[
+            {'email': user.email, 'password_hash': user.password_hash}
+            for user in page],
+        next=next_after,
+        total=total,
+        as_of=as_of,
+    )
+
+
+def insert_users(records):
+    """
+    Add users in a single transaction, skipping any whose email addresses
+    are already in use. If users are sharded, the users must all belong to
+    the shard chosen by ``using_shard``.
+
+    :param records: Dictionaries with ``email`` and ``password_hash`` keys,
+        and optionally ``last_login`` and ``login_count`` keys. Email
+        addresses must be unique within ``records``.
+    :return: A tuple of the email addresses of the users which were added
+        and the email addresses which were already in use.
+    :rtype: ``tuple``
+    """
+    emails = [record['email'] for record in records]
+    existing = set()
+    for start in range(0, len(emails), BATCH_CHUNK_SIZE):
+        existing.update(
+            email for (email,) in
+            db.session.query(User.email).filter(
+                User.email.in_(emails[start:start + BATCH_CHUNK_SIZE])))
+
+    # Bulk inserts bypass the ORM events which set fingerprints.
+    created_at = time.time()
+    rows = [
+        {
+            'email': record['email'],
+            'password_hash': record['password_hash'],
+            'token_fingerprint': token_fingerprint(
+                email=record['email'],
+                password_hash=record['password_hash'],
+            ),
+            'last_login': record.get('last_login'),
+            'login_count': record.get('login_count', 0),
+            'created_at': created_at,
+        }
+        for record in records if record['email'] not in existing]
+
+    if rows:
+        db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+    count_users(difference=len(rows))
+
+    created = [row['email'] for row in rows]
+    conflicts = [email for email in emails if email in existing]
+    return created, conflicts
+
+
+def insert_new_users(records):
+    """
+    Add users as ``insert_users`` does, checking again for users which were
+    added by another request after they were checked for.
+
+    :param records: See ``insert_users``.
+    :return: See ``insert_users``.
+    :rtype: ``tuple``
+    """
+    try:
+        return insert_users(records=records)
+    except IntegrityError:
+        # Another request added one of these users after they were checked
+        # for. Checking again finds that user.
+        db.session.rollback()
+        return insert_users(records=records)
+
+
+def create_users(records):
+    """
+    Add many users, in transactions of ``BATCH_CHUNK_SIZE`` users. A user is
+    not added if its email address is already in use, or appears earlier in
+    ``records``.
+
+    :param records: Dictionaries with ``email`` and ``password_hash`` keys.
+    :return: A tuple of the email addresses of the users which were added
+        and, in the order given, the email addresses which were already in
+        use.
+    :rtype: ``tuple``
+    """
+    created = []
+    conflicts = []
+    seen = set()
+
+    for start in range(0, len(records), BATCH_CHUNK_SIZE):
+        chunk_records = records[start:start + BATCH_CHUNK_SIZE]
+        chunk = []
+        for record in chunk_records:
+            if record['email'] not in seen:
+                seen.add(record['email'])
+                chunk.append(record)
+
+        by_shard = {}
+        for record in chunk:
+            by_shard.setdefault(shard_for(record['email']), []).append(record)
+
+        chunk_created = set()
+        for bind, shard_records in by_shard.items():
+            with using_shard(bind):
+                shard_created, _ = insert_new_users(records=shard_records)
+            chunk_created.update(shard_created)
+
+        created.extend(
+            record['email'] for record in chunk
+            if record['email'] in chunk_created)
+        for record in chunk_records:
+            if record['email'] in chunk_created:
+                chunk_created.discard(record['email'])
+            else:
+                conflicts.append(record['email'])
+
+    return created, conflicts
+
+
+@app.route('/users/batch', methods=['POST'])
+@consumes('application/json')
+@jsonschema.validate('users', 'batch_create')
+def users_batch_route():
+    """
+    Create many users.
+
+    Users are added in transactions of ``BATCH_CHUNK_SIZE`` users. A user is
+    not added if its email address is already in use, or appears earlier in
+    the request.
+
+    :param users: An array of objects with ``email`` and ``password_hash``
+        strings.
+    :type users: array
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson array created: The email addresses of the users which have been
+        created.
+    :resjson array conflicts: The email addresses of the users which have not
+        been created because the email address is already in use.
+    :status 200: All users without conflicts have been created.
+    """
+    created, conflicts = create_users(records=request.json['users'])
+    return jsonify(created=created, conflicts=conflicts)
+
+
+@app.route('/users/lookup', methods=['POST'])
+@consumes('application/json')
+@jsonschema.validate('users', 'lookup')
+def users_lookup_route():
+    """
+    Get many particular users.
+
+    This only reads, so it is served from a replica if there are any, as
+    ``GET`` requests are.
+
+    :param emails: The email addresses of the users to get.
+    :type emails: array
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson array users: Objects with the ``email`` and ``password_hash`` of
+        each user which exists, in the order requested.
+    :resjson array missing: The email addresses requested which no user has.
+    :status 200: The users have been looked up.
+    """
+    users, missing = load_users(emails=request.json['emails'])
+    return jsonify(
+        users=[
+            {'email': user.email, 'password_hash': user.password_hash}
+            for user in users],
+        missing=missing,
+    )
+
+
+def record_logins(logins):
+    """
+    Add to users' login counts and move their last login times forward, in
+    transactions of up to ``BATCH_CHUNK_SIZE`` users for each shard.
+
+    A last login time earlier than the stored one is ignored, so batches
+    which arrive out of order do not move it back. Logins of users who do
+    not exist, for example because they have been deleted since, are
+    ignored.
+
+    :param logins: Dictionaries with the ``email`` of a user, a ``count`` of
+        their logins to add and the time of the ``last_login`` of those.
+    :return: The number of entries of ``logins`` for users who exist.
+    :rtype: int
+    """
+    table = User.__table__
+    last_login = bindparam('new_last_login')
+    # Bound parameters cannot share the names of the columns which they set.
+    statement = table.update().where(
+        table.c.email == bindparam('user_email'),
+    ).values(
+        login_count=table.c.login_count + bindparam('new_logins'),
+        last_login=case(
+            [(or_(table.c.last_login.is_(None),
+                  table.c.last_login < last_login), last_login)],
+            else_=table.c.last_login,
+        ),
+    )
+
+    by_shard = {}
+    for login in logins:
+        by_shard.setdefault(shard_for(login['email']), []).append({
+            'user_email': login['email'],
+            'new_logins': login['count'],
+            'new_last_login': login['last_login'],
+        })
+
+    updated = 0
+    for bind, rows in by_shard.items():
+        with using_shard(bind):
+            for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+                result = db.session.execute(
+                    statement, rows[start:start + BATCH_CHUNK_SIZE])
+                updated += result.rowcount
+                db.session.commit()
+    return updated
+
+
+@app.route('/users/activity', methods=['POST'])
+@consumes('application/json')
+@jsonschema.validate('users', 'record_logins')
+def users_activity_route():
+    """
+    Record logins of many users.
+
+    Users are updated in transactions of ``BATCH_CHUNK_SIZE`` users. Unlike
+    other writes, this does not send the caller's reads to the primary
+    database, as it is made in the background.
+
+    :param logins: An array of objects with the ``email`` of a user, the
+        ``count`` of their logins to add and the time of the ``last_login``
+        of those, in seconds since the epoch.
+    :type logins: array
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson int updated: The number of entries of ``logins`` for users who
+        exist. Logins of other users are ignored.
+    :status 200: The logins have been recorded.
+    """
+    updated = record_logins(logins=request.json['logins'])
+    return jsonify(updated=updated)
+
+
+@app.route('/users/<email>/activity', methods=['GET'])
+@consumes('application/json')
+def user_activity_route(email):
+    """
+    Get a particular user's login activity.
+
+    Logins are recorded in batches, so the most recent ones may not be
+    included yet.
+
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/json
+    :resjson string email: The email address of the user.
+    :resjson number last_login: The time of the user's last login, in
+        seconds since the epoch, or ``null`` if none has been recorded.
+    :resjson int login_count: The number of logins recorded.
+    :status 200: The requested user's activity is returned.
+    :status 404: There is no user with the given ``email``.
+    """
+    user = load_user_from_id(email)
+
+    if user is None:
+        return jsonify(
+            title='The requested user does not exist.',
+            detail='No user exists with the email "{email}"'.format(
+                email=email),
+        ), codes.NOT_FOUND
+
+    return jsonify(
+        email=user.email,
+        last_login=user.last_login,
+        login_count=user.login_count,
+    )
+
+
+def export_users(page_size=1000):
+    """
+    Encode all users as a snapshot. Users are read ``page_size`` at a time
+    from each shard, so memory use does not grow with the number of users.
+
+    :param page_size: The number of users to read at a time.
+    :type page_size: int
+    :return: An iterator of ``bytes`` which make up the snapshot. See
+        ``storage.snapshot``.
+    """
+    def pages():
+        for bind in shard_binds():
+            after = None
+            while True:
+                with using_shard(bind):
+                    query = db.session.query(User.email, User.password_hash)
+                    if after is not None:
+                        query = query.filter(User.email > after)
+                    page = query.order_by(User.email).limit(page_size).all()
+                if not page:
+                    break
+                after = page[-1][0]
+                yield page
+
+    return dump_records(pages())
+
+
+def import_users(stream, batch_size):
+    """
+    Add the users in a snapshot, in transactions of up to ``batch_size``
+    users for each shard. Users whose email addresses are already in use,
+    including by users added while the snapshot is imported, are skipped.
+
+    :param stream: A binary file-like object to read the snapshot from.
+    :param batch_size: The number of users to add at a time.
+    :type batch_size: int
+    :return: A tuple of the number of users added and the number skipped.
+    :rtype: ``tuple``
+    :raises storage.snapshot.SnapshotError: The snapshot is not valid. Users
+        before the problem have been added.
+    """
+    counts = {'created': 0, 'skipped': 0}
+
+    def add(batch):
+        by_shard = {}
+        for email, password_hash in batch.items():
+            by_shard.setdefault(shard_for(email), []).append(
+                {'email': email, 'password_hash': password_hash})
+        for bind, records in by_shard.items():
+            with using_shard(bind):
+                created, conflicts = insert_new_users(records=records)
+            counts['created'] += len(created)
+            counts['skipped'] += len(conflicts)
+
+    batch = {}
+    try:
+        for email, password_hash in load_records(stream):
+            if email in batch:
+                counts['skipped'] += 1
+                continue
+            batch[email] = password_hash
+            if len(batch) >= batch_size:
+                add(batch)
+                batch = {}
+    finally:
+        add(batch)
+
+    return counts['created'], counts['skipped']
+
+
+@app.route('/users/snapshot', methods=['GET'])
+@consumes('application/json')
+def snapshot_route():
+    """
+    Get a snapshot of all users.
+
+    The snapshot is in the binary format described in ``storage.snapshot``.
+    It is streamed as it is read from the database, so that it can be
+    larger than the memory of the storage service.
+
+    :reqheader Content-Type: application/json
+    :resheader Content-Type: application/octet-stream
+    :status 200: A snapshot of all users is returned.
+    """
+    return Response(
+        stream_with_context(export_users()),
+        mimetype='application/octet-stream',
+    )
+
+
+@app.route('/users/snapshot', methods=['POST'])
+@consumes('application/octet-stream')
+def restore_snapshot_route():
+    """
+    Add the users in a snapshot, such as one from ``GET /users/snapshot``.
+
+    Users are added in transactions of ``SNAPSHOT_BATCH_SIZE`` users. A user
+    is not added if its email address is already in use.
+
+    :reqheader Content-Type: application/octet-stream
+    :resheader Content-Type: application/json
+    :resjson int created: The number of users which have been added.
+    :resjson int skipped: The number of users which have not been added
+        because the email address is already in use.
+    :status 200: All users without conflicts have been added.
+    :status 400: The snapshot is not valid. Users before the problem have
+        been added.
+    """
+    try:
+        created, skipped = import_users(
+            stream=request.stream,
+            batch_size=SNAPSHOT_BATCH_SIZE,
+        )
+    except SnapshotError as error:
+        return jsonify(
+            title='The snapshot could not be read.',
+            detail=str(error),
+        ), codes.BAD_REQUEST
+
+    return jsonify(created=created, skipped=skipped)
 
-    return make_response(
-        json.dumps(details),
-        codes.OK,
-        {'Content-Type': 'application/json'})
 
 if __name__ == '__main__':   # pragma: no cover
     # Specifying 0.0.0.0 as the host tells the operating system to listen on
     # all public IPs. This makes the server visible externally.
     # See http://flask.pocoo.org/docs/0.10/quickstart/#a-minimal-application
-    app.run(host='0.0.0.0', port=5001)
+    user_counts.start()
+    try:
+        app.run(host='0.0.0.0', port=5001)
+    finally:
+        user_counts.stop()
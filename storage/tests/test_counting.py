@@ -0,0 +1,97 @@
+"""
+Tests for storage.counting.
+"""
+
+import threading
+import unittest
+
+from storage.counting import PendingCounts
+
+
+class RecordingWriter(object):
+    """
+    A writer which keeps the changes written with it, or fails to write
+    them.
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.fail = False
+        self.written = threading.Event()
+
+    def __call__(self, key, difference):
+        if self.fail:
+            raise IOError()
+        self.writes.append((key, difference))
+        self.written.set()
+
+
+class PendingCountsTests(unittest.TestCase):
+    """
+    Tests for ``PendingCounts``.
+    """
+
+    def setUp(self):
+        self.writer = RecordingWriter()
+        self.counts = PendingCounts(write=self.writer, flush_interval=60)
+
+    def test_combined(self):
+        """
+        Changes to the same count are added together and written once.
+        """
+        self.counts.add('a', 1)
+        self.counts.add('a', 1)
+        self.counts.add('b', -1)
+        self.assertEqual(self.counts.pending('a'), 2)
+        self.assertEqual(self.counts.pending('c'), 0)
+        self.assertEqual(self.counts.flush(), 2)
+        self.assertEqual(sorted(self.writer.writes), [('a', 2), ('b', -1)])
+        self.assertEqual(self.counts.pending('a'), 0)
+        self.assertEqual(self.counts.flush(), 0)
+
+    def test_no_change(self):
+        """
+        Changes which add up to nothing are not written.
+        """
+        self.counts.add('a', 0)
+        self.counts.add('b', 1)
+        self.counts.add('b', -1)
+        self.assertEqual(self.counts.flush(), 0)
+        self.assertEqual(self.writer.writes, [])
+
+    def test_failure_kept(self):
+        """
+        Changes which fail to be written are kept, with changes made since,
+        for the next flush.
+        """
+        self.counts.add('a', 1)
+        self.writer.fail = True
+        self.assertEqual(self.counts.flush(), 0)
+        self.assertEqual(self.counts.pending('a'), 1)
+        self.counts.add('a', 2)
+        self.writer.fail = False
+        self.assertEqual(self.counts.flush(), 1)
+        self.assertEqual(self.writer.writes, [('a', 3)])
+
+    def test_background(self):
+        """
+        Once started, pending changes are written by a background thread,
+        and stopping writes the rest.
+        """
+        counts = PendingCounts(write=self.writer, flush_interval=0.01)
+        counts.start()
+        counts.add('a', 1)
+        self.assertTrue(self.writer.written.wait(5))
+        counts.add('a', 1)
+        counts.stop()
+        self.assertEqual(sum(
+            difference for _, difference in self.writer.writes), 2)
+        self.assertEqual(counts.pending('a'), 0)
+
+    def test_stop_without_thread(self):
+        """
+        Stopping without a background thread writes pending changes.
+        """
+        self.counts.add('a', 1)
+        self.counts.stop()
+        self.assertEqual(self.writer.writes, [('a', 1)])
@@ -0,0 +1,369 @@
+"""
+Tests for sharding users across databases.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from requests import codes
+from sqlalchemy import select
+
+from storage.rebalance import rebalance
+from storage.sharding import HashRing
+from storage.storage import (
+    app,
+    create_shard_tables,
+    db,
+    recompute_fingerprints,
+    recount_users,
+    shard_for,
+    token_fingerprint,
+    User,
+    user_counts,
+)
+
+from .testtools import InMemoryStorageTests
+
+EMAILS = ['user{index}@example.com'.format(index=index)
+          for index in range(60)]
+
+
+class HashRingTests(unittest.TestCase):
+    """
+    Tests for ``HashRing``.
+    """
+
+    def test_spread(self):
+        """
+        Keys are spread across all shards.
+        """
+        ring = HashRing(shards=['a', 'b', 'c'])
+        keys = ['key{index}'.format(index=index) for index in range(3000)]
+        counts = {}
+        for key in keys:
+            shard = ring.shard_for(key)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        self.assertTrue(all(count > 700 for count in counts.values()))
+
+    def test_stable(self):
+        """
+        The same key always belongs to the same shard.
+        """
+        self.assertEqual(
+            HashRing(shards=['a', 'b']).shard_for('key'),
+            HashRing(shards=['a', 'b']).shard_for('key'),
+        )
+
+    def test_add_shard(self):
+        """
+        Adding a shard only moves keys to the new shard, and moves about
+        ``1 / n`` of them.
+        """
+        before = HashRing(shards=['a', 'b', 'c'])
+        after = HashRing(shards=['a', 'b', 'c', 'd'])
+        keys = ['key{index}'.format(index=index) for index in range(4000)]
+        moved = [key for key in keys
+                 if before.shard_for(key) != after.shard_for(key)]
+        self.assertTrue(all(after.shard_for(key) == 'd' for key in moved))
+        self.assertTrue(600 < len(moved) < 1400)
+
+
+class ShardedStorageTests(InMemoryStorageTests):
+    """
+    Tests for the storage service with users spread across SQLite files.
+    """
+
+    shards = 3
+
+    def setUp(self):
+        super(ShardedStorageTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.original_config = {
+            key: app.config[key]
+            for key in ('SQLALCHEMY_BINDS', 'SHARD_BINDS')}
+        self.set_shards(self.shards)
+
+    def tearDown(self):
+        user_counts.flush()
+        self.dispose()
+        app.config.update(self.original_config)
+        super(ShardedStorageTests, self).tearDown()
+
+    def set_shards(self, count):
+        """
+        Use ``count`` shards, creating tables in any new ones.
+        """
+        binds = ['shard{index}'.format(index=index) for index in range(count)]
+        app.config['SHARD_BINDS'] = binds
+        app.config['SQLALCHEMY_BINDS'] = {
+            bind: 'sqlite:///' + os.path.join(self.directory, bind + '.db')
+            for bind in binds}
+        create_shard_tables(app=app)
+
+    def dispose(self):
+        with app.app_context():
+            db.session.remove()
+            for bind in app.config['SHARD_BINDS']:
+                db.get_engine(app, bind=bind).dispose()
+
+    def stored_emails(self, bind):
+        """
+        :return: The email addresses of the users stored in a shard.
+        """
+        with app.app_context():
+            engine = db.get_engine(app, bind=bind)
+            return sorted(
+                email for (email,) in
+                engine.execute(select([User.__table__.c.email])))
+
+    def create(self, emails):
+        self.storage_app.post(
+            '/users/batch',
+            content_type='application/json',
+            data=json.dumps({'users': [
+                {'email': email, 'password_hash': 'hash'}
+                for email in emails]}))
+
+    def get(self, email):
+        return self.storage_app.get(
+            '/users/{email}'.format(email=email),
+            content_type='application/json')
+
+    def test_users_stored_in_their_shard(self):
+        """
+        Each user is only stored in the shard it belongs to, and every shard
+        is used.
+        """
+        self.create(EMAILS)
+        with app.app_context():
+            expected = {bind: [] for bind in app.config['SHARD_BINDS']}
+            for email in EMAILS:
+                expected[shard_for(email)].append(email)
+        for bind, emails in expected.items():
+            self.assertTrue(emails)
+            self.assertEqual(self.stored_emails(bind), sorted(emails))
+
+    def test_single_user_routes(self):
+        """
+        Users can be created, got, updated, found by token and deleted.
+        """
+        user = {'email': 'alice@example.com', 'password_hash': 'hash'}
+        response = self.storage_app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps(user))
+        self.assertEqual(response.status_code, codes.CREATED)
+        response = self.storage_app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps(user))
+        self.assertEqual(response.status_code, codes.CONFLICT)
+
+        self.assertEqual(self.get(user['email']).status_code, codes.OK)
+
+        response = self.storage_app.patch(
+            '/users/{email}'.format(email=user['email']),
+            content_type='application/json',
+            data=json.dumps({'password_hash': 'new_hash'}))
+        self.assertEqual(response.status_code, codes.OK)
+
+        with app.app_context():
+            fingerprint = token_fingerprint(
+                email=user['email'], password_hash='new_hash')
+        response = self.storage_app.get(
+            '/tokens/{fingerprint}'.format(fingerprint=fingerprint),
+            content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+
+        response = self.storage_app.delete(
+            '/users/{email}'.format(email=user['email']),
+            content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(self.get(user['email']).status_code, codes.NOT_FOUND)
+
+    def test_list_users(self):
+        """
+        Listing users without a limit gives users from all shards.
+        """
+        self.create(EMAILS)
+        response = self.storage_app.get(
+            '/users', content_type='application/json')
+        users = json.loads(response.data.decode('utf8'))
+        self.assertEqual(sorted(user['email'] for user in users),
+                         sorted(EMAILS))
+
+    def test_pages_merged(self):
+        """
+        Pages of users are merged from all shards in order of email address,
+        with the total number of users in all shards.
+        """
+        self.create(EMAILS)
+        emails = []
+        after = None
+        while True:
+            url = '/users?limit=7'
+            if after is not None:
+                url += '&after=' + after
+            page = json.loads(self.storage_app.get(
+                url, content_type='application/json').data.decode('utf8'))
+            self.assertEqual(page['total'], len(EMAILS))
+            emails.extend(user['email'] for user in page['users'])
+            after = page['next']
+            if after is None:
+                break
+        self.assertEqual(emails, sorted(EMAILS))
+
+    def test_pages_merged_mixed_case(self):
+        """
+        Pages of users whose email addresses differ in case, and use
+        characters outside ASCII, are merged from all shards in code point
+        order, with no user repeated or missed.
+        """
+        emails = [
+            'alice@example.com', 'Alice@example.com', 'ALICE@example.com',
+            'bob@example.com', 'Bob@example.com', 'zoe@example.com',
+            'Zoe@example.com', '_carol@example.com', u'\xe9mile@example.com',
+            u'\xc9mile@example.com', '1dan@example.com', 'dan@example.com',
+        ]
+        with app.app_context():
+            shards = set(shard_for(email) for email in emails)
+        self.assertGreater(len(shards), 1)
+        self.create(emails)
+        listed = []
+        after = None
+        while True:
+            query = {'limit': 2}
+            if after is not None:
+                query['after'] = after
+            page = json.loads(self.storage_app.get(
+                '/users', query_string=query,
+                content_type='application/json').data.decode('utf8'))
+            listed.extend(user['email'] for user in page['users'])
+            after = page['next']
+            if after is None:
+                break
+        self.assertEqual(listed, sorted(emails))
+
+    def test_batch_conflicts(self):
+        """
+        Creating users in bulk reports conflicts from every shard, in the
+        order given.
+        """
+        self.create(EMAILS[:30])
+        response = self.storage_app.post(
+            '/users/batch',
+            content_type='application/json',
+            data=json.dumps({'users': [
+                {'email': email, 'password_hash': 'hash'}
+                for email in EMAILS]}))
+        result = json.loads(response.data.decode('utf8'))
+        self.assertEqual(result['created'], EMAILS[30:])
+        self.assertEqual(result['conflicts'], EMAILS[:30])
+
+    def test_lookup(self):
+        """
+        Looking up many users finds them in every shard, in the order given.
+        """
+        self.create(EMAILS[:30])
+        emails = EMAILS[::-1]
+        response = self.storage_app.post(
+            '/users/lookup',
+            content_type='application/json',
+            data=json.dumps({'emails': emails}))
+        result = json.loads(response.data.decode('utf8'))
+        self.assertEqual(
+            [user['email'] for user in result['users']], emails[30:])
+        self.assertEqual(result['missing'], emails[:30])
+
+    def test_record_logins(self):
+        """
+        Logins are recorded for users in every shard.
+        """
+        self.create(EMAILS)
+        response = self.storage_app.post(
+            '/users/activity',
+            content_type='application/json',
+            data=json.dumps({'logins': [
+                {'email': email, 'count': 1, 'last_login': 10.0}
+                for email in EMAILS]}))
+        self.assertEqual(
+            json.loads(response.data.decode('utf8')),
+            {'updated': len(EMAILS)})
+
+    def test_rebalance_keeps_activity(self):
+        """
+        Users' login activity is moved with them when rebalancing.
+        """
+        self.create(EMAILS)
+        self.storage_app.post(
+            '/users/activity',
+            content_type='application/json',
+            data=json.dumps({'logins': [
+                {'email': email, 'count': 2, 'last_login': 10.0}
+                for email in EMAILS]}))
+        self.dispose()
+        self.set_shards(self.shards + 1)
+        with app.app_context():
+            rebalance(page_size=7)
+
+        for email in EMAILS:
+            response = self.storage_app.get(
+                '/users/{email}/activity'.format(email=email),
+                content_type='application/json')
+            activity = json.loads(response.data.decode('utf8'))
+            self.assertEqual(
+                (activity['login_count'], activity['last_login']), (2, 10.0))
+
+    def test_recompute_fingerprints(self):
+        """
+        The token fingerprints of the users in every shard are recomputed.
+        """
+        self.create(EMAILS)
+        with app.app_context():
+            self.assertEqual(
+                recompute_fingerprints(page_size=7), len(EMAILS))
+
+    def test_recount(self):
+        """
+        Users are counted again in each shard.
+        """
+        self.create(EMAILS)
+        with app.app_context():
+            totals = recount_users()
+        self.assertEqual(sorted(totals), ['shard0', 'shard1', 'shard2'])
+        for bind, total in totals.items():
+            self.assertEqual(total, len(self.stored_emails(bind)))
+
+    def test_rebalance(self):
+        """
+        After a shard is added, rebalancing moves users to the new shard so
+        that every user can be found again.
+        """
+        self.create(EMAILS)
+        self.dispose()
+        self.set_shards(self.shards + 1)
+        lost = [email for email in EMAILS
+                if self.get(email).status_code == codes.NOT_FOUND]
+        self.assertTrue(lost)
+
+        with app.app_context():
+            self.assertEqual(
+                sum(rebalance(page_size=7, dry_run=True).values()),
+                len(lost))
+            moved = rebalance(page_size=7)
+            self.assertEqual(set(target for _, target in moved), {'shard3'})
+            self.assertEqual(sum(moved.values()), len(lost))
+            self.assertEqual(rebalance(page_size=7), {})
+
+        for email in EMAILS:
+            self.assertEqual(self.get(email).status_code, codes.OK)
+        self.assertEqual(self.stored_emails('shard3'), sorted(lost))
+        page = json.loads(self.storage_app.get(
+            '/users?limit=1', content_type='application/json',
+        ).data.decode('utf8'))
+        self.assertEqual(page['total'], len(EMAILS))
@@ -0,0 +1,254 @@
+"""
+Tests for snapshots of users.
+"""
+
+import io
+import json
+import unittest
+
+from requests import codes
+from sqlalchemy.exc import IntegrityError
+
+from storage import storage
+from storage.snapshot import dump_records, load_records, MAGIC, SnapshotError
+from storage.storage import (
+    app,
+    db,
+    import_users,
+    token_fingerprint,
+    User,
+    user_counts,
+)
+
+from .testtools import InMemoryStorageTests
+
+RECORDS = [
+    ('alice@example.com', '$2b$12$abc'),
+    (u'böb@example.com', '$2b$12$def'),
+]
+
+
+def snapshot(pages):
+    return b''.join(dump_records(pages))
+
+
+class SnapshotFormatTests(unittest.TestCase):
+    """
+    Tests for encoding and decoding snapshots.
+    """
+
+    def test_round_trip(self):
+        """
+        Users which are encoded are decoded in the same order.
+        """
+        data = snapshot([RECORDS[:1], [], RECORDS[1:]])
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(list(load_records(io.BytesIO(data))), RECORDS)
+
+    def test_compact(self):
+        """
+        Each user takes four bytes more than its email address and password
+        hash.
+        """
+        data = snapshot([RECORDS[:1]])
+        self.assertEqual(
+            len(data),
+            len(MAGIC) + 4 + len('alice@example.com') + len('$2b$12$abc') +
+            4 + 8,
+        )
+
+    def test_not_snapshot(self):
+        """
+        Data which does not start like a snapshot is refused.
+        """
+        with self.assertRaises(SnapshotError):
+            list(load_records(io.BytesIO(b'[{"email": "alice@example.com"}]')))
+
+    def test_truncated(self):
+        """
+        A snapshot which ends early is refused after the complete users in
+        it are given.
+        """
+        data = snapshot([RECORDS])
+        records = load_records(io.BytesIO(data[:-20]))
+        self.assertEqual(next(records), RECORDS[0])
+        with self.assertRaises(SnapshotError):
+            list(records)
+
+    def test_wrong_count(self):
+        """
+        A snapshot whose count of users does not match the users in it is
+        refused.
+        """
+        data = snapshot([RECORDS])
+        with self.assertRaises(SnapshotError):
+            list(load_records(io.BytesIO(data[:-1] + b'\x09')))
+
+
+class SnapshotRouteTests(InMemoryStorageTests):
+    """
+    Tests for exporting users at ``GET /users/snapshot`` and importing them
+    at ``POST /users/snapshot``.
+    """
+
+    def create_users(self, count):
+        users = [
+            {'email': 'user{index:04d}@example.com'.format(index=index),
+             'password_hash': 'hash{index}'.format(index=index)}
+            for index in range(count)]
+        self.storage_app.post(
+            '/users/batch',
+            content_type='application/json',
+            data=json.dumps({'users': users}))
+        return users
+
+    def export(self):
+        response = self.storage_app.get(
+            '/users/snapshot', content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/octet-stream')
+        return response.data
+
+    def restore(self, data):
+        return self.storage_app.post(
+            '/users/snapshot',
+            content_type='application/octet-stream',
+            data=data)
+
+    def test_export(self):
+        """
+        A snapshot holds every user.
+        """
+        users = self.create_users(2500)
+        records = list(load_records(io.BytesIO(self.export())))
+        self.assertEqual(
+            records,
+            [(user['email'], user['password_hash']) for user in users])
+
+    def test_export_streamed(self):
+        """
+        A snapshot is streamed rather than built in memory.
+        """
+        response = self.storage_app.get(
+            '/users/snapshot', content_type='application/json',
+            buffered=False)
+        self.assertTrue(response.is_streamed)
+        response.close()
+
+    def test_restore(self):
+        """
+        Importing a snapshot into an empty database adds every user, with
+        token fingerprints. Importing it again skips every user.
+        """
+        users = self.create_users(30)
+        data = self.export()
+        user_counts.flush()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+        response = self.restore(data)
+        self.assertEqual(response.status_code, codes.OK)
+        self.assertEqual(json.loads(response.data.decode('utf8')),
+                         {'created': 30, 'skipped': 0})
+
+        with app.app_context():
+            fingerprint = token_fingerprint(**users[0])
+        response = self.storage_app.get(
+            '/tokens/{fingerprint}'.format(fingerprint=fingerprint),
+            content_type='application/json')
+        self.assertEqual(json.loads(response.data.decode('utf8')), users[0])
+
+        page = json.loads(self.storage_app.get(
+            '/users?limit=1', content_type='application/json',
+        ).data.decode('utf8'))
+        self.assertEqual(page['total'], 30)
+
+        response = self.restore(data)
+        self.assertEqual(json.loads(response.data.decode('utf8')),
+                         {'created': 0, 'skipped': 30})
+
+    def test_restore_batches(self):
+        """
+        Users are imported in batches, and duplicates within a snapshot are
+        skipped.
+        """
+        data = snapshot([RECORDS, RECORDS[:1], RECORDS])
+        with app.app_context():
+            created, skipped = import_users(
+                stream=io.BytesIO(data), batch_size=1)
+        self.assertEqual((created, skipped), (2, 3))
+
+    def test_restore_existing(self):
+        """
+        Users in a snapshot who already exist are skipped and counted, and
+        the others are added.
+        """
+        self.storage_app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps(
+                {'email': RECORDS[0][0], 'password_hash': 'existing'}))
+        response = self.restore(snapshot([RECORDS]))
+        self.assertEqual(json.loads(response.data.decode('utf8')),
+                         {'created': len(RECORDS) - 1, 'skipped': 1})
+        response = self.storage_app.get(
+            '/users/{email}'.format(email=RECORDS[0][0]),
+            content_type='application/json')
+        self.assertEqual(
+            json.loads(response.data.decode('utf8'))['password_hash'],
+            'existing')
+
+    def test_restore_added_meanwhile(self):
+        """
+        A user in a snapshot who is added by another request after they are
+        checked for is skipped, rather than failing the import.
+        """
+        original = storage.insert_users
+        self.addCleanup(setattr, storage, 'insert_users', original)
+        email, _ = RECORDS[0]
+
+        def insert_users(records):
+            storage.insert_users = original
+            # Another request adds the user, after the check which would
+            # have found them.
+            db.session.execute(
+                User.__table__.insert(),
+                {'email': email, 'password_hash': 'existing'})
+            db.session.commit()
+            raise IntegrityError('INSERT', {}, Exception())
+
+        storage.insert_users = insert_users
+        with app.app_context():
+            created, skipped = import_users(
+                stream=io.BytesIO(snapshot([RECORDS])), batch_size=10)
+        self.assertEqual((created, skipped), (len(RECORDS) - 1, 1))
+
+    def test_restore_invalid(self):
+        """
+        Importing something which is not a valid snapshot returns a
+        BAD_REQUEST status code and error details, after adding the users
+        before the problem.
+        """
+        data = snapshot([RECORDS])
+        response = self.restore(data[:-20])
+        self.assertEqual(response.status_code, codes.BAD_REQUEST)
+        self.assertEqual(json.loads(response.data.decode('utf8')), {
+            'title': 'The snapshot could not be read.',
+            'detail': 'The snapshot ends unexpectedly.',
+        })
+        response = self.storage_app.get(
+            '/users/{email}'.format(email=RECORDS[0][0]),
+            content_type='application/json')
+        self.assertEqual(response.status_code, codes.OK)
+
+    def test_restore_incorrect_content_type(self):
+        """
+        A snapshot must be sent as application/octet-stream.
+        """
+        response = self.storage_app.post(
+            '/users/snapshot',
+            content_type='application/json',
+            data=snapshot([RECORDS]))
+        self.assertEqual(response.status_code, codes.UNSUPPORTED_MEDIA_TYPE)
@@ -4,7 +4,7 @@ Test tools for the storage service.
 
 import unittest
 
-from storage.storage import app, db
+from storage.storage import app, db, user_counts
 
 
 class InMemoryStorageTests(unittest.TestCase):
@@ -23,6 +23,9 @@ class InMemoryStorageTests(unittest.TestCase):
             db.create_all()
 
     def tearDown(self):
+        # Changes to the number of users are written before the tables are
+        # dropped, so that they are not carried over to the next test.
+        user_counts.flush()
         with app.app_context():
             db.session.remove()
             db.drop_all()